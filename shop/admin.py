@@ -1,16 +1,13 @@
 from django.contrib import admin
-from django.utils.html import format_html, mark_safe
+from django.utils.html import format_html, format_html_join, mark_safe
 from django.urls import path
-from django.http import JsonResponse, HttpResponseRedirect
+from django.http import JsonResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.shortcuts import get_object_or_404, render
 from django.contrib import messages
-from django.core.management import call_command
 from django.conf import settings
 import os
-import threading
-import traceback
 from .models import Category, SubCategory, Brand, Product, ProductImage, ProductAnalog, OeKod, ImportFile
 
 
@@ -45,7 +42,7 @@ class CategoryAdmin(admin.ModelAdmin):
     def tree_name(self, obj):
         """Отображение названия с отступами для древовидной структуры"""
         try:
-            level = 0 if not obj.parent else 1  # Упрощенно: 0 или 1
+            level = obj.depth
             indent = "—" * level * 2
             return format_html(
                 '<span style="margin-left: {}px;">{} {}</span>',
@@ -95,6 +92,11 @@ class CategoryAdmin(admin.ModelAdmin):
                             'success': False,
                             'message': 'Категория не может быть родителем самой себе'
                         })
+                    if category.path and parent.path.startswith(category.path):
+                        return JsonResponse({
+                            'success': False,
+                            'message': 'Категорию нельзя перенести в ее собственную подкатегорию'
+                        })
                     category.parent = parent
                 else:
                     category.parent = None
@@ -170,7 +172,7 @@ class ImportFileAdmin(admin.ModelAdmin):
     list_display = ['original_filename', 'file_type_display', 'file_size', 'uploaded_at', 'status_display', 'total_rows', 'processed_rows', 'created_products', 'action_buttons']
     list_filter = ['status', 'processed', 'uploaded_at']
     search_fields = ['original_filename']
-    readonly_fields = ['file', 'original_filename', 'uploaded_at', 'file_info_display', 'processed', 'processed_at', 'total_rows', 'processed_rows', 'created_products', 'updated_products', 'error_log', 'cancelled', 'cancelled_at']
+    readonly_fields = ['file', 'original_filename', 'uploaded_at', 'file_info_display', 'processed', 'processed_at', 'total_rows', 'processed_rows', 'created_products', 'updated_products', 'error_log', 'cancelled', 'cancelled_at', 'started_at', 'timings_display']
     ordering = ['-uploaded_at']
     
     def file_size(self, obj):
@@ -245,6 +247,18 @@ class ImportFileAdmin(admin.ModelAdmin):
     
     file_info_display.short_description = 'Информация о файле'
     
+    def timings_display(self, obj):
+        """Скорость импорта и время этапов (для сравнения запусков)"""
+        if not obj.phase_timings and not obj.batch_timings:
+            return "Замеров нет"
+        lines = [('Средняя скорость', f'{obj.processing_speed} строк/сек')]
+        if obj.batch_timings:
+            lines.append(('Последние пачки', f'{obj.rows_per_sec} строк/сек'))
+        lines.extend((phase, f'{seconds:.1f} сек') for phase, seconds in obj.phase_timings.items())
+        return format_html_join(mark_safe('<br>'), '{}: {}', lines)
+    
+    timings_display.short_description = 'Замеры импорта'
+    
     def total_rows(self, obj):
         """Безопасное отображение общего количества строк"""
         try:
@@ -275,6 +289,8 @@ class ImportFileAdmin(admin.ModelAdmin):
                 'processed_rows': getattr(obj, 'processed_rows', 0) or 0,
                 'created_products': getattr(obj, 'created_products', 0) or 0,
                 'updated_products': getattr(obj, 'updated_products', 0) or 0,
+                'unchanged_products': getattr(obj, 'unchanged_products', 0) or 0,
+                'removed_products': getattr(obj, 'removed_products', 0) or 0,
             }
             
             # Убеждаемся, что все значения являются числами
@@ -292,6 +308,8 @@ class ImportFileAdmin(admin.ModelAdmin):
                 'processed_rows': 0,
                 'created_products': 0,
                 'updated_products': 0,
+                'unchanged_products': 0,
+                'removed_products': 0,
             }
     
     def stats_display(self, obj):
@@ -317,6 +335,12 @@ class ImportFileAdmin(admin.ModelAdmin):
             if stats['updated_products'] > 0:
                 stats_text += f" | Обновлено: {stats['updated_products']}"
             
+            if stats['unchanged_products'] > 0:
+                stats_text += f" | Без изменений: {stats['unchanged_products']}"
+            
+            if stats['removed_products'] > 0:
+                stats_text += f" | Пропало: {stats['removed_products']}"
+            
             return format_html(
                 '<div style="background: #f8f9fa; padding: 8px; border-radius: 4px; border: 1px solid #dee2e6;">{}</div>',
                 stats_text
@@ -331,6 +355,7 @@ class ImportFileAdmin(admin.ModelAdmin):
         try:
             status_map = {
                 'pending': ('Ожидает', 'orange'),
+                'queued': ('В очереди', 'purple'),
                 'processing': ('Обрабатывается', 'blue'),
                 'completed': ('Завершен', 'green'),
                 'failed': ('Ошибка', 'red'),
@@ -372,7 +397,7 @@ class ImportFileAdmin(admin.ModelAdmin):
                 )
             
             # Кнопка отмены импорта
-            if obj.status == 'processing':
+            if obj.status in ['queued', 'processing']:
                 buttons.append(
                     format_html(
                         '<a href="#" class="button btn-cancel-import" data-id="{}" style="background: #dc3545; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; margin-right: 5px;">⏹ Отменить</a>',
@@ -381,7 +406,7 @@ class ImportFileAdmin(admin.ModelAdmin):
                 )
             
             # Кнопка просмотра прогресса
-            if obj.status in ['processing', 'pending']:
+            if obj.status in ['processing', 'queued', 'pending']:
                 buttons.append(
                     format_html(
                         '<a href="progress/{}/" class="button" style="background: #007bff; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px;">📊 Прогресс</a>',
@@ -389,6 +414,15 @@ class ImportFileAdmin(admin.ModelAdmin):
                     )
                 )
             
+            # Кнопка продолжения с контрольной точки
+            if obj.can_resume:
+                buttons.append(
+                    format_html(
+                        '<a href="#" class="button btn-resume-import" data-id="{}" style="background: #17a2b8; color: white; padding: 5px 10px; text-decoration: none; border-radius: 3px; margin-right: 5px;">⏯ Продолжить</a>',
+                        obj.id
+                    )
+                )
+            
             # Кнопка повторного запуска
             if obj.status in ['failed', 'cancelled']:
                 buttons.append(
@@ -408,9 +442,11 @@ class ImportFileAdmin(admin.ModelAdmin):
         custom_urls = [
             path('upload/', self.admin_site.admin_view(self.upload_csv_view), name='shop_import_upload'),
             path('process/<int:file_id>/', self.admin_site.admin_view(self.process_import), name='shop_import_process'),
+            path('resume/<int:file_id>/', self.admin_site.admin_view(self.resume_import), name='shop_import_resume'),
             path('cancel/<int:file_id>/', self.admin_site.admin_view(self.cancel_import), name='shop_import_cancel'),
             path('progress/<int:file_id>/', self.admin_site.admin_view(self.import_progress), name='shop_import_progress'),
             path('status/<int:file_id>/', self.admin_site.admin_view(self.import_status), name='shop_import_status'),
+            path('stream/<int:file_id>/', self.admin_site.admin_view(self.import_stream), name='shop_import_stream'),
         ]
         return custom_urls + urls
     
@@ -433,59 +469,19 @@ class ImportFileAdmin(admin.ModelAdmin):
                     status='pending'
                 )
                 
-                # Подсчитываем количество строк/записей в файле для отображения прогресса
-                try:
-                    total_rows = 0
-                    
-                    if import_file.name.lower().endswith('.dbf'):
-                        # Обработка DBF файла
-                        try:
-                            from dbfread import DBF
-                            table = DBF(import_file_obj.file.path, encoding='cp1251', load=False)
-                            total_rows = len(table)
-                        except ImportError:
-                            import_file_obj.error_log = "Библиотека dbfread не установлена"
-                        except Exception as e:
-                            import_file_obj.error_log = f"Ошибка чтения DBF файла: {str(e)}"
-                    
-                    elif import_file.name.lower().endswith('.csv'):
-                        # Обработка CSV файла (старая логика)
-                        import csv
-                        import chardet
-                        
-                        # Определяем кодировку
-                        with open(import_file_obj.file.path, 'rb') as f:
-                            raw_data = f.read()
-                            result = chardet.detect(raw_data)
-                            encoding = result['encoding']
-                        
-                        # Подсчитываем строки
-                        with open(import_file_obj.file.path, 'r', encoding=encoding, errors='ignore') as f:
-                            # Пробуем разные разделители
-                            content = f.read()
-                            if '#' in content:
-                                delimiter = '#'
-                            elif ';' in content:
-                                delimiter = ';'
-                            elif ',' in content:
-                                delimiter = ','
-                            else:
-                                delimiter = '\t'
-                            
-                            f.seek(0)
-                            reader = csv.DictReader(f, delimiter=delimiter)
-                            total_rows = sum(1 for _ in reader)
-                    
-                    import_file_obj.total_rows = total_rows
-                    import_file_obj.save()
-                        
-                except Exception as e:
-                    # Если не удалось подсчитать строки, продолжаем без этого
-                    import_file_obj.error_log = f"Не удалось подсчитать строки/записи: {str(e)}"
-                    import_file_obj.save()
+                # Число записей DBF - из заголовка, строк CSV - оценка по образцу
+                # из начала файла; точное число посчитает импорт в воркере
+                from .import_inspect import inspect_import_file
+                info = inspect_import_file(import_file_obj.pk)
                 
                 file_type = "DBF" if import_file.name.lower().endswith('.dbf') else "CSV"
-                messages.success(request, f'{file_type} файл "{import_file.name}" успешно загружен на сервер! Всего записей: {import_file_obj.total_rows or "неизвестно"}. Теперь можно запустить импорт.')
+                if info is None:
+                    rows_message = 'Количество записей будет подсчитано при импорте.'
+                elif info['estimated']:
+                    rows_message = f'Записей примерно: {info["total_rows"]}.'
+                else:
+                    rows_message = f'Записей: {info["total_rows"]}.'
+                messages.success(request, f'{file_type} файл "{import_file.name}" успешно загружен на сервер! {rows_message} Теперь можно запустить импорт.')
                 return HttpResponseRedirect('../')
                 
             except Exception as e:
@@ -510,60 +506,49 @@ class ImportFileAdmin(admin.ModelAdmin):
                         'message': 'Файл уже обработан или отменен'
                     })
                 
-                # Проверяем есть ли активные импорты
-                active_imports = ImportFile.objects.filter(status='processing').exclude(id=file_id)
-                if active_imports.exists():
+                if import_file.status in ['queued', 'processing']:
                     return JsonResponse({
                         'success': False,
-                        'message': 'Дождитесь завершения текущего импорта. Одновременно может выполняться только один импорт.'
+                        'message': 'Импорт этого файла уже в очереди или выполняется'
                     })
                 
-                # Запускаем импорт в отдельном потоке
-                def run_import():
-                    try:
-                        # Обновляем статус на processing
-                        import_file.status = 'processing'
-                        import_file.save()
-                        
-                        # Выбираем команду импорта в зависимости от типа файла
-                        if import_file.is_dbf_file:
-                            # Используем новую команду для DBF файлов
-                            call_command(
-                                'import_dbf',
-                                import_file.file.path,  # positional dbf_file
-                                batch_size=10000,
-                                disable_transactions=True,
-                                import_file_id=import_file.id,
-                            )
-                        else:
-                            # Используем команду для CSV файлов
-                            call_command(
-                                'import_products_new',
-                                import_file.file.path,  # positional csv_file
-                                batch_size=10000,
-                                disable_transactions=True,
-                                import_file_id=import_file.id,
-                            )
-                        
-                        # Обновляем статус на completed
-                        import_file.status = 'completed'
-                        import_file.processed = True
-                        from django.utils import timezone
-                        import_file.processed_at = timezone.now()
-                        import_file.save()
-                        
-                    except Exception as e:
-                        import_file.status = 'failed'
-                        import_file.error_log = traceback.format_exc()
-                        import_file.save()
+                # Импорт выполняет отдельный процесс - воркер (manage.py run_import_worker),
+                # админка только ставит файл в очередь. Одновременно воркеры выполняют
+                # только один импорт, остальные ждут в очереди
+                import_file.enqueue()
+                
+                return JsonResponse({
+                    'success': True,
+                    'message': 'Импорт поставлен в очередь и будет выполнен фоновым воркером.',
+                    'redirect_url': f'progress/{file_id}/'
+                })
+                
+            except Exception as e:
+                return JsonResponse({
+                    'success': False,
+                    'message': f'Ошибка: {str(e)}'
+                })
+        
+        return JsonResponse({'success': False, 'message': 'Неверный метод запроса'})
+    
+    @method_decorator(csrf_exempt)
+    def resume_import(self, request, file_id):
+        """AJAX продолжение прерванного импорта с последней сохраненной пачки"""
+        if request.method == 'POST':
+            try:
+                import_file = get_object_or_404(ImportFile, id=file_id)
+                
+                if not import_file.can_resume:
+                    return JsonResponse({
+                        'success': False,
+                        'message': 'У импорта нет контрольной точки, запустите его заново'
+                    })
                 
-                thread = threading.Thread(target=run_import)
-                thread.daemon = True
-                thread.start()
+                import_file.enqueue(resume=True)
                 
                 return JsonResponse({
                     'success': True,
-                    'message': 'Импорт запущен в фоновом режиме.',
+                    'message': f'Импорт продолжится после строки {import_file.committed_row}.',
                     'redirect_url': f'progress/{file_id}/'
                 })
                 
@@ -582,19 +567,14 @@ class ImportFileAdmin(admin.ModelAdmin):
             try:
                 import_file = get_object_or_404(ImportFile, id=file_id)
                 
-                if not import_file.can_cancel:
+                # Отмечаем как отмененный (только поля отмены - счетчики и
+                # контрольную точку пишет работающая команда импорта)
+                if not import_file.cancel():
                     return JsonResponse({
                         'success': False,
                         'message': 'Импорт нельзя отменить в текущем состоянии'
                     })
                 
-                # Отмечаем как отмененный
-                from django.utils import timezone
-                import_file.cancelled = True
-                import_file.cancelled_at = timezone.now()
-                import_file.status = 'cancelled'
-                import_file.save()
-                
                 return JsonResponse({
                     'success': True,
                     'message': 'Импорт отменен'
@@ -622,7 +602,7 @@ class ImportFileAdmin(admin.ModelAdmin):
     def import_status(self, request, file_id):
         """AJAX endpoint для получения статуса импорта"""
         try:
-            import_file = get_object_or_404(ImportFile, id=file_id)
+            import_file = get_object_or_404(ImportFile, id=file_id).apply_live_progress()
             
             # Безопасное получение прогресса
             try:
@@ -647,6 +627,9 @@ class ImportFileAdmin(admin.ModelAdmin):
                 'updated_products': import_file.updated_products,
                 'error_count': import_file.error_count,
                 'processing_speed': processing_speed,
+                'rows_per_sec': import_file.rows_per_sec,
+                'eta_seconds': import_file.eta_seconds,
+                'phase_timings': import_file.phase_timings,
                 'processed': import_file.processed,
             })
         except Exception as e:
@@ -655,6 +638,38 @@ class ImportFileAdmin(admin.ModelAdmin):
                 'message': str(e)
             })
     
+    def import_stream(self, request, file_id):
+        """
+        Поток Server-Sent Events для страницы прогресса: база читается один раз
+        при подключении, дальше - только файл канала прогресса импорта
+        """
+        from .import_progress import progress_events
+        import_file = get_object_or_404(ImportFile, id=file_id).apply_live_progress()
+        initial = {
+            'status': import_file.status,
+            'current_row': import_file.current_row,
+            'total_rows': import_file.total_rows,
+            'processed_rows': import_file.processed_rows,
+            'created_products': import_file.created_products,
+            'updated_products': import_file.updated_products,
+            'error_count': import_file.error_count,
+            'progress_percent': import_file.progress_percent,
+        }
+        response = StreamingHttpResponse(
+            progress_events(
+                file_id,
+                initial,
+                poll_interval=getattr(settings, 'IMPORT_PROGRESS_WRITE_INTERVAL', 1),
+                heartbeat_interval=getattr(settings, 'IMPORT_PROGRESS_STREAM_HEARTBEAT', 15),
+                duration=getattr(settings, 'IMPORT_PROGRESS_STREAM_DURATION', 300),
+            ),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        # nginx не должен буферизовать поток
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    
     def error_log_display(self, obj):
         """Безопасное отображение лога ошибок"""
         try:
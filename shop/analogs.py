@@ -0,0 +1,153 @@
+"""
+Группы аналогов товаров.
+
+Товары связаны, если у них есть общий нормализованный номер (ProductNumber,
+включая номера OE) или явная связь ProductAnalog. Группа аналогов - компонента
+связности этого графа, ее ID равен минимальному ID товара в компоненте.
+"""
+from collections import defaultdict
+from itertools import groupby
+from operator import itemgetter
+import logging
+
+from django.db.models import Q
+
+from .models import Product, ProductNumber, ProductAnalog
+
+logger = logging.getLogger(__name__)
+
+# Номер, который встречается у большего числа товаров, считается "мусорным"
+# (заглушки вроде "0" или "Б/Н") и не связывает товары в одну группу
+MAX_NUMBER_PRODUCTS = 200
+
+# Ограничение обхода графа при инкрементальном пересчете
+MAX_INCREMENTAL_PRODUCTS = 20000
+
+CHUNK_SIZE = 500
+
+
+class UnionFind:
+    """Система непересекающихся множеств, корень - минимальный ID"""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        parent = self.parent
+        root = parent.setdefault(x, x)
+        while root != parent[root]:
+            root = parent[root]
+        # Сжатие путей
+        while x != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return
+        if root_a < root_b:
+            self.parent[root_b] = root_a
+        else:
+            self.parent[root_a] = root_b
+
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _save_groups(uf, product_ids):
+    """Записывает в Product.analog_group только изменившиеся значения"""
+    changed = []
+    for chunk in _chunks(product_ids):
+        for product_id, analog_group in Product.objects.filter(id__in=chunk).values_list('id', 'analog_group'):
+            new_group = uf.find(product_id)
+            if analog_group != new_group:
+                changed.append(Product(id=product_id, analog_group=new_group))
+
+    Product.objects.bulk_update(changed, ['analog_group'], batch_size=CHUNK_SIZE)
+    return len(changed)
+
+
+def rebuild_analog_groups(max_number_products=MAX_NUMBER_PRODUCTS):
+    """Полный пересчет групп аналогов (union-find по всему каталогу). Возвращает число измененных товаров"""
+    uf = UnionFind()
+    product_ids = list(Product.objects.values_list('id', flat=True))
+    for product_id in product_ids:
+        uf.find(product_id)
+
+    rows = ProductNumber.objects.order_by('number').values_list('number', 'product_id').iterator(chunk_size=10000)
+    for number, group in groupby(rows, key=itemgetter(0)):
+        linked = {product_id for _, product_id in group}
+        if len(linked) > max_number_products:
+            logger.info(f"Номер '{number}' встречается у {len(linked)} товаров и не учитывается в группах аналогов")
+            continue
+        first = min(linked)
+        for product_id in linked:
+            uf.union(first, product_id)
+
+    for product_id, analog_id in ProductAnalog.objects.values_list('product_id', 'analog_product_id').iterator(chunk_size=10000):
+        uf.union(product_id, analog_id)
+
+    changed = _save_groups(uf, product_ids)
+    logger.info(f"Группы аналогов пересчитаны: товаров={len(product_ids)}, изменено={changed}")
+    return changed
+
+
+def update_analog_groups(product_ids, max_number_products=MAX_NUMBER_PRODUCTS, max_products=MAX_INCREMENTAL_PRODUCTS):
+    """
+    Инкрементальный пересчет групп для измененных товаров.
+
+    Обходим граф от измененных товаров и всех участников их прежних групп:
+    так учитываются и слияния, и распады групп.
+    """
+    seeds = {product_id for product_id in product_ids if product_id}
+    if not seeds:
+        return 0
+
+    old_groups = set()
+    for chunk in _chunks(seeds):
+        old_groups.update(
+            Product.objects.filter(id__in=chunk).exclude(analog_group=None).values_list('analog_group', flat=True)
+        )
+    for chunk in _chunks(old_groups):
+        seeds.update(Product.objects.filter(analog_group__in=chunk).values_list('id', flat=True))
+
+    uf = UnionFind()
+    visited = set()
+    frontier = seeds
+    while frontier:
+        if len(visited) + len(frontier) > max_products:
+            logger.warning(f"Группа аналогов слишком большая (>{max_products} товаров), пересчет отложен до полного")
+            return 0
+        visited |= frontier
+        for product_id in frontier:
+            uf.find(product_id)
+
+        neighbours = set()
+        for chunk in _chunks(frontier):
+            numbers = set(ProductNumber.objects.filter(product_id__in=chunk).values_list('number', flat=True))
+            for number_chunk in _chunks(numbers):
+                by_number = defaultdict(set)
+                for number, product_id in ProductNumber.objects.filter(number__in=number_chunk).values_list('number', 'product_id'):
+                    by_number[number].add(product_id)
+                for linked in by_number.values():
+                    if len(linked) > max_number_products:
+                        continue
+                    first = min(linked)
+                    for product_id in linked:
+                        uf.union(first, product_id)
+                    neighbours |= linked
+
+            links = ProductAnalog.objects.filter(
+                Q(product_id__in=chunk) | Q(analog_product_id__in=chunk)
+            ).values_list('product_id', 'analog_product_id')
+            for product_id, analog_id in links:
+                uf.union(product_id, analog_id)
+                neighbours.update((product_id, analog_id))
+
+        frontier = neighbours - visited
+
+    return _save_groups(uf, visited)
@@ -0,0 +1,107 @@
+"""
+Кэш результатов каталога.
+
+Для каждой комбинации параметров запроса (поиск, фильтры, сортировка)
+хранится упорядоченный список id товаров и готовые фасеты. Ключ включает
+версию каталога: импорт и правки в админке увеличивают ее через
+bump_catalog_version(), и все старые записи перестают использоваться
+(и вытесняются по TTL/MAX_ENTRIES бэкенда кэша).
+
+Результаты могут лежать в памяти процесса (CATALOG_CACHE_ALIAS), а версия
+хранится в кэше CATALOG_VERSION_CACHE_ALIAS, общем для всех процессов:
+импорт идет в процессе воркера или консольной команды, а его результат
+должны увидеть все процессы сайта.
+"""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+VERSION_KEY = 'catalog:version'
+
+# Параметры, не влияющие на выборку (страница/курсор выбираются из списка id)
+_IGNORED_PARAMS = ('page', 'after')
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def get_version_cache():
+    return caches[getattr(settings, 'CATALOG_VERSION_CACHE_ALIAS', getattr(settings, 'CATALOG_CACHE_ALIAS', 'default'))]
+
+
+def get_catalog_version():
+    """
+    Текущая версия каталога. Если ключ версии вытеснен из кэша, создается
+    новая (по времени) - старые записи при этом гарантированно не совпадут
+    """
+    return get_version_cache().get_or_set(VERSION_KEY, time.time_ns, None)
+
+
+def bump_catalog_version():
+    """Сбрасывает кэш результатов каталога (после импорта или изменения данных)"""
+    get_version_cache().set(VERSION_KEY, time.time_ns(), None)
+
+
+def make_key(params):
+    """Ключ кэша по нормализованным параметрам запроса (QueryDict)"""
+    normalized = {}
+    for key in sorted(params):
+        if key in _IGNORED_PARAMS:
+            continue
+        values = sorted({value.strip() for value in params.getlist(key) if value.strip()})
+        if key == 'search':
+            values = [' '.join(value.lower().split()) for value in values]
+        if values:
+            normalized[key] = values
+    digest = hashlib.md5(json.dumps(normalized, ensure_ascii=False).encode('utf-8')).hexdigest()
+    return f'catalog:result:{get_catalog_version()}:{digest}'
+
+
+def get_result(key):
+    """Запись кэша {'ids': [...] или None, 'count': int, 'facets': {...}} или None"""
+    if not getattr(settings, 'CATALOG_CACHE_TTL', 0):
+        return None
+    return get_cache().get(key)
+
+
+def set_result(key, ids, count, facets):
+    """
+    Сохраняет результат. Список id хранится только для выборок не больше
+    CATALOG_CACHE_MAX_IDS, для больших - только количество и фасеты
+    """
+    ttl = getattr(settings, 'CATALOG_CACHE_TTL', 0)
+    if not ttl:
+        return
+    get_cache().set(key, {'ids': ids, 'count': count, 'facets': facets}, ttl)
+
+
+class CachedProductList:
+    """
+    Последовательность товаров по закэшированному списку id. Paginator
+    получает количество из len(), а срез страницы загружается одним
+    запросом с сохранением порядка
+    """
+
+    def __init__(self, ids, queryset):
+        self.ids = ids
+        self.queryset = queryset
+
+    def __len__(self):
+        return len(self.ids)
+
+    def count(self):
+        return len(self.ids)
+
+    def index(self, pk):
+        return self.ids.index(pk)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        page_ids = self.ids[item]
+        products = self.queryset.filter(pk__in=page_ids).in_bulk()
+        return [products[pk] for pk in page_ids if pk in products]
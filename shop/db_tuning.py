@@ -0,0 +1,152 @@
+"""
+Настройки SQLite для работы сайта и массовой загрузки импорта.
+
+configure_connection (сигнал connection_created) выставляет каждому новому
+соединению SQLITE_CONNECTION_PRAGMAS: WAL - чтение сайта не блокируется
+записью импорта, busy_timeout - пишущий ждет освобождения базы, а не
+сразу получает "database is locked".
+
+bulk_load_session() - режим импорта --bulk-load:
+
+1. На время загрузки применяются IMPORT_SQLITE_PRAGMAS (synchronous,
+   cache_size, temp_store), по окончании возвращаются прежние значения.
+2. Индексы IMPORT_DEFERRED_INDEXES снимаются, чтобы вставки не обновляли
+   их построчно, и строятся заново одним проходом в конце. По умолчанию это
+   индексы сортировок каталога (in_stock, price/name/created_at) - их
+   колонки импорт переписывает у каждой строки. Пока они сняты, сортировки
+   каталога на сайте медленнее. Индексы внешних ключей, analog_group и
+   root_section остаются: по ним фильтрует сайт и читает сам импорт
+   (категории, группы аналогов). Уникальные индексы (tmp_id, slug) не
+   снимаются никогда - на них держатся upsert и проверка slug.
+
+SQL снятых индексов хранится в самой базе (DEFERRED_INDEX_TABLE) в той же
+транзакции, что и DROP INDEX, поэтому индексы, не восстановленные из-за
+падения импорта, пересоздает restore_deferred_indexes() - ее вызывают
+следующий bulk_load_session() и воркер импорта при запуске.
+"""
+import logging
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.utils import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+}
+
+DEFAULT_IMPORT_PRAGMAS = {
+    'synchronous': 'OFF',
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+}
+
+DEFAULT_DEFERRED_INDEXES = (
+    'product_stock_created_idx',
+    'product_stock_price_idx',
+    'product_stock_name_idx',
+)
+
+DEFERRED_INDEX_TABLE = 'shop_deferred_index'
+
+
+def configure_connection(sender, connection, **kwargs):
+    """Прагмы нового соединения SQLite (обработчик connection_created)"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'SQLITE_CONNECTION_PRAGMAS', DEFAULT_CONNECTION_PRAGMAS)
+    for name, value in pragmas.items():
+        try:
+            connection.connection.execute(f'PRAGMA {name} = {value}')
+        except Exception as e:
+            logger.warning(f"Не удалось установить PRAGMA {name} = {value}: {e}")
+
+
+def _pragma(cursor, name):
+    cursor.execute(f'PRAGMA {name}')
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _execute_pragma(cursor, pragma):
+    try:
+        cursor.execute(f'PRAGMA {pragma}')
+    except DatabaseError as e:
+        # temp_store и wal_checkpoint, например, не выполняются внутри транзакции
+        logger.warning(f"Не удалось выполнить PRAGMA {pragma}: {e}")
+
+
+def _apply_pragmas(cursor, pragmas):
+    for name, value in pragmas.items():
+        _execute_pragma(cursor, f'{name} = {value}')
+
+
+def defer_indexes(names=None):
+    """Снимает неуникальные индексы из списка, сохраняя их SQL. Возвращает имена индексов"""
+    if names is None:
+        names = getattr(settings, 'IMPORT_DEFERRED_INDEXES', DEFAULT_DEFERRED_INDEXES)
+    if not names:
+        return []
+    placeholders = ', '.join(['%s'] * len(names))
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {DEFERRED_INDEX_TABLE} (name TEXT PRIMARY KEY, sql TEXT NOT NULL)')
+        cursor.execute(
+            f"SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+            f"AND sql NOT LIKE 'CREATE UNIQUE%%' AND name IN ({placeholders})",
+            list(names),
+        )
+        indexes = cursor.fetchall()
+        cursor.executemany(f'INSERT OR REPLACE INTO {DEFERRED_INDEX_TABLE} (name, sql) VALUES (%s, %s)', indexes)
+        for name, _ in indexes:
+            cursor.execute(f'DROP INDEX "{name}"')
+    return [name for name, _ in indexes]
+
+
+def restore_deferred_indexes():
+    """Строит снятые defer_indexes() индексы. Возвращает имена пересозданных индексов"""
+    if connection.vendor != 'sqlite':
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [DEFERRED_INDEX_TABLE])
+        if cursor.fetchone() is None:
+            return []
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'SELECT name, sql FROM {DEFERRED_INDEX_TABLE}')
+        indexes = cursor.fetchall()
+        for name, sql in indexes:
+            cursor.execute(sql.replace('CREATE INDEX', 'CREATE INDEX IF NOT EXISTS', 1))
+        cursor.execute(f'DROP TABLE {DEFERRED_INDEX_TABLE}')
+    return [name for name, _ in indexes]
+
+
+@contextmanager
+def bulk_load_session(indexes=None):
+    """Режим массовой загрузки SQLite (для других баз ничего не делает)"""
+    if connection.vendor != 'sqlite':
+        yield
+        return
+
+    restored = restore_deferred_indexes()
+    if restored:
+        logger.warning(f"Восстановлены индексы, оставшиеся снятыми после прошлого импорта: {restored}")
+
+    pragmas = getattr(settings, 'IMPORT_SQLITE_PRAGMAS', DEFAULT_IMPORT_PRAGMAS)
+    with connection.cursor() as cursor:
+        previous = {name: _pragma(cursor, name) for name in pragmas}
+        _apply_pragmas(cursor, pragmas)
+    deferred = defer_indexes(indexes)
+    logger.info(f"Массовая загрузка: прагмы {pragmas}, сняты индексы {deferred}")
+    try:
+        yield
+    finally:
+        restored = restore_deferred_indexes()
+        with connection.cursor() as cursor:
+            _apply_pragmas(cursor, previous)
+            # Статистика планировщика по новым индексам и усечение WAL после загрузки
+            _execute_pragma(cursor, 'optimize')
+            _execute_pragma(cursor, 'wal_checkpoint(TRUNCATE)')
+        logger.info(f"Массовая загрузка завершена, индексы построены: {restored}")
@@ -0,0 +1,71 @@
+"""
+Фасеты боковой панели каталога.
+
+Диапазон цен и количество товаров по брендам и категориям считаются одним
+сгруппированным запросом по текущей выборке CatalogView. Дерево категорий и
+список брендов загружаются по одному запросу и собираются в памяти.
+"""
+from collections import Counter
+
+from django.db.models import Count, Max, Min
+
+from .models import Brand, Category
+
+
+def _subtree_count(category):
+    """Количество товаров в категории вместе со всеми подкатегориями"""
+    category.product_count = category.own_product_count + sum(
+        _subtree_count(child) for child in category.active_children
+    )
+    return category.product_count
+
+
+def build_facets(queryset):
+    """
+    Возвращает готовые к отображению фасеты для выборки товаров:
+    min_price, max_price, brands (с product_count) и main_categories
+    (с product_count и active_children).
+    """
+    rows = (
+        queryset.order_by()
+        .prefetch_related(None)
+        .values('brand_id', 'category_id')
+        .annotate(product_count=Count('id'), min_price=Min('price'), max_price=Max('price'))
+    )
+
+    brand_counts = Counter()
+    category_counts = Counter()
+    min_price = max_price = None
+    for row in rows:
+        brand_counts[row['brand_id']] += row['product_count']
+        category_counts[row['category_id']] += row['product_count']
+        if min_price is None or row['min_price'] < min_price:
+            min_price = row['min_price']
+        if max_price is None or row['max_price'] > max_price:
+            max_price = row['max_price']
+
+    # Дерево активных категорий одним запросом
+    categories = list(Category.objects.filter(is_active=True).order_by('order', 'name'))
+    categories_by_id = {category.id: category for category in categories}
+    for category in categories:
+        category.active_children = []
+        category.own_product_count = category_counts[category.id]
+    main_categories = []
+    for category in categories:
+        if category.parent_id is None:
+            main_categories.append(category)
+        elif category.parent_id in categories_by_id:
+            categories_by_id[category.parent_id].active_children.append(category)
+    for category in main_categories:
+        _subtree_count(category)
+
+    brands = list(Brand.objects.all())
+    for brand in brands:
+        brand.product_count = brand_counts[brand.id]
+
+    return {
+        'min_price': min_price,
+        'max_price': max_price,
+        'brands': brands,
+        'main_categories': main_categories,
+    }
@@ -0,0 +1,153 @@
+"""
+Определение кодировки файлов выгрузки по образцам - общее для команд
+импорта и загрузки в админке.
+
+1. BOM в начале файла определяет кодировку сразу.
+2. chardet смотрит только начало файла (CHARDET_SAMPLE байт); его ответ
+   берется, только если это одна из COMMON_ENCODINGS.
+3. Кандидаты (ответ chardet, затем FALLBACK_ENCODINGS) проверяются строгим
+   декодированием WINDOWS окон по WINDOW_SIZE байт, равномерно разнесенных
+   по файлу: выбирается первый, которым декодируются все окна.
+
+Файл целиком не читается, поэтому время не зависит от размера файла.
+Результат кэшируется (кэш ENCODING_CACHE_ALIAS, общий для процессов сайта,
+воркера и команд) по отпечатку файла - SHA-256 его размера и тех же окон.
+"""
+import codecs
+import hashlib
+import logging
+import os
+
+from django.conf import settings
+from django.core.cache import caches
+
+try:
+    import chardet
+except ImportError:
+    chardet = None
+
+logger = logging.getLogger(__name__)
+
+BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+CHARDET_SAMPLE = 64 * 1024
+WINDOW_SIZE = 16 * 1024
+WINDOWS = 8
+
+# Ответы chardet, которым можно верить для выгрузок 1С, и их каноничные имена
+COMMON_ENCODINGS = {
+    'ascii': 'utf-8',
+    'utf-8': 'utf-8',
+    'utf-8-sig': 'utf-8-sig',
+    'windows-1251': 'cp1251',
+    'cp1251': 'cp1251',
+}
+
+FALLBACK_ENCODINGS = ('utf-8', 'cp1251')
+
+# Кодировки, в которых перевод строки - не один байт b'\n'. Импорт CSV
+# читает файл строками по байтам (и хранит байтовые смещения в контрольных
+# точках), поэтому такие файлы он не принимает
+WIDE_ENCODINGS = ('utf-16', 'utf-32')
+
+CACHE_TIMEOUT = 30 * 24 * 3600
+
+
+def _cache():
+    return caches[getattr(settings, 'ENCODING_CACHE_ALIAS', 'default')]
+
+
+def read_windows(file_path, count=WINDOWS, size=WINDOW_SIZE):
+    """Начало файла (CHARDET_SAMPLE байт) и count окон по size байт, разнесенных по файлу"""
+    with open(file_path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        head = f.read(CHARDET_SAMPLE)
+        windows = [head[:size]]
+        if file_size > size:
+            step = (file_size - size) / max(count - 1, 1)
+            for i in range(1, count):
+                # Четное смещение - окна UTF-16 не начинаются с середины символа
+                f.seek(int(step * i) & ~1)
+                windows.append(f.read(size))
+    return file_size, head, windows
+
+
+def detect_bom(data):
+    for bom, encoding in BOMS:
+        if data.startswith(bom):
+            return encoding
+    return None
+
+
+def decodes(encoding, windows):
+    """
+    Декодируются ли все окна строго. Окно внутри файла может начинаться и
+    кончаться посреди многобайтового символа - такие края не считаются ошибкой
+    """
+    try:
+        codecs.lookup(encoding)
+    except LookupError:
+        return False
+    for i, window in enumerate(windows):
+        if i and encoding.startswith('utf-8'):
+            # Пропускаем продолжение символа, начатого до окна (байты 10xxxxxx)
+            start = 0
+            while start < min(3, len(window)) and 0x80 <= window[start] <= 0xbf:
+                start += 1
+            window = window[start:]
+        decoder = codecs.getincrementaldecoder(encoding)('strict')
+        try:
+            decoder.decode(window, final=False)
+        except UnicodeDecodeError:
+            return False
+    return True
+
+
+def _chardet_guess(head):
+    if chardet is None or not head:
+        return None
+    encoding = (chardet.detect(head).get('encoding') or '').lower()
+    return COMMON_ENCODINGS.get(encoding)
+
+
+def detect_encoding(file_path, default='cp1251'):
+    """Кодировка файла (см. описание модуля); default - если ни один кандидат не подошел"""
+    file_size, head, windows = read_windows(file_path)
+    digest = hashlib.sha256(str(file_size).encode())
+    for window in windows:
+        digest.update(window)
+    key = f'file-encoding:{digest.hexdigest()}'
+    cache = _cache()
+    encoding = cache.get(key)
+    if encoding:
+        return encoding
+
+    encoding = detect_bom(head)
+    if encoding is None:
+        candidates = [_chardet_guess(head), *FALLBACK_ENCODINGS]
+        encoding = next(
+            (candidate for candidate in dict.fromkeys(candidates) if candidate and decodes(candidate, windows)),
+            default,
+        )
+    cache.set(key, encoding, CACHE_TIMEOUT)
+    logger.info(f"Кодировка {file_path}: {encoding}")
+    return encoding
+
+
+def supports_byte_lines(encoding):
+    """Можно ли читать файл в этой кодировке строками по байту b'\\n'"""
+    try:
+        name = codecs.lookup(encoding).name
+    except LookupError:
+        return False
+    return not name.startswith(WIDE_ENCODINGS)
+
+
+def is_decodable(file_path, encoding):
+    """Декодируются ли строго окна файла в этой кодировке (вместо чтения файла целиком)"""
+    _, _, windows = read_windows(file_path)
+    return decodes(encoding, windows)
@@ -0,0 +1,150 @@
+"""
+Полнотекстовый поиск товаров через SQLite FTS5.
+
+Таблица shop_product_fts (rowid = id товара) хранит название, бренд, описание
+и применяемость. Если база не SQLite или FTS5 недоступен, search() возвращает
+None и CatalogView использует обычный поиск через icontains.
+"""
+import logging
+import re
+
+from django.db import connection, OperationalError
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'shop_product_fts'
+
+# Поля товара, от которых зависит содержимое индекса
+INDEXED_FIELDS = ('name', 'brand', 'description', 'applicability')
+
+# Веса колонок для bm25: название, бренд, описание, применяемость
+BM25_WEIGHTS = (10.0, 5.0, 1.0, 2.0)
+
+# ё -> е на стороне индекса (unicode61 их не склеивает)
+_INDEX_SELECT_SQL = (
+    "SELECT p.id, "
+    "REPLACE(REPLACE(p.name, 'ё', 'е'), 'Ё', 'Е'), "
+    "REPLACE(REPLACE(COALESCE(b.name, ''), 'ё', 'е'), 'Ё', 'Е'), "
+    "REPLACE(REPLACE(p.description, 'ё', 'е'), 'Ё', 'Е'), "
+    "REPLACE(REPLACE(p.applicability, 'ё', 'е'), 'Ё', 'Е') "
+    "FROM shop_product p LEFT JOIN shop_brand b ON b.id = p.brand_id"
+)
+
+# Окончания, которые отбрасываются у русских слов перед префиксным поиском
+_RU_ENDINGS = (
+    'ями', 'ами', 'его', 'ого', 'ему', 'ому', 'ыми', 'ими', 'ых', 'их',
+    'ий', 'ый', 'ой', 'ая', 'яя', 'ое', 'ее', 'ие', 'ые', 'ов', 'ев', 'ей',
+    'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ью',
+    'ы', 'и', 'а', 'я', 'о', 'е', 'у', 'ю', 'ь',
+)
+_CYRILLIC_RE = re.compile(r'[а-я]')
+_TOKEN_RE = re.compile(r'\w+')
+
+CHUNK_SIZE = 500
+
+_available = {}
+
+
+def fts_available():
+    """Есть ли в текущей базе таблица FTS5"""
+    if connection.vendor != 'sqlite':
+        return False
+    key = (connection.alias, str(connection.settings_dict.get('NAME')))
+    if key not in _available:
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+                _available[key] = cursor.fetchone() is not None
+        except OperationalError:
+            _available[key] = False
+    return _available[key]
+
+
+def _stem(token):
+    """Упрощенный стемминг: отрезает типичное русское окончание"""
+    if len(token) < 5 or not _CYRILLIC_RE.search(token):
+        return token
+    for ending in _RU_ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= 4:
+            return token[:-len(ending)]
+    return token
+
+
+def build_match_query(search):
+    """Строит выражение MATCH: все слова обязательны, каждое ищется по префиксу"""
+    text = search.lower().replace('ё', 'е')
+    tokens = [_stem(token) for token in _TOKEN_RE.findall(text)]
+    return ' '.join(f'"{token}"*' for token in tokens if token)
+
+
+def search(queryset, search_term):
+    """
+    Фильтрует queryset товаров по полнотекстовому индексу и добавляет
+    поле search_rank (bm25, меньше - лучше). Возвращает None, если FTS5 недоступен.
+    """
+    if not fts_available():
+        return None
+    match_query = build_match_query(search_term)
+    if not match_query:
+        return None
+    weights = ', '.join(str(weight) for weight in BM25_WEIGHTS)
+    return queryset.extra(
+        select={'search_rank': f'bm25({FTS_TABLE}, {weights})'},
+        tables=[FTS_TABLE],
+        where=[f'{FTS_TABLE} MATCH %s', f'{FTS_TABLE}.rowid = shop_product.id'],
+        params=[match_query],
+    )
+
+
+def index_products(values, field='id'):
+    """Переиндексирует товары, отобранные по значениям поля (по умолчанию id)"""
+    if not fts_available():
+        return
+    from .models import Product
+
+    values = [value for value in values if value]
+    for start in range(0, len(values), CHUNK_SIZE):
+        chunk = values[start:start + CHUNK_SIZE]
+        product_ids = list(Product.objects.filter(**{f'{field}__in': chunk}).values_list('id', flat=True))
+        if not product_ids:
+            continue
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", product_ids)
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} (rowid, name, brand, description, applicability) "
+                f"{_INDEX_SELECT_SQL} WHERE p.id IN ({placeholders})",
+                product_ids,
+            )
+
+
+def remove_products(product_ids):
+    """Удаляет товары из индекса"""
+    if not fts_available():
+        return
+    product_ids = [product_id for product_id in product_ids if product_id]
+    with connection.cursor() as cursor:
+        for start in range(0, len(product_ids), CHUNK_SIZE):
+            chunk = product_ids[start:start + CHUNK_SIZE]
+            placeholders = ', '.join(['%s'] * len(chunk))
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", chunk)
+
+
+def clear_index():
+    """Очищает индекс (после массового удаления товаров)"""
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+
+def rebuild_index():
+    """Полная пересборка индекса одним INSERT ... SELECT"""
+    if not fts_available():
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.execute(f"INSERT INTO {FTS_TABLE} (rowid, name, brand, description, applicability) {_INDEX_SELECT_SQL}")
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    logger.info("Полнотекстовый индекс товаров пересобран")
+    return True
@@ -0,0 +1,142 @@
+"""
+Манифест изображений товаров.
+
+Вместо os.path.exists для каждой карточки товара наличие изображения
+проверяется по множеству относительных путей (section_id/tmp_id.jpg),
+загруженному из файла манифеста. Манифест строится сканированием папки
+images командой build_image_manifest (в том числе в режиме --watch), а
+процессы сайта перечитывают его не чаще раза в IMAGE_MANIFEST_RELOAD_INTERVAL
+секунд, если файл изменился.
+
+Если манифеста нет, запрос сайта папку не сканирует: изображений считается
+нет (показывается заглушка), а манифест строится в фоновом потоке.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+_lock = threading.Lock()
+_state = {'paths': None, 'mtime': None, 'checked_at': 0.0, 'building': False}
+
+
+def images_root():
+    return str(getattr(settings, 'IMAGES_ROOT', os.path.join(settings.BASE_DIR, 'images')))
+
+
+def manifest_path():
+    return str(getattr(settings, 'IMAGE_MANIFEST_PATH', os.path.join(settings.BASE_DIR, 'images_manifest.json')))
+
+
+def scan_images(root=None):
+    """Множество относительных путей всех изображений в папке (через os.scandir)"""
+    root = root or images_root()
+    paths = set()
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(root, relative_dir))
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                relative_path = f'{relative_dir}/{entry.name}' if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relative_path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    paths.add(relative_path)
+    return paths
+
+
+def write_manifest(paths):
+    """Атомарно записывает манифест (читатели никогда не видят недописанный файл)"""
+    path = manifest_path()
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(sorted(paths), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def build_manifest():
+    """Сканирует папку изображений, сохраняет манифест и возвращает множество путей"""
+    paths = scan_images()
+    write_manifest(paths)
+    _set_paths(paths, _manifest_mtime())
+    logger.info(f"Манифест изображений построен: {len(paths)} файлов")
+    return paths
+
+
+def build_in_background():
+    """Строит манифест в фоновом потоке, если он еще не строится"""
+    if _state['building']:
+        return
+    _state['building'] = True
+
+    def run():
+        try:
+            build_manifest()
+        except Exception as e:
+            logger.error(f"Ошибка построения манифеста изображений: {str(e)}")
+        finally:
+            _state['building'] = False
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def _manifest_mtime():
+    try:
+        return os.stat(manifest_path()).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _set_paths(paths, mtime):
+    _state['paths'] = frozenset(paths)
+    _state['mtime'] = mtime
+    _state['checked_at'] = time.monotonic()
+
+
+def get_paths():
+    """Текущее множество путей; файл манифеста проверяется не чаще раза в интервал"""
+    interval = getattr(settings, 'IMAGE_MANIFEST_RELOAD_INTERVAL', 60)
+    if _state['paths'] is not None and time.monotonic() - _state['checked_at'] < interval:
+        return _state['paths']
+
+    with _lock:
+        if _state['paths'] is not None and time.monotonic() - _state['checked_at'] < interval:
+            return _state['paths']
+        mtime = _manifest_mtime()
+        if mtime is None:
+            # Манифеста еще нет - до его построения в фоне изображений нет
+            logger.warning("Манифест изображений не найден, строим его в фоне (запустите build_image_manifest)")
+            _set_paths(_state['paths'] or (), None)
+            build_in_background()
+        elif mtime != _state['mtime']:
+            try:
+                with open(manifest_path(), encoding='utf-8') as f:
+                    _set_paths(json.load(f), mtime)
+            except (OSError, ValueError) as e:
+                logger.error(f"Ошибка чтения манифеста изображений: {str(e)}")
+                _set_paths(_state['paths'] or (), mtime)
+        else:
+            _state['checked_at'] = time.monotonic()
+    return _state['paths']
+
+
+def reset():
+    """Забывает загруженный манифест (он будет перечитан при следующем обращении)"""
+    with _lock:
+        _state.update(paths=None, mtime=None, checked_at=0.0)
+
+
+def has_image(relative_path):
+    """Есть ли изображение с путем относительно папки images"""
+    return relative_path in get_paths()
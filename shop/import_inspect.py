@@ -0,0 +1,119 @@
+"""
+Анализ загруженного файла импорта с ограниченной стоимостью.
+
+При загрузке в админке файл не декодируется и не разбирается целиком, а
+анализ выполняется прямо в запросе загрузки (без фоновых потоков в
+процессе сайта):
+
+- DBF - число записей из заголовка (DBFReader);
+- CSV - кодировка по образцам (shop.file_encoding), разделитель и оценка
+  числа строк по образцу из начала файла (SAMPLE_SIZE байт).
+
+Точное число строк (count_csv_rows - подсчет байтов перевода строки в
+файле, отображенном в память) считает команда импорта в процессе воркера и
+записывает его в total_rows вместо оценки.
+"""
+import logging
+import mmap
+import os
+
+from .file_encoding import detect_encoding
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_SIZE = 64 * 1024
+
+# Блок, которым считаются переводы строки в отображенном файле
+COUNT_CHUNK = 16 * 1024 * 1024
+
+DELIMITERS = ('#', ';', ',', '\t')
+
+
+def read_sample(path, size=SAMPLE_SIZE):
+    with open(path, 'rb') as f:
+        return f.read(size)
+
+
+def sniff_delimiter(text, max_lines=20):
+    """
+    Разделитель, который встречается во всех первых строках образца - из
+    них тот, которого в строке меньше всего раз больше остальных
+    """
+    lines = [line for line in text.splitlines()[:max_lines] if line.strip()]
+    # Последняя строка образца может быть оборвана
+    if len(lines) > 1:
+        lines = lines[:-1]
+    best, best_count = '#', 0
+    for delimiter in DELIMITERS:
+        count = min((line.count(delimiter) for line in lines), default=0)
+        if count > best_count:
+            best, best_count = delimiter, count
+    return best
+
+
+def estimate_csv_rows(path, sample):
+    """
+    Оценка числа строк CSV без заголовка по средней длине строки образца
+    (точное число, если образец - весь файл)
+    """
+    size = os.path.getsize(path)
+    if len(sample) == size:
+        lines = sample.count(b'\n') + (1 if sample and not sample.endswith(b'\n') else 0)
+        return max(lines - 1, 0)
+    # Заголовок в среднюю длину строки не входит; последняя строка образца оборвана
+    header_end = sample.find(b'\n') + 1
+    body = sample[header_end:sample.rfind(b'\n') + 1]
+    rows = body.count(b'\n')
+    if not rows:
+        return 0
+    return round(rows * (size - header_end) / len(body))
+
+
+def count_csv_rows(path):
+    """Число строк CSV без заголовка: переводы строки в файле через mmap"""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            lines = sum(data[pos:pos + COUNT_CHUNK].count(b'\n') for pos in range(0, size, COUNT_CHUNK))
+            # Последняя строка без перевода строки тоже считается
+            if data[size - 1:size] != b'\n':
+                lines += 1
+    return max(lines - 1, 0)
+
+
+def inspect_file(path):
+    """
+    Тип файла, число строк/записей (для CSV - оценка, estimated), а для CSV -
+    кодировка и разделитель
+    """
+    if path.lower().endswith('.dbf'):
+        from .dbf_reader import DBFReader
+        return {'type': 'DBF', 'total_rows': len(DBFReader(path)), 'estimated': False}
+    sample = read_sample(path)
+    encoding = detect_encoding(path)
+    return {
+        'type': 'CSV',
+        'total_rows': estimate_csv_rows(path, sample),
+        'estimated': len(sample) < os.path.getsize(path),
+        'encoding': encoding,
+        'delimiter': sniff_delimiter(sample.decode(encoding, errors='ignore')),
+    }
+
+
+def inspect_import_file(import_file_id):
+    """Анализирует файл ImportFile и записывает total_rows (если импорт еще не записал свое)"""
+    from .models import ImportFile
+    import_file = ImportFile.objects.filter(pk=import_file_id).first()
+    if import_file is None:
+        return None
+    try:
+        info = inspect_file(import_file.file.path)
+    except Exception as e:
+        logger.warning(f"Не удалось проанализировать файл импорта #{import_file_id}: {e}")
+        ImportFile.objects.filter(pk=import_file_id).update(error_log=f"Не удалось подсчитать строки/записи: {e}")
+        return None
+    ImportFile.objects.filter(pk=import_file_id, total_rows=0).update(total_rows=info['total_rows'])
+    logger.info(f"Файл импорта #{import_file_id}: {info}")
+    return info
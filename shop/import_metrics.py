@@ -0,0 +1,117 @@
+"""
+Замеры времени импорта.
+
+ImportTimings копит время по этапам импорта (сек) и ряд замеров по пачкам
+[последняя строка, строк в пачке, разбор мс, разрешение мс, запись мс]:
+
+- разбор - время внутри итератора строк (чтение файла и import_transform,
+  в режиме --workers - ожидание результатов пула);
+- запись - сохранение пачки вместе с контрольной точкой;
+- разрешение - остальное время пачки: бренды, категории, сборка товаров.
+
+Этапы после основного цикла (merge, disappeared, analogs, indexes)
+замеряются целиком. Команды импорта сохраняют этапы в
+ImportFile.phase_timings, ряд - в ImportFile.batch_timings. Ряд не длиннее
+IMPORT_TIMING_MAX_BATCHES записей: при переполнении соседние записи
+сливаются попарно, и ряд покрывает весь импорт с меньшей детализацией.
+"""
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+
+# Поля записи ряда batch_timings
+BATCH_FIELDS = ('row', 'rows', 'parse_ms', 'resolve_ms', 'write_ms')
+
+# По скольким последним записям ряда считается текущая скорость
+ROLLING_BATCHES = 5
+
+
+def _ms(seconds):
+    return int(seconds * 1000)
+
+
+def batch_rate(batches):
+    """Строк в секунду по записям ряда batch_timings (0 - если замеров нет)"""
+    rows = sum(batch[1] for batch in batches)
+    elapsed_ms = sum(batch[2] + batch[3] + batch[4] for batch in batches)
+    return rows * 1000 / elapsed_ms if elapsed_ms else 0
+
+
+class ImportTimings:
+    """Время этапов и пачек одного импорта (продолжает сохраненные замеры при resume)"""
+
+    def __init__(self, phases=None, batches=None):
+        self.phases = defaultdict(float, phases or {})
+        self.batches = [list(batch) for batch in batches or []]
+        self.max_batches = getattr(settings, 'IMPORT_TIMING_MAX_BATCHES', 1000)
+        self.reset_batch()
+
+    def reset_batch(self):
+        """Начало новой пачки (и отсчета времени разрешения)"""
+        self.batch_started = time.perf_counter()
+        self.parse_time = self.write_time = 0.0
+
+    def timed_rows(self, rows):
+        """Выдает строки итератора, считая время внутри него разбором"""
+        rows = iter(rows)
+        while True:
+            started = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                self.parse_time += time.perf_counter() - started
+            yield row
+
+    @contextmanager
+    def writing(self):
+        """Запись пачки в базу"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.write_time += time.perf_counter() - started
+
+    @contextmanager
+    def phase(self, name):
+        """Этап импорта, замеряемый целиком"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] += time.perf_counter() - started
+
+    def batch(self, row, rows):
+        """Пачка из rows строк сохранена (row - последняя строка): запись в ряд"""
+        elapsed = time.perf_counter() - self.batch_started
+        resolve_time = max(elapsed - self.parse_time - self.write_time, 0)
+        self.phases['parse'] += self.parse_time
+        self.phases['resolve'] += resolve_time
+        self.phases['write'] += self.write_time
+        self.batches.append([row, rows, _ms(self.parse_time), _ms(resolve_time), _ms(self.write_time)])
+        if len(self.batches) > self.max_batches:
+            self.compact()
+        self.reset_batch()
+
+    def compact(self):
+        """Сливает соседние записи ряда попарно"""
+        merged = []
+        for first, second in zip(self.batches[::2], self.batches[1::2]):
+            merged.append([second[0], *(a + b for a, b in zip(first[1:], second[1:]))])
+        if len(self.batches) % 2:
+            merged.append(self.batches[-1])
+        self.batches = merged
+
+    def rows_per_sec(self):
+        """Текущая скорость по последним пачкам"""
+        return batch_rate(self.batches[-ROLLING_BATCHES:])
+
+    def as_fields(self):
+        """Значения полей ImportFile для сохранения"""
+        return {
+            'phase_timings': {name: round(seconds, 3) for name, seconds in self.phases.items()},
+            'batch_timings': self.batches,
+        }
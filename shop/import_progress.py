@@ -0,0 +1,261 @@
+"""
+Прогресс импорта вне основной базы.
+
+Команда импорта передает счетчики в ImportProgress.update(): они хранятся
+в памяти, не чаще раза в IMPORT_PROGRESS_WRITE_INTERVAL сек атомарно
+записываются в JSON-файл <IMPORT_PROGRESS_DIR>/<id>.json и не чаще раза в
+IMPORT_PROGRESS_FLUSH_INTERVAL сек - в ImportFile. Админка берет свежие
+счетчики из файла (read_progress), так что запись в базу на горячем пути
+импорта не нужна.
+
+Отмена идет тем же каналом: админка создает файл <id>.cancel
+(request_cancel), команда проверяет его наличие (is_cancelled) - это stat
+файла раз в секунду, а не запрос к базе.
+
+Канал файловый, потому что кэш (LocMemCache) у каждого процесса свой, а
+импорт выполняется в процессе воркера, не в процессе сайта.
+
+Кроме счетчиков в файле есть статус и этап импорта (phase): из него
+progress_events() отдает страницу прогресса в админке потоком Server-Sent
+Events - каждый тик это чтение файла, без запросов к базе. Файл прогресса
+остается после окончания импорта с итоговым статусом и удаляется перед
+следующим запуском.
+"""
+import json
+import logging
+import os
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Как часто is_cancelled() смотрит на файл отмены, сек
+CANCEL_CHECK_INTERVAL = 1
+
+# Счетчики, которые flush() переносит в ImportFile (остальное - только в файле)
+COUNTER_FIELDS = ('current_row', 'total_rows', 'processed_rows', 'created_products', 'updated_products', 'error_count')
+
+FINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+# Сглаживание скорости (строк/сек) между соседними отсчетами
+RATE_SMOOTHING = 0.3
+
+
+def _progress_dir():
+    return str(getattr(settings, 'IMPORT_PROGRESS_DIR', os.path.join(settings.BASE_DIR, 'import_progress')))
+
+
+def progress_path(import_file_id):
+    return os.path.join(_progress_dir(), f'{import_file_id}.json')
+
+
+def cancel_path(import_file_id):
+    return os.path.join(_progress_dir(), f'{import_file_id}.cancel')
+
+
+def read_progress(import_file_id):
+    """Последние записанные командой счетчики импорта (словарь) или None"""
+    try:
+        with open(progress_path(import_file_id), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def cancel_requested(import_file_id):
+    """Есть ли запрос отмены импорта (без учета интервала проверки)"""
+    return os.path.exists(cancel_path(import_file_id))
+
+
+def request_cancel(import_file_id):
+    """Просит команду импорта остановиться (она увидит файл при следующей проверке)"""
+    os.makedirs(_progress_dir(), exist_ok=True)
+    with open(cancel_path(import_file_id), 'w'):
+        pass
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def discard(import_file_id):
+    """Удаляет файлы прогресса и отмены импорта (перед новым запуском и после завершения)"""
+    _remove(progress_path(import_file_id))
+    _remove(cancel_path(import_file_id))
+
+
+class ImportProgress:
+    """
+    Канал прогресса одного импорта. Без import_file_id (импорт из консоли
+    без ImportFile) ничего не записывает
+    """
+
+    def __init__(self, import_file_id):
+        self.import_file_id = import_file_id
+        self.write_interval = getattr(settings, 'IMPORT_PROGRESS_WRITE_INTERVAL', 1)
+        self.flush_interval = getattr(settings, 'IMPORT_PROGRESS_FLUSH_INTERVAL', 5)
+        self.values = {}
+        self.pending = False
+        self.written_at = self.flushed_at = self.checked_at = time.monotonic()
+        self.cancelled = False
+
+    def update(self, **values):
+        """Новые значения счетчиков (поля ImportFile); в файл и базу они попадут по интервалам"""
+        if self.import_file_id is None:
+            return
+        self.values.update(values)
+        self.pending = True
+        now = time.monotonic()
+        if now - self.written_at >= self.write_interval:
+            self.write(now)
+        if now - self.flushed_at >= self.flush_interval:
+            self.flush(now)
+
+    def start(self, **values):
+        """Импорт начался: статус processing и начальные значения сразу в файл"""
+        if self.import_file_id is None:
+            return
+        self.values.update(values, status='processing')
+        self.write()
+
+    def set_phase(self, phase):
+        """Этап импорта (rows, merge, analogs...) - пишется в файл сразу"""
+        if self.import_file_id is None:
+            return
+        self.values['phase'] = phase
+        self.write()
+
+    def finish(self, status):
+        """Итоговый статус импорта - страница прогресса по нему понимает, что импорт окончен"""
+        if self.import_file_id is None:
+            return
+        self.values['status'] = status
+        self.write()
+
+    def saved(self, **values):
+        """Счетчики уже записаны в ImportFile (контрольной точкой) - повторно в базу не пишутся"""
+        if self.import_file_id is None:
+            return
+        self.values.update(values)
+        self.pending = False
+        self.flushed_at = time.monotonic()
+        self.write(self.flushed_at)
+
+    def write(self, now=None):
+        """Атомарно записывает счетчики в файл прогресса"""
+        self.written_at = now or time.monotonic()
+        path = progress_path(self.import_file_id)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+                json.dump({**self.values, 'updated_at': time.time()}, f)
+            os.replace(f'{path}.tmp', path)
+        except OSError as e:
+            logger.warning(f"Не удалось записать прогресс импорта #{self.import_file_id}: {e}")
+
+    def flush(self, now=None):
+        """Записывает накопленные счетчики в ImportFile"""
+        from .models import ImportFile
+        self.flushed_at = now or time.monotonic()
+        if self.import_file_id is None or not self.pending:
+            return
+        counters = {field: self.values[field] for field in COUNTER_FIELDS if field in self.values}
+        if counters:
+            ImportFile.objects.filter(id=self.import_file_id).update(**counters)
+        self.pending = False
+
+    def is_cancelled(self):
+        """Отменен ли импорт в админке (файл отмены проверяется не чаще раза в секунду)"""
+        if self.import_file_id is None or self.cancelled:
+            return self.cancelled
+        now = time.monotonic()
+        if now - self.checked_at >= CANCEL_CHECK_INTERVAL:
+            self.checked_at = now
+            self.cancelled = cancel_requested(self.import_file_id)
+        return self.cancelled
+
+    def close(self):
+        """Сбрасывает оставшиеся счетчики в базу и удаляет файл отмены"""
+        if self.import_file_id is None:
+            return
+        self.flush()
+        _remove(cancel_path(self.import_file_id))
+
+
+def _sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def progress_events(import_file_id, initial, poll_interval=1, heartbeat_interval=15, duration=300, sleep=time.sleep):
+    """
+    Поток Server-Sent Events о ходе импорта. initial - состояние из базы на
+    момент подключения (статус и счетчики), дальше каждые poll_interval сек
+    читается только файл прогресса:
+
+    - progress - счетчики, скорость (строк/сек, сглаженная) и ETA (сек)
+      при каждом новом отсчете команды;
+    - phase - смена статуса или этапа импорта;
+    - done - импорт окончен (итоговый статус), поток закрывается;
+    - комментарий-heartbeat, если событий не было heartbeat_interval сек.
+
+    Через duration сек поток закрывается, чтобы не держать поток сервера
+    бесконечно; браузер (EventSource) переподключается сам
+    """
+    state = dict(initial)
+    yield f'retry: {int(poll_interval * 3000)}\n\n'
+    yield _sse('progress', state)
+    if state.get('status') in FINAL_STATUSES:
+        yield _sse('done', {'status': state['status']})
+        return
+
+    rate = None
+    last_sample = last_sent = None
+    seen_file = False
+    waited = since_event = 0
+    while waited < duration:
+        sleep(poll_interval)
+        waited += poll_interval
+        since_event += poll_interval
+
+        values = read_progress(import_file_id)
+        if values is None:
+            if seen_file:
+                # Файл удален - импорт перезапущен или окончен без итога;
+                # страница перечитает состояние из базы
+                yield _sse('done', {'status': None})
+                return
+        elif values.get('updated_at') != last_sent:
+            seen_file = True
+            last_sent = values.get('updated_at')
+            if (values.get('status'), values.get('phase')) != (state.get('status'), state.get('phase')):
+                yield _sse('phase', {'status': values.get('status'), 'phase': values.get('phase')})
+
+            # Скорость считается по отсчетам, в которых продвинулись строки
+            # (смена этапа без новых строк ее не меняет)
+            sample = (values.get('updated_at') or 0, values.get('current_row') or 0)
+            if last_sample is None or sample[1] < last_sample[1]:
+                last_sample = sample
+            elif sample[1] > last_sample[1] and sample[0] > last_sample[0]:
+                current = (sample[1] - last_sample[1]) / (sample[0] - last_sample[0])
+                rate = current if rate is None else RATE_SMOOTHING * current + (1 - RATE_SMOOTHING) * rate
+                last_sample = sample
+
+            state.update(values)
+            total, current_row = state.get('total_rows') or 0, state.get('current_row') or 0
+            state['rows_per_sec'] = round(rate or 0)
+            state['eta_seconds'] = round(max(total - current_row, 0) / rate) if rate and total else None
+            state['progress_percent'] = min(100, int(current_row / total * 100)) if total else 0
+            yield _sse('progress', state)
+            since_event = 0
+
+            if state.get('status') in FINAL_STATUSES:
+                yield _sse('done', {'status': state['status']})
+                return
+
+        if since_event >= heartbeat_interval:
+            yield ': heartbeat\n\n'
+            since_event = 0
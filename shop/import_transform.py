@@ -0,0 +1,238 @@
+"""
+Разбор строк выгрузки 1С без обращения к базе.
+
+Здесь собрана вся построчная работа импорта, не требующая ORM: разбор
+строки CSV/записи DBF, очистка полей, slugify товара, бренда и категории.
+Команды импорта вызывают эти функции сами, а в режиме --workers N - в пуле
+процессов: файл делится на диапазоны (байтовые для CSV, диапазоны записей
+для DBF), каждый диапазон разбирается в отдельном процессе, а результаты в
+исходном порядке возвращаются единственному писателю, который сохраняет
+товары. Модуль не импортирует модели, поэтому годится для spawn-процессов
+без django.setup().
+"""
+import hashlib
+import multiprocessing
+import os
+import string
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.utils.text import slugify
+
+from .dbf_reader import DBFReader
+
+# Размер диапазона, который разбирает один процесс за раз
+CSV_CHUNK_BYTES = 4 * 1024 * 1024
+DBF_CHUNK_RECORDS = 20000
+
+CSV_FIELDS = (
+    'TMP_ID', 'NAME', 'PROPERTY_PRODUCER_ID', 'PROPERTY_TMC_NUMBER', 'PROPERTY_ARTIKYL_NUMBER',
+    'PROPERTY_MODEL_AVTO', 'PROPERTY_CROSS_NUMBER', 'SECTION_ID',
+)
+
+# Колонки DBF, которые читает импорт (в этом порядке DBFReader выдает значения)
+DBF_FIELDS = (
+    'TMP_ID', 'NAME', 'PROPERTY_P', 'PROPERTY_T', 'PROPERTY_A', 'PROPERTY_M', 'PROPERTY_C', 'SECTION_ID',
+)
+
+# Длина поля Product.slug (SlugField по умолчанию)
+PRODUCT_SLUG_LENGTH = 50
+
+# Наибольшая длина ключа TMP_ID в slug; более длинный ключ заменяется хэшем
+SLUG_KEY_LENGTH = 20
+
+_SLUG_SAFE = frozenset(string.ascii_letters + string.digits + '-')
+
+
+def slug_key(tmp_id):
+    """
+    Обратимая запись TMP_ID символами slug: латиница, цифры и '-' как есть,
+    остальные символы (и сам '_') - кодом _<hex>_. Разные TMP_ID дают разные ключи.
+
+    Ключ длиннее SLUG_KEY_LENGTH (длинные и кириллические TMP_ID) заменяется
+    на _h<16 hex blake2b>: обратимый ключ не начинается с '_h' ('h' - не
+    hex-цифра), поэтому с ним хэш не совпадет
+    """
+    key = ''.join(char if char in _SLUG_SAFE else f'_{ord(char):x}_' for char in tmp_id)
+    if len(key) > SLUG_KEY_LENGTH:
+        key = '_h' + hashlib.blake2b(tmp_id.encode('utf-8'), digest_size=8).hexdigest()
+    return key
+
+
+def make_product_slug(name, tmp_id):
+    """
+    Slug товара: <название>--<slug_key(TMP_ID)>. TMP_ID уникален, поэтому
+    уникален и slug - без запросов к базе и без загрузки всех slug. slugify
+    не оставляет '--' внутри и '-' на краях, поэтому такой slug не совпадет
+    ни с другим slug этой схемы, ни со slug, полученным slugify (старые товары)
+    """
+    key = slug_key(tmp_id or 'unknown')
+    name_length = min(30, PRODUCT_SLUG_LENGTH - len(key) - 2)
+    clean_name = slugify(name)[:name_length].strip('-') if name else ''
+    return f"{clean_name or 'product'}--{key}"
+
+
+def brand_slug(producer):
+    return slugify(producer)
+
+
+def category_slug(section_id):
+    return slugify(f"category-{section_id}")
+
+
+def parse_csv_line(line, delimiter='#'):
+    """Парсит строку CSV с учетом специфики формата 1С"""
+    # Удаляем лишние разделители в конце и разбиваем по разделителю
+    fields = line.rstrip(delimiter).strip().split(delimiter)
+    return {name: fields[i].strip() if i < len(fields) else '' for i, name in enumerate(CSV_FIELDS)}
+
+
+def _product_row(tmp_id, name, producer, section_id, catalog_number, cross_number, artikyl_number, applicability):
+    """
+    Поля товара из очищенных значений строки. Строка без TMP_ID - ошибка:
+    TMP_ID - ключ upsert, а ключ по номеру строки после сдвига строк в
+    следующей выгрузке перезаписал бы другой товар
+    """
+    if not tmp_id:
+        raise ValueError('пустой TMP_ID, строка пропущена')
+    return {
+        'tmp_id': tmp_id,
+        'name': name,
+        'producer': producer,
+        'section_id': section_id,
+        'catalog_number': catalog_number,
+        'cross_number': cross_number[:100] if cross_number else '',
+        'artikyl_number': artikyl_number[:100] if artikyl_number else '',
+        'applicability': applicability[:500] if applicability else 'Уточняйте',
+        'slug': make_product_slug(name, tmp_id),
+        'brand_slug': brand_slug(producer) if producer else '',
+        'category_slug': category_slug(section_id) if section_id else '',
+    }
+
+
+def transform_csv_line(line, delimiter='#'):
+    """Строка CSV -> поля товара (None - пустая строка)"""
+    if not line.strip():
+        return None
+    row = parse_csv_line(line, delimiter)
+    # Очищаем SECTION_ID от квадратных скобок и других символов
+    section_id = row['SECTION_ID'].replace('[', '').replace(']', '').replace(';', '').strip()
+    return _product_row(
+        tmp_id=row['TMP_ID'],
+        name=row['NAME'] or 'Недоступно',
+        producer=row['PROPERTY_PRODUCER_ID'],
+        section_id=section_id,
+        catalog_number=row['PROPERTY_TMC_NUMBER'],
+        cross_number=row['PROPERTY_CROSS_NUMBER'],
+        artikyl_number=row['PROPERTY_ARTIKYL_NUMBER'],
+        applicability=row['PROPERTY_MODEL_AVTO'],
+    )
+
+
+def parse_dbf_record(values):
+    """
+    Значения записи DBF (кортеж по DBF_FIELDS от DBFReader) по именам колонок:
+    PROPERTY_P - бренд, PROPERTY_T - каталожный номер, PROPERTY_A - дополнительный
+    номер, PROPERTY_M - применяемость, PROPERTY_C - кросс-код, SECTION_ID - категория
+    """
+    return dict(zip(DBF_FIELDS, values))
+
+
+def transform_dbf_record(values):
+    """Запись DBF -> поля товара"""
+    data = parse_dbf_record(values)
+    return _product_row(
+        tmp_id=data['TMP_ID'],
+        name=data['NAME'] or 'Товар без названия',
+        producer=data['PROPERTY_P'],
+        section_id=data['SECTION_ID'],
+        catalog_number=data['PROPERTY_T'][:50],
+        cross_number=data['PROPERTY_C'],
+        artikyl_number=data['PROPERTY_A'],
+        applicability=data['PROPERTY_M'],
+    )
+
+
+def transform_or_error(transform, value, *args):
+    # Исключение возвращается вместо результата, чтобы одна плохая строка
+    # не прерывала разбор диапазона (и передавалось между процессами)
+    try:
+        return transform(value, *args)
+    except Exception as e:
+        return ValueError(str(e))
+
+
+def transform_csv_chunk(file_path, start, end, encoding, delimiter):
+    """Разбирает строки файла в байтах [start, end): список (смещение конца строки, поля или ошибка)"""
+    results = []
+    with open(file_path, 'rb') as file:
+        file.seek(start)
+        offset = start
+        while offset < end:
+            raw_line = file.readline()
+            if not raw_line:
+                break
+            offset += len(raw_line)
+            try:
+                line = raw_line.decode(encoding)
+            except UnicodeDecodeError as e:
+                results.append((offset, ValueError(str(e))))
+                continue
+            results.append((offset, transform_or_error(transform_csv_line, line, delimiter)))
+    return results
+
+
+def transform_dbf_chunk(file_path, encoding, start, end):
+    """Разбирает записи DBF с физическими номерами [start, end) - удаленные пропускаются"""
+    reader = DBFReader(file_path, encoding, DBF_FIELDS)
+    return [
+        values if isinstance(values, Exception) else transform_or_error(transform_dbf_record, values)
+        for _, values in reader.iter_records(start, end)
+    ]
+
+
+def csv_chunk_ranges(file_path, start, chunk_bytes=CSV_CHUNK_BYTES):
+    """Делит файл от start до конца на диапазоны по границам строк"""
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                file.seek(end)
+                end += len(file.readline())
+            yield start, end
+            start = end
+
+
+def dbf_chunk_ranges(start, total, chunk_records=DBF_CHUNK_RECORDS):
+    """Делит физические записи DBF от start до total на диапазоны"""
+    for chunk_start in range(start, total, chunk_records):
+        yield chunk_start, min(chunk_start + chunk_records, total)
+
+
+def map_chunks(func, chunk_args, workers):
+    """
+    Выполняет func над диапазонами в пуле из workers процессов и выдает
+    результаты в исходном порядке. В работе не больше 2 * workers диапазонов,
+    поэтому память не зависит от размера файла
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        pending = deque()
+        chunk_args = iter(chunk_args)
+        try:
+            for args in chunk_args:
+                pending.append(executor.submit(func, *args))
+                if len(pending) >= workers * 2:
+                    break
+            while pending:
+                result = pending.popleft().result()
+                for args in chunk_args:
+                    pending.append(executor.submit(func, *args))
+                    break
+                yield result
+        finally:
+            # Импорт остановлен раньше конца файла (лимит строк, ошибка) -
+            # еще не начатые диапазоны не разбираются
+            for future in pending:
+                future.cancel()
@@ -1,7 +1,7 @@
 import csv
 import os
 from django.core.management.base import BaseCommand
-import chardet
+from shop.file_encoding import detect_encoding
 import re
 
 
@@ -12,12 +12,9 @@ class Command(BaseCommand):
         parser.add_argument('csv_file', type=str, help='Путь к CSV файлу')
 
     def detect_encoding(self, file_path):
-        """Определяет кодировку файла"""
+        """Определяет кодировку файла по образцам (shop.file_encoding)"""
         try:
-            with open(file_path, 'rb') as file:
-                raw_data = file.read(50000)
-                result = chardet.detect(raw_data)
-                return result['encoding']
+            return detect_encoding(file_path)
         except Exception as e:
             return 'cp1251'
 
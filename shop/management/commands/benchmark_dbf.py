@@ -0,0 +1,67 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from shop.dbf_reader import DBFReader
+from shop.import_transform import DBF_FIELDS
+
+try:
+    from dbfread import DBF
+except ImportError:
+    DBF = None
+
+
+class Command(BaseCommand):
+    help = 'Сравнение скорости чтения DBF: DBFReader (mmap, только колонки импорта) и dbfread'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dbf_file', type=str, help='Путь к DBF файлу')
+        parser.add_argument('--encoding', type=str, default='cp1251', help='Кодировка DBF файла (по умолчанию cp1251)')
+        parser.add_argument('--repeat', type=int, default=3, help='Число прогонов, берется лучший (по умолчанию 3)')
+
+    def read_dbfreader(self, dbf_file, encoding):
+        count = 0
+        for _ in DBFReader(dbf_file, encoding, DBF_FIELDS):
+            count += 1
+        return count
+
+    def read_dbfread(self, dbf_file, encoding):
+        # Так импорт читал файл раньше: все поля записи и str().strip() нужных
+        count = 0
+        for record in DBF(dbf_file, encoding=encoding, load=False):
+            tuple(str(record.get(column, '')).strip() for column in DBF_FIELDS)
+            count += 1
+        return count
+
+    def measure(self, reader, dbf_file, encoding, repeat):
+        best, count = None, 0
+        for _ in range(max(repeat, 1)):
+            started = time.perf_counter()
+            count = reader(dbf_file, encoding)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return count, best
+
+    def handle(self, *args, **options):
+        dbf_file = options['dbf_file']
+        encoding = options['encoding']
+        repeat = options['repeat']
+
+        if not os.path.exists(dbf_file):
+            self.stdout.write(self.style.ERROR(f'🚫 Файл не найден: {dbf_file}'))
+            return
+
+        self.stdout.write(f'📁 {os.path.basename(dbf_file)}: {os.path.getsize(dbf_file) / (1024*1024):.2f} MB, '
+                          f'записей по заголовку: {len(DBFReader(dbf_file, encoding))}')
+
+        results = [('DBFReader', *self.measure(self.read_dbfreader, dbf_file, encoding, repeat))]
+        if DBF:
+            results.append(('dbfread', *self.measure(self.read_dbfread, dbf_file, encoding, repeat)))
+        else:
+            self.stdout.write(self.style.WARNING('⚠️ dbfread не установлен - сравнение только для DBFReader'))
+
+        for name, count, elapsed in results:
+            rate = count / elapsed if elapsed else 0
+            self.stdout.write(f'⏱️ {name}: {count} записей за {elapsed:.3f} с ({rate:,.0f} записей/с)')
+        if len(results) == 2 and results[0][2]:
+            self.stdout.write(self.style.SUCCESS(f'🚀 DBFReader быстрее в {results[1][2] / results[0][2]:.1f} раз'))
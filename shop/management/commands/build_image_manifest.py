@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+from shop import image_manifest
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Построение манифеста изображений товаров (папка images); с --watch следит за изменениями'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--watch', action='store_true', help='Не завершаться, а периодически пересканировать папку')
+        parser.add_argument('--interval', type=int, default=60, help='Интервал пересканирования в режиме --watch, сек (по умолчанию 60)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'📁 Сканируем папку изображений: {image_manifest.images_root()}')
+        paths = image_manifest.build_manifest()
+        self.stdout.write(self.style.SUCCESS(f'✅ Манифест сохранен: {len(paths)} изображений → {image_manifest.manifest_path()}'))
+
+        if not options['watch']:
+            return
+
+        interval = max(options['interval'], 1)
+        self.stdout.write(f'👀 Следим за изменениями (каждые {interval} сек), Ctrl+C для выхода')
+        try:
+            while True:
+                time.sleep(interval)
+                current = image_manifest.scan_images()
+                if current == paths:
+                    continue
+                added = len(current - paths)
+                removed = len(paths - current)
+                image_manifest.write_manifest(current)
+                paths = current
+                self.stdout.write(f'🔄 Манифест обновлен: +{added} / -{removed}, всего {len(paths)}')
+                logger.info(f"Манифест изображений обновлен: добавлено={added}, удалено={removed}, всего={len(paths)}")
+        except KeyboardInterrupt:
+            self.stdout.write('⏹️ Остановлено')
@@ -3,7 +3,7 @@ import os
 from django.core.management.base import BaseCommand
 from django.utils.text import slugify
 from shop.models import Brand
-import chardet
+from shop.file_encoding import detect_encoding, is_decodable
 
 
 class Command(BaseCommand):
@@ -16,26 +16,22 @@ class Command(BaseCommand):
         parser.add_argument('--test-lines', type=int, default=0, help='Ограничить импорт первыми N строками (для тестирования)')
 
     def detect_encoding(self, file_path):
-        """Автоматически определяет кодировку файла"""
+        """Определяет кодировку файла по образцам (shop.file_encoding), не читая его целиком"""
         try:
-            with open(file_path, 'rb') as file:
-                raw_data = file.read()
-                result = chardet.detect(raw_data)
-                detected_encoding = result['encoding']
-                confidence = result['confidence']
-                
-                self.stdout.write(f'Определена кодировка: {detected_encoding} (уверенность: {confidence:.2f})')
-                
-                return detected_encoding
-                    
+            encoding = detect_encoding(file_path)
+            self.stdout.write(f'Определена кодировка: {encoding}')
+            return encoding
         except Exception as e:
             self.stdout.write(f'Ошибка определения кодировки: {e}')
             return 'cp1251'
 
     def try_read_file(self, file_path, encoding):
-        """Проверяет можно ли прочитать файл с данной кодировкой"""
+        """Проверяет можно ли прочитать файл с данной кодировкой (по образцам) и показывает первые строки"""
         try:
-            with open(file_path, 'r', encoding=encoding) as file:
+            if not is_decodable(file_path, encoding):
+                self.stdout.write(f'Ошибка декодирования с {encoding}')
+                return False
+            with open(file_path, 'r', encoding=encoding, errors='replace') as file:
                 for i, line in enumerate(file):
                     if i >= 10:  # Читаем первые 10 строк
                         break
@@ -7,7 +7,12 @@ from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
 from django.db import transaction, OperationalError
 from django.utils.text import slugify
-from shop.models import Product, Category, Brand, ImportFile, OeKod
+from shop.models import Product, Category, Brand, ImportFile, OeKod, ProductNumber
+from shop.analogs import rebuild_analog_groups
+from shop.catalog_cache import bump_catalog_version
+from shop import fts
+from shop.import_transform import make_product_slug
+from shop.import_progress import cancel_requested
 
 
 class Command(BaseCommand):
@@ -52,9 +57,9 @@ class Command(BaseCommand):
     def check_cancellation(self, import_file):
         """Проверяет был ли отменен импорт"""
         if import_file:
-            # Обновляем данные из БД
-            import_file.refresh_from_db()
-            if import_file.cancelled:
+            # Отмена приходит файлом канала прогресса - без запроса к БД
+            if cancel_requested(import_file.id):
+                import_file.cancelled = True
                 self.stdout.write(self.style.WARNING('Импорт отменен пользователем'))
                 import_file.status = 'cancelled'
                 import_file.save()
@@ -167,6 +172,12 @@ class Command(BaseCommand):
                 error_count += result['errors']
                 error_log.extend(result['error_log'])
         
+        # Пересчитываем группы аналогов по всему каталогу
+        if processed_rows:
+            self.stdout.write('Пересчитываем группы аналогов...')
+            rebuild_analog_groups()
+            bump_catalog_version()
+        
         # Финальное обновление статистики импорта
         if import_file:
             if import_file.cancelled:
@@ -246,6 +257,13 @@ class Command(BaseCommand):
                             'name', 'category', 'brand', 'catalog_number', 'artikyl_number', 
                             'cross_number', 'applicability', 'price'
                         ])
+                    
+                    # Обновляем поисковые индексы для товаров пакета
+                    codes = [product.code for product in products_to_create + products_to_update]
+                    Product.update_root_sections(codes, field='code')
+                    ProductNumber.rebuild_for(codes, field='code')
+                    fts.index_products(codes, field='code')
+                    bump_catalog_version()
                 
                 # Если дошли сюда, то транзакция прошла успешно
                 break
@@ -301,11 +319,6 @@ class Command(BaseCommand):
             except (InvalidOperation, ValueError, TypeError):
                 price = Decimal('0')
             
-            # Создание slug
-            slug = slugify(f"{name}-{catalog_number}")
-            if not slug:
-                slug = f"product-{tmp_id}"
-            
             # УСКОРЕНИЕ: Проверяем существование товара
             try:
                 product = Product.objects.get(code=tmp_id)
@@ -325,7 +338,7 @@ class Command(BaseCommand):
                 # Создаем новый товар
                 product = Product(
                     name=name,
-                    slug=self.generate_unique_slug(slug),
+                    slug=make_product_slug(name, tmp_id),  # уникален вместе с TMP_ID - без проверок
                     code=tmp_id,
                     category=category,
                     brand=brand,
@@ -383,25 +396,3 @@ class Command(BaseCommand):
                 )
             self._category_cache[section_id] = category
         return self._category_cache[section_id]
-    
-    def generate_unique_slug(self, base_slug):
-        """Генерирует уникальный slug"""
-        try:
-            if not base_slug:
-                base_slug = 'product'
-            
-            slug = base_slug
-            counter = 1
-            
-            while Product.objects.filter(slug=slug).exists():
-                slug = f"{base_slug}-{counter}"
-                counter += 1
-                # Защита от бесконечного цикла
-                if counter > 1000:
-                    slug = f"{base_slug}-{hash(str(timezone.now()))}"
-                    break
-            
-            return slug
-        except Exception:
-            # В случае любой ошибки возвращаем безопасный slug
-            return f"product-{hash(str(timezone.now()))}" 
\ No newline at end of file
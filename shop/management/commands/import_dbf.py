@@ -1,19 +1,25 @@
 import os
+import time
 from django.core.management.base import BaseCommand
-from django.utils.text import slugify
 from django.db import transaction, connection
-from shop.models import Category, Brand, Product
+from shop.models import Category, Brand, Product, ProductNumber
 from shop.models import ImportFile
+from shop.analogs import rebuild_analog_groups
+from shop.catalog_cache import bump_catalog_version
+from shop.db_tuning import bulk_load_session
+from shop.import_progress import ImportProgress, discard as discard_progress
+from shop.import_metrics import ImportTimings
+from shop.staging import StagingLoader, staging_available
+from shop import fts
+from shop.dbf_reader import DBFReader
+from shop.import_transform import (
+    DBF_FIELDS, dbf_chunk_ranges, make_product_slug, map_chunks, parse_dbf_record, transform_dbf_chunk,
+    transform_dbf_record, transform_or_error,
+)
 from django.utils import timezone
 import logging
 from django.db.models import Q
 from collections import defaultdict
-import re
-
-try:
-    from dbfread import DBF
-except ImportError:
-    DBF = None
 
 logger = logging.getLogger(__name__)
 
@@ -30,36 +36,73 @@ class Command(BaseCommand):
         parser.add_argument('--import-file-id', type=int, default=None, help='ID записи ImportFile для обновления прогресса')
         parser.add_argument('--clear-existing', action='store_true', help='Очистить существующие товары перед импортом')
         parser.add_argument('--test-records', type=int, default=0, help='Ограничить импорт первыми N записями (для тестирования)')
+        parser.add_argument('--diff', action='store_true', help='Режим сравнения: найти товары, пропавшие из выгрузки')
+        parser.add_argument('--mark-disappeared', action='store_true', help='Снять с наличия товары, пропавшие из выгрузки (включает --diff)')
+        parser.add_argument('--resume', action='store_true', help='Продолжить прерванный импорт с контрольной точки ImportFile (нужен --import-file-id)')
+        parser.add_argument('--staging', action='store_true', help='Загрузка через промежуточную таблицу с переносом в каталог одной транзакцией')
+        parser.add_argument('--workers', type=int, default=1, help='Число процессов для разбора записей (по умолчанию 1 - без пула)')
+        parser.add_argument('--bulk-load', action='store_true', help='Массовая загрузка SQLite: прагмы импорта, индексы сортировок товаров строятся в конце')
 
     def count_records_in_dbf(self, dbf_file, encoding='cp1251'):
-        """Подсчитывает количество записей в DBF файле"""
+        """Количество записей в DBF файле по заголовку (включая удаленные)"""
         try:
-            table = DBF(dbf_file, encoding=encoding, load=False)
-            return len(table)
+            return len(DBFReader(dbf_file, encoding))
         except Exception as e:
             logger.error(f"Ошибка подсчета записей в DBF файле: {e}")
             return 0
 
+    def iter_dbf_records(self, table, start_record=0):
+        """
+        Выдает (номер записи, значения колонок DBF_FIELDS). С start_record
+        чтение начинается сразу после этой записи - загруженная часть файла
+        не разбирается (пропуск идет только по флагам удаления)
+        """
+        records = table.iter_records(table.record_index(start_record))
+        for record_num, (_, values) in enumerate(records, start=start_record + 1):
+            yield record_num, values
+
+    def iter_rows(self, table, start_record=0):
+        """Как iter_dbf_records, но записи выдаются уже разобранными (поля товара или исключение)"""
+        for record_num, values in self.iter_dbf_records(table, start_record):
+            if not isinstance(values, Exception):
+                values = transform_or_error(transform_dbf_record, values)
+            yield record_num, values
+
+    def iter_parallel_rows(self, table, encoding, workers, start_record=0):
+        """
+        То же, что iter_rows, но записи разбираются в пуле из workers процессов
+        диапазонами по DBF_CHUNK_RECORDS физических записей. Удаленные записи
+        пропускаются при разборе, номера назначаются по порядку при выдаче
+        """
+        start = table.record_index(start_record)
+        chunks = ((table.filename, encoding, chunk_start, chunk_end) for chunk_start, chunk_end in dbf_chunk_ranges(start, len(table)))
+        record_num = start_record
+        for results in map_chunks(transform_dbf_chunk, chunks, workers):
+            for row in results:
+                record_num += 1
+                yield record_num, row
+
     def parse_dbf_record(self, record):
         """Парсит запись из DBF файла в нужный формат"""
-        return {
-            'TMP_ID': str(record.get('TMP_ID', '')).strip(),
-            'NAME': str(record.get('NAME', '')).strip(),
-            'PROPERTY_P': str(record.get('PROPERTY_P', '')).strip(),  # бренд
-            'PROPERTY_T': str(record.get('PROPERTY_T', '')).strip(),  # каталожный номер
-            'PROPERTY_A': str(record.get('PROPERTY_A', '')).strip(),  # дополнительный номер
-            'PROPERTY_M': str(record.get('PROPERTY_M', '')).strip(),  # применяемость
-            'PROPERTY_C': str(record.get('PROPERTY_C', '')).strip(),  # кросс-код
-            'SECTION_ID': str(record.get('SECTION_ID', '')).strip(),  # категория
-        }
+        return parse_dbf_record(record)
 
-    def handle(self, *args, **options):
-        if not DBF:
-            error_msg = 'Библиотека dbfread не установлена! Выполните: pip install dbfread'
-            self.stdout.write(self.style.ERROR(error_msg))
-            logger.error(error_msg)
-            return
+    def make_product_slug(self, name, tmp_id):
+        """Slug товара из названия и TMP_ID - уникален вместе с TMP_ID, без проверок в базе"""
+        return make_product_slug(name, tmp_id)
 
+    def handle(self, *args, **options):
+        if options.get('bulk_load'):
+            # Вся загрузка - в режиме массовой загрузки SQLite: индексы строятся в конце
+            self.stdout.write('🚚 Режим массовой загрузки: прагмы импорта, индексы товаров строятся в конце')
+            with bulk_load_session():
+                result = self.run_import(*args, **options)
+                indexes_started = time.perf_counter()
+            if options.get('import_file_id'):
+                ImportFile.add_phase_timing(options['import_file_id'], 'indexes', time.perf_counter() - indexes_started)
+            return result
+        return self.run_import(*args, **options)
+
+    def run_import(self, *args, **options):
         dbf_file = options['dbf_file']
         batch_size = options['batch_size']
         skip_rows = options['skip_rows']
@@ -68,7 +111,13 @@ class Command(BaseCommand):
         import_file_id = options.get('import_file_id')
         clear_existing = options.get('clear_existing', False)
         test_records = options.get('test_records', 0)
+        mark_disappeared = options.get('mark_disappeared', False)
+        diff_mode = options.get('diff', False) or mark_disappeared
+        use_staging = options.get('staging', False)
+        workers = max(options.get('workers') or 1, 1)
+        resume = options.get('resume', False)
         import_file = None
+        checkpoint = None
         
         self.stdout.write(f'🔄 Начинаем импорт DBF файла: {dbf_file}')
         logger.info(f"Начинаем импорт DBF файла: {dbf_file}")
@@ -76,16 +125,33 @@ class Command(BaseCommand):
         # Настройка ImportFile для отслеживания прогресса
         if import_file_id:
             import_file = ImportFile.objects.filter(id=import_file_id).first()
-            if import_file:
+            if import_file and resume:
+                if import_file.committed_row and import_file.checkpoint:
+                    checkpoint = import_file.checkpoint
+                    self.stdout.write(f'⏯️ Продолжаем импорт после записи {import_file.committed_row}')
+                else:
+                    self.stdout.write(self.style.WARNING('⚠️ Контрольной точки нет, импорт начнется с начала файла'))
+            if checkpoint is not None:
+                ImportFile.objects.filter(id=import_file.id).update(
+                    status='processing', processed=False, started_at=timezone.now(),
+                )
+            elif import_file:
                 ImportFile.objects.filter(id=import_file.id).update(
                     status='processing',
+                    started_at=timezone.now(),
+                    phase_timings={},
+                    batch_timings=[],
                     error_log='',
                     processed=False,
                     current_row=0,
                     processed_rows=0,
                     created_products=0,
                     updated_products=0,
+                    unchanged_products=0,
+                    removed_products=0,
                     error_count=0,
+                    committed_row=0,
+                    checkpoint={},
                 )
 
         # Проверяем существование файла
@@ -106,45 +172,66 @@ class Command(BaseCommand):
                 ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
             return
 
+        # Хэш файла привязывает контрольные точки к содержимому: продолжить
+        # можно только импорт того же файла
+        if import_file:
+            file_hash = ImportFile.compute_file_hash(dbf_file)
+            if checkpoint is not None and file_hash != import_file.file_hash:
+                error_msg = 'Файл изменился после контрольной точки, продолжить импорт нельзя - запустите его заново'
+                self.stdout.write(self.style.ERROR(error_msg))
+                logger.error(error_msg)
+                ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
+                return
+            ImportFile.objects.filter(id=import_file.id).update(file_hash=file_hash)
+
+        # Счетчики по ходу импорта идут в канал прогресса (файл), в базу - не чаще
+        # раза в несколько секунд; через него же приходит отмена из админки
+        if import_file:
+            discard_progress(import_file.id)
+        self.progress = progress = ImportProgress(import_file.id if import_file else None)
+        # Замеры продолжаются с контрольной точки вместе со счетчиками
+        if checkpoint is not None:
+            self.timings = timings = ImportTimings(import_file.phase_timings, import_file.batch_timings)
+        else:
+            self.timings = timings = ImportTimings()
+
         # Очищаем существующие товары если указан флаг
         if clear_existing:
             self.stdout.write('🗑️ Очищаем существующие товары...')
             deleted_count = Product.objects.count()
             Product.objects.all().delete()
+            fts.clear_index()
+            bump_catalog_version()
             self.stdout.write(f'✅ Удалено {deleted_count} существующих товаров')
             logger.info(f"Удалено {deleted_count} существующих товаров")
             
             # Очищаем кэши
-            existing_tmp_ids = set()
-            existing_codes = set()
             all_categories = {}
             all_brands = {}
         else:
             # Загружаем существующие данные в память для быстрого поиска
             self.stdout.write('📥 Загружаем существующие данные в память...')
             
-            existing_tmp_ids = set(Product.objects.values_list('tmp_id', flat=True))
-            existing_codes = set(Product.objects.values_list('slug', flat=True))
             all_categories = {cat.slug: cat for cat in Category.objects.all()}
             all_brands = {brand.slug: brand for brand in Brand.objects.all()}
             
             self.stdout.write(f'📊 Загружено:')
-            self.stdout.write(f'   • {len(existing_tmp_ids)} товаров по TMP_ID')
-            self.stdout.write(f'   • {len(existing_codes)} товаров по slug')
             self.stdout.write(f'   • {len(all_categories)} категорий')
             self.stdout.write(f'   • {len(all_brands)} брендов')
             
-            logger.info(f"Загружено данных: товары={len(existing_tmp_ids)}, категории={len(all_categories)}, бренды={len(all_brands)}")
+            logger.info(f"Загружено данных: категории={len(all_categories)}, бренды={len(all_brands)}")
 
         # Пытаемся открыть DBF файл
         try:
-            table = DBF(dbf_file, encoding=encoding)
+            table = DBFReader(dbf_file, encoding, DBF_FIELDS)
+            # Число записей из заголовка: файл не читается целиком
             total_records = len(table)
             self.stdout.write(f'📋 Всего записей в DBF файле: {total_records}')
             logger.info(f"Всего записей в DBF файле: {total_records}")
             
             if import_file:
                 ImportFile.objects.filter(id=import_file.id).update(total_rows=total_records)
+            progress.start(total_rows=total_records, phase='rows')
                 
         except Exception as e:
             error_msg = f'Ошибка открытия DBF файла: {str(e)}'
@@ -152,82 +239,135 @@ class Command(BaseCommand):
             logger.error(error_msg)
             if import_file:
                 ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
+                progress.finish('failed')
             return
 
         # Инициализируем переменные
         categories_cache = {}
         brands_cache = {}
         stats = defaultdict(int)
+        
+        # В режиме сравнения запоминаем все TMP_ID выгрузки, чтобы найти пропавшие товары.
+        # При частичном импорте (пропуск/лимит строк) пропавшие не определяются
+        seen_tmp_ids = None
+        if diff_mode:
+            if skip_rows or test_records or checkpoint is not None:
+                self.stdout.write(self.style.WARNING('Режим сравнения отключен: импортируется только часть файла'))
+                mark_disappeared = False
+            else:
+                seen_tmp_ids = set()
+        
         processed_records = 0
         errors = 0
         products_batch = []
-
-        # Выводим структуру первой записи для отладки
-        try:
-            first_record = next(iter(table))
-            self.stdout.write('🔍 Структура DBF файла:')
-            for key, value in first_record.items():
-                self.stdout.write(f'   {key}: {value} ({type(value).__name__})')
-            logger.info(f"Структура DBF: {list(first_record.keys())}")
-        except Exception as e:
-            self.stdout.write(f'⚠️ Не удалось прочитать первую запись: {e}')
+        start_record = 0
+        if checkpoint is not None:
+            # Счетчики продолжаются с контрольной точки
+            start_record = import_file.committed_row
+            processed_records = checkpoint.get('processed_rows', 0)
+            errors = checkpoint.get('errors', 0)
+            stats.update(checkpoint.get('stats', {}))
+
+        # Выводим структуру DBF файла для отладки (из заголовка, записи не читаются)
+        self.stdout.write('🔍 Структура DBF файла:')
+        for field in table.fields:
+            self.stdout.write(f'   {field.name}: {field.type}({field.length})')
+        logger.info(f"Структура DBF: {[field.name for field in table.fields]}")
+        if table.missing_columns:
+            self.stdout.write(self.style.WARNING(f'⚠️ В файле нет колонок: {", ".join(table.missing_columns)}'))
+            logger.warning(f"В DBF файле нет колонок: {table.missing_columns}")
+
+        # В режиме staging записи копятся во временной таблице, а бренды,
+        # категории и slug разрешаются при переносе в каталог
+        loader = None
+        if use_staging:
+            if staging_available():
+                loader = StagingLoader(batch_size=batch_size)
+                loader.create()
+                self.stdout.write('🧱 Загрузка через staging-таблицу')
+            else:
+                self.stdout.write(self.style.WARNING('⚠️ Staging-загрузка доступна только для SQLite, используем обычный импорт'))
 
         try:
             if not disable_transactions:
                 connection.autocommit = False
 
-            # Основной цикл обработки записей
-            for record_num, record in enumerate(table, start=1):
+            # Основной цикл обработки записей (last_record - последняя обработанная)
+            # Пропускаемые записи не разбираются: чтение начинается после них
+            start_record = max(start_record, skip_rows)
+            if workers > 1:
+                rows = self.iter_parallel_rows(table, encoding, workers, start_record)
+            else:
+                rows = self.iter_rows(table, start_record)
+            rows = timings.timed_rows(rows)
+            timings.reset_batch()
+            last_record = start_record
+            cancelled = False
+            for record_num, row in rows:
+                if progress.is_cancelled():
+                    cancelled = True
+                    break
                 try:
-                    # Пропускаем уже обработанные записи
-                    if record_num <= skip_rows:
-                        continue
-                        
                     # Ограничиваем количество записей для тестирования
                     if test_records > 0 and record_num > test_records:
                         self.stdout.write(f'🔬 Достигнут лимит тестовых записей: {test_records}')
                         break
+                    last_record = record_num
 
-                    # Парсим данные из DBF записи
-                    data = self.parse_dbf_record(record)
+                    # Запись уже разобрана (import_transform) - здесь только то, что требует базы
+                    if isinstance(row, Exception):
+                        raise row
                     
-                    tmp_id = data.get('TMP_ID', '').strip()
-                    name = data.get('NAME', '').strip()
-                    producer = data.get('PROPERTY_P', '').strip()  # бренд
-                    catalog_number = data.get('PROPERTY_T', '').strip()  # каталожный номер
-                    artikyl_number = data.get('PROPERTY_A', '').strip()  # дополнительный номер
-                    applicability = data.get('PROPERTY_M', '').strip()  # применяемость
-                    cross_number = data.get('PROPERTY_C', '').strip()  # кросс-код
-                    section_id = data.get('SECTION_ID', '').strip()  # категория
+                    tmp_id = row['tmp_id']
+                    name = row['name']
+                    producer = row['producer']  # бренд
+                    section_id = row['section_id']  # категория
 
                     # Логируем первые записи для отладки
                     if record_num <= 5:
                         logger.info(f"Запись {record_num}: TMP_ID={tmp_id}, NAME={name}, PRODUCER={producer}, SECTION={section_id}")
                         self.stdout.write(f"🔍 Запись {record_num}: TMP_ID={tmp_id}, NAME={name[:30]}...")
 
-                    # Обрабатываем критичные пустые поля
-                    if not tmp_id:
-                        tmp_id = f"auto-{record_num}"
-                        logger.warning(f"Запись {record_num}: Пустой TMP_ID, установлен '{tmp_id}'")
-                        
-                    if not name:
-                        name = "Товар без названия"
-                        logger.warning(f"Запись {record_num}: Пустое название, установлено '{name}'")
-
-                    # Обрабатываем дубликаты по TMP_ID
-                    original_tmp_id = tmp_id
-                    counter = 1
-                    while tmp_id in existing_tmp_ids:
-                        tmp_id = f"{original_tmp_id}-dup{counter}"
-                        counter += 1
-                        
-                    if tmp_id != original_tmp_id:
-                        logger.warning(f"Запись {record_num}: Дубликат TMP_ID '{original_tmp_id}', изменен на '{tmp_id}'")
+                    # Записи без TMP_ID отсеяны при разборе как ошибки
+                    if seen_tmp_ids is not None:
+                        seen_tmp_ids.add(tmp_id)
+
+                    # Существующий товар с тем же TMP_ID обновляется при сохранении пачки (upsert)
+
+                    if loader is not None:
+                        if not producer or not section_id:
+                            raise ValueError(f'товар {tmp_id} без производителя или категории')
+                        loader.add(
+                            record_num,
+                            tmp_id=tmp_id,
+                            name=name[:200],
+                            slug=row['slug'],
+                            producer=producer,
+                            section_id=section_id,
+                            code=tmp_id,
+                            catalog_number=row['catalog_number'] or tmp_id,
+                            cross_number=row['cross_number'],
+                            artikyl_number=row['artikyl_number'],
+                            applicability=row['applicability'],
+                            in_stock=True,
+                        )
+                        processed_records += 1
+                        if processed_records % 1000 == 0:
+                            self.stdout.write(f'⏳ Прогресс: {processed_records / total_records * 100:.1f}% ({processed_records}/{total_records}) | Загружено в staging')
+                            progress.update(
+                                current_row=processed_records,
+                                processed_rows=processed_records,
+                                error_count=errors,
+                            )
+                        if not loader.rows:
+                            # Пачка только что записана в staging-таблицу
+                            timings.batch(record_num, loader.batch_size)
+                        continue
 
                     # Создаем/получаем бренд
                     brand = None
                     if producer:
-                        brand_slug = slugify(producer)
+                        brand_slug = row['brand_slug']
                         if brand_slug in all_brands:
                             brand = all_brands[brand_slug]
                         elif brand_slug not in brands_cache:
@@ -250,7 +390,7 @@ class Command(BaseCommand):
                     # Создаем/получаем категорию
                     category = None
                     if section_id:
-                        category_slug = slugify(f"category-{section_id}")
+                        category_slug = row['category_slug']
                         if category_slug in all_categories:
                             category = all_categories[category_slug]
                         elif category_slug not in categories_cache:
@@ -270,71 +410,55 @@ class Command(BaseCommand):
                         else:
                             category = categories_cache[category_slug]
 
-                    # Создаем безопасный slug для товара
-                    clean_name = slugify(name)[:30] if name else 'product'
-                    clean_tmp_id = re.sub(r'[^a-zA-Z0-9]', '', tmp_id) if tmp_id else 'unknown'
-                    base_slug = f"{clean_name}-{clean_tmp_id}"
-                    slug = slugify(base_slug)
-                    
-                    if not slug:
-                        slug = f"product-{clean_tmp_id}"
-                    
-                    # Проверяем уникальность slug
-                    counter = 1
-                    original_slug = slug
-                    while slug in existing_codes:
-                        slug = f"{original_slug}-{counter}"
-                        counter += 1
+                    # Бренд и категория обязательны - без них товар не сохранится,
+                    # поэтому такая строка считается ошибочной, а не валит всю пачку
+                    if brand is None or category is None:
+                        raise ValueError(f'товар {tmp_id} без производителя или категории')
                     
-                    existing_codes.add(slug)
-                    existing_tmp_ids.add(tmp_id)
 
                     # Создаем товар
                     product = Product(
                         tmp_id=tmp_id,
                         name=name[:200], 
-                        slug=slug,
+                        slug=row['slug'],  # уникален вместе с TMP_ID - без проверок
                         category=category,
                         brand=brand,
                         code=tmp_id,
-                        catalog_number=catalog_number[:50] if catalog_number else tmp_id,
-                        cross_number=cross_number[:100] if cross_number else '',
-                        artikyl_number=artikyl_number[:100] if artikyl_number else '',
-                        applicability=applicability[:500] if applicability else 'Уточняйте',
+                        catalog_number=row['catalog_number'] or tmp_id,
+                        cross_number=row['cross_number'],
+                        artikyl_number=row['artikyl_number'],
+                        applicability=row['applicability'],
                         price=0,  # Цена будет обновляться отдельно
                         in_stock=True,
                         is_new=True,
                     )
 
                     products_batch.append(product)
-                    stats['new_products'] += 1
                     processed_records += 1
 
                     # Логируем прогресс
                     if processed_records % 1000 == 0:
-                        progress = (processed_records / total_records) * 100
-                        self.stdout.write(f'⏳ Прогресс: {progress:.1f}% ({processed_records}/{total_records}) | Создано товаров: {stats["new_products"]}')
-                        logger.info(f"Прогресс: {progress:.1f}%, создано товаров: {stats['new_products']}")
+                        percent = (processed_records / total_records) * 100
+                        self.stdout.write(f'⏳ Прогресс: {percent:.1f}% ({processed_records}/{total_records}) | Создано товаров: {stats["new_products"]}')
+                        logger.info(f"Прогресс: {percent:.1f}%, создано товаров: {stats['new_products']}")
                         
-                        if import_file:
-                            ImportFile.objects.filter(id=import_file.id).update(
-                                current_row=processed_records,
-                                processed_rows=processed_records,
-                                created_products=stats['new_products'],
-                                error_count=errors,
-                            )
-
-                    # Сохраняем пачку товаров
+                        progress.update(
+                            current_row=processed_records,
+                            processed_rows=processed_records,
+                            created_products=stats['new_products'],
+                            updated_products=stats['updated_products'],
+                            error_count=errors,
+                        )
+
+                    # Сохраняем пачку товаров вместе с контрольной точкой
                     if len(products_batch) >= batch_size:
-                        self._save_products_batch(products_batch)
+                        with timings.writing(), transaction.atomic():
+                            self._save_products_batch(products_batch, stats)
+                            if import_file:
+                                self._save_checkpoint(import_file, record_num, processed_records, errors, stats)
+                        timings.batch(record_num, len(products_batch))
                         logger.info(f"Сохранена пачка товаров: {len(products_batch)}")
                         products_batch = []
-                        
-                        if import_file:
-                            ImportFile.objects.filter(id=import_file.id).update(
-                                processed_rows=processed_records,
-                                created_products=stats['new_products']
-                            )
 
                 except Exception as e:
                     errors += 1
@@ -343,15 +467,55 @@ class Command(BaseCommand):
                         self.stdout.write(self.style.ERROR(error_msg))
                         logger.error(f"Ошибка в записи {record_num}: {str(e)}")
                     
-                    if import_file:
-                        ImportFile.objects.filter(id=import_file.id).update(error_count=errors)
+                    progress.update(error_count=errors)
                     continue
 
+            if cancelled:
+                # Несохраненная пачка отбрасывается: импорт продолжается с контрольной точки
+                self.stdout.write(self.style.WARNING(f'⏹️ Импорт отменен пользователем после записи {last_record}'))
+                logger.info(f"Импорт DBF отменен пользователем, последняя обработанная запись: {last_record}")
+                if loader is not None:
+                    loader.drop()
+                if not disable_transactions:
+                    connection.autocommit = True
+                if import_file:
+                    ImportFile.objects.filter(id=import_file.id, cancelled=False).update(
+                        status='cancelled', cancelled=True, cancelled_at=timezone.now(),
+                    )
+                    ImportFile.objects.filter(id=import_file.id).update(**timings.as_fields())
+                progress.finish('cancelled')
+                return
+
             # Сохраняем оставшиеся товары
             if products_batch:
-                self._save_products_batch(products_batch)
+                with timings.writing(), transaction.atomic():
+                    self._save_products_batch(products_batch, stats)
+                    if import_file:
+                        self._save_checkpoint(import_file, last_record, processed_records, errors, stats)
+                timings.batch(last_record, len(products_batch))
                 logger.info(f"Сохранена финальная пачка товаров: {len(products_batch)}")
 
+            if loader is not None:
+                progress.set_phase('merge')
+                with timings.phase('merge'):
+                    errors += self._merge_staging(loader, stats)
+
+            if seen_tmp_ids is not None:
+                progress.set_phase('disappeared')
+                with timings.phase('disappeared'):
+                    self._process_disappeared(seen_tmp_ids, mark_disappeared, stats)
+            
+            # Пересчитываем группы аналогов по всему каталогу
+            self.stdout.write('🔗 Пересчитываем группы аналогов...')
+            progress.set_phase('analogs')
+            try:
+                with timings.phase('analogs'):
+                    changed_groups = rebuild_analog_groups()
+                bump_catalog_version()
+                self.stdout.write(f'🔗 Группы аналогов обновлены у {changed_groups} товаров')
+            except Exception as e:
+                logger.error(f"Ошибка пересчета групп аналогов: {str(e)}")
+
             if not disable_transactions:
                 connection.autocommit = True
 
@@ -362,6 +526,9 @@ class Command(BaseCommand):
                 f'📁 Создано категорий: {stats["new_categories"]}\n'
                 f'🏭 Создано брендов: {stats["new_brands"]}\n'
                 f'📦 Создано товаров: {stats["new_products"]}\n'
+                f'🔄 Обновлено товаров: {stats["updated_products"]}\n'
+                f'💤 Без изменений: {stats["unchanged_products"]}\n'
+                f'👻 Пропало из выгрузки: {stats["removed_products"]}\n'
                 f'⚠️ Ошибок: {errors}'
             )
 
@@ -372,6 +539,9 @@ class Command(BaseCommand):
                 f'Создано категорий: {stats["new_categories"]}, '
                 f'Создано брендов: {stats["new_brands"]}, '
                 f'Создано товаров: {stats["new_products"]}, '
+                f'Обновлено товаров: {stats["updated_products"]}, '
+                f'Без изменений: {stats["unchanged_products"]}, '
+                f'Пропало из выгрузки: {stats["removed_products"]}, '
                 f'Ошибок: {errors}'
             )
 
@@ -386,8 +556,14 @@ class Command(BaseCommand):
                     current_row=processed_records,
                     processed_rows=processed_records,
                     created_products=stats['new_products'],
+                    updated_products=stats['updated_products'],
+                    unchanged_products=stats['unchanged_products'],
+                    removed_products=stats['removed_products'],
                     error_count=errors,
+                    **timings.as_fields(),
                 )
+                progress.saved()
+            progress.finish('completed')
 
         except Exception as e:
             error_msg = f'Критическая ошибка импорта DBF: {str(e)}'
@@ -398,22 +574,79 @@ class Command(BaseCommand):
                 connection.autocommit = True
                 
             if import_file:
-                ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
-
-    def _save_products_batch(self, products_batch):
-        """Сохраняет пачку товаров в базу данных"""
+                ImportFile.objects.filter(id=import_file.id).update(
+                    status='failed', error_log=error_msg, **timings.as_fields(),
+                )
+                progress.finish('failed')
+        finally:
+            progress.close()
+
+    def _process_disappeared(self, seen_tmp_ids, mark_out_of_stock, stats):
+        """Товары, которых нет в выгрузке: считаются и (по флагу) снимаются с наличия"""
+        disappeared = Product.find_disappeared(seen_tmp_ids, mark_out_of_stock=mark_out_of_stock)
+        stats['removed_products'] = len(disappeared)
+        if disappeared and mark_out_of_stock:
+            bump_catalog_version()
+            self.stdout.write(f'👻 Снято с наличия товаров, пропавших из выгрузки: {len(disappeared)}')
+        else:
+            self.stdout.write(f'👻 Товаров, пропавших из выгрузки: {len(disappeared)}')
+        logger.info(f"Пропало из выгрузки: {len(disappeared)}, снято с наличия: {mark_out_of_stock}")
+
+    def _save_checkpoint(self, import_file, record_num, processed_records, errors, stats):
+        """Контрольная точка после сохраненной пачки: номер записи и счетчики"""
+        ImportFile.objects.filter(id=import_file.id).update(
+            committed_row=record_num,
+            checkpoint={
+                'processed_rows': processed_records,
+                'errors': errors,
+                'stats': dict(stats),
+            },
+            current_row=record_num,
+            processed_rows=processed_records,
+            created_products=stats['new_products'],
+            updated_products=stats['updated_products'],
+            unchanged_products=stats['unchanged_products'],
+            error_count=errors,
+            **self.timings.as_fields(),
+        )
+        self.progress.saved(
+            current_row=record_num,
+            processed_rows=processed_records,
+            created_products=stats['new_products'],
+            updated_products=stats['updated_products'],
+            error_count=errors,
+        )
+
+    def _merge_staging(self, loader, stats):
+        """Переносит записи из staging-таблицы в каталог одной транзакцией; возвращает число ошибочных записей"""
+        self.stdout.write(f'🧱 Переносим в каталог {loader.loaded + len(loader.rows)} записей из staging-таблицы...')
+        try:
+            result = loader.merge()
+        finally:
+            loader.drop()
+        changed_tmp_ids = result.pop('changed_tmp_ids')
+        unresolved = result.pop('unresolved_rows')
+        for key, value in result.items():
+            stats[key] += value
+        if changed_tmp_ids:
+            bump_catalog_version()
+        self.stdout.write(f'💾 Перенесено: создано {result["new_products"]}, обновлено {result["updated_products"]}, без изменений {result["unchanged_products"]}')
+        # Строки без категории не перенесены - это ошибки строк
+        for line_num, tmp_id in unresolved[:10]:
+            self.stdout.write(self.style.ERROR(f'Ошибка в записи {line_num}: не найдена категория товара {tmp_id}'))
+        if unresolved:
+            logger.error(f"Не перенесено записей без категории: {len(unresolved)}")
+        return len(unresolved)
+
+    def _save_products_batch(self, products_batch, stats):
+        """Сохраняет пачку товаров: новые создаются, изменившиеся обновляются по TMP_ID"""
+        created, updated, unchanged = [], [], []
         try:
             logger.info(f"Попытка сохранения пачки из {len(products_batch)} товаров")
+            created, updated, unchanged = Product.upsert_by_tmp_id(products_batch)
             
-            created_products = Product.objects.bulk_create(products_batch, ignore_conflicts=True)
-            actual_count = len(created_products)
-            
-            logger.info(f"Фактически создано товаров: {actual_count} из {len(products_batch)}")
-            
-            if actual_count < len(products_batch):
-                logger.warning(f"Пропущено товаров из-за конфликтов: {len(products_batch) - actual_count}")
-            
-            self.stdout.write(f'💾 Сохранена пачка из {len(products_batch)} товаров')
+            logger.info(f"Сохранена пачка: создано={len(created)}, обновлено={len(updated)}, без изменений={len(unchanged)}")
+            self.stdout.write(f'💾 Сохранена пачка из {len(products_batch)} товаров: создано {len(created)}, обновлено {len(updated)}, без изменений {len(unchanged)}')
             
         except Exception as e:
             error_msg = f'Ошибка сохранения пачки товаров: {str(e)}'
@@ -423,7 +656,26 @@ class Command(BaseCommand):
             # Пытаемся сохранить по одному товару
             for product in products_batch:
                 try:
-                    product.save()
+                    product_created, product_updated, product_unchanged = Product.upsert_by_tmp_id([product])
+                    created += product_created
+                    updated += product_updated
+                    unchanged += product_unchanged
                     logger.info(f"Товар {product.tmp_id} сохранен по одному")
                 except Exception as single_error:
                     logger.error(f"Не удалось сохранить товар {product.tmp_id}: {str(single_error)}")
+        
+        stats['new_products'] += len(created)
+        stats['updated_products'] += len(updated)
+        stats['unchanged_products'] += len(unchanged)
+        
+        # Обновляем поисковые индексы только для созданных и измененных товаров
+        changed_tmp_ids = created + updated
+        if not changed_tmp_ids:
+            return
+        try:
+            Product.update_root_sections(changed_tmp_ids, field='tmp_id')
+            ProductNumber.rebuild_for(changed_tmp_ids, field='tmp_id')
+            fts.index_products(changed_tmp_ids, field='tmp_id')
+            bump_catalog_version()
+        except Exception as e:
+            logger.error(f"Ошибка обновления поисковых индексов: {str(e)}")
@@ -3,7 +3,10 @@ import os
 from django.core.management.base import BaseCommand
 from django.utils.text import slugify
 from django.db import transaction
-from shop.models import Category, Brand, Product
+from shop.models import Category, Brand, Product, ProductNumber
+from shop.analogs import rebuild_analog_groups
+from shop.catalog_cache import bump_catalog_version
+from shop import fts
 
 
 class Command(BaseCommand):
@@ -129,6 +132,10 @@ class Command(BaseCommand):
                     if len(products_batch) >= batch_size:
                         with transaction.atomic():
                             Product.objects.bulk_create(products_batch, ignore_conflicts=True)
+                            Product.update_root_sections([product.code for product in products_batch], field='code')
+                            ProductNumber.rebuild_for([product.code for product in products_batch], field='code')
+                            fts.index_products([product.code for product in products_batch], field='code')
+                            bump_catalog_version()
                         created_products += len(products_batch)
                         self.stdout.write(f'Обработано {created_products} товаров... (строка {row_num})')
                         products_batch = []
@@ -144,8 +151,18 @@ class Command(BaseCommand):
         if products_batch:
             with transaction.atomic():
                 Product.objects.bulk_create(products_batch, ignore_conflicts=True)
+                Product.update_root_sections([product.code for product in products_batch], field='code')
+                ProductNumber.rebuild_for([product.code for product in products_batch], field='code')
+                fts.index_products([product.code for product in products_batch], field='code')
+                bump_catalog_version()
             created_products += len(products_batch)
         
+        # Пересчитываем группы аналогов по всему каталогу
+        if created_products:
+            self.stdout.write('Пересчитываем группы аналогов...')
+            rebuild_analog_groups()
+            bump_catalog_version()
+        
         # Статистика
         self.stdout.write(self.style.SUCCESS('=== ИМПОРТ ЗАВЕРШЕН ==='))
         self.stdout.write(f'Обработано строк: {processed_rows}')
@@ -1,16 +1,25 @@
-import csv
 import os
+import time
 from django.core.management.base import BaseCommand
-from django.utils.text import slugify
 from django.db import transaction, connection
-from shop.models import Category, Brand, Product
+from shop.models import Category, Brand, Product, ProductNumber
 from shop.models import ImportFile
+from shop.analogs import rebuild_analog_groups
+from shop.catalog_cache import bump_catalog_version
+from shop.db_tuning import bulk_load_session
+from shop.import_progress import ImportProgress, discard as discard_progress
+from shop.import_metrics import ImportTimings
+from shop.import_inspect import count_csv_rows
+from shop.file_encoding import detect_encoding, is_decodable, supports_byte_lines
+from shop.staging import StagingLoader, staging_available
+from shop import fts
+from shop.import_transform import (
+    transform_or_error, csv_chunk_ranges, make_product_slug, map_chunks, parse_csv_line,
+    transform_csv_chunk, transform_csv_line,
+)
 from django.utils import timezone
 import logging
-from django.db.models import Q
 from collections import defaultdict
-import chardet
-import re
 
 logger = logging.getLogger(__name__)
 
@@ -28,77 +37,131 @@ class Command(BaseCommand):
         parser.add_argument('--import-file-id', type=int, default=None, help='ID записи ImportFile для обновления прогресса')
         parser.add_argument('--clear-existing', action='store_true', help='Очистить существующие товары перед импортом')
         parser.add_argument('--test-lines', type=int, default=0, help='Ограничить импорт первыми N строками (для тестирования)')
+        parser.add_argument('--diff', action='store_true', help='Режим сравнения: найти товары, пропавшие из выгрузки')
+        parser.add_argument('--mark-disappeared', action='store_true', help='Снять с наличия товары, пропавшие из выгрузки (включает --diff)')
+        parser.add_argument('--resume', action='store_true', help='Продолжить прерванный импорт с контрольной точки ImportFile (нужен --import-file-id)')
+        parser.add_argument('--staging', action='store_true', help='Загрузка через промежуточную таблицу с переносом в каталог одной транзакцией')
+        parser.add_argument('--workers', type=int, default=1, help='Число процессов для разбора строк (по умолчанию 1 - без пула)')
+        parser.add_argument('--bulk-load', action='store_true', help='Массовая загрузка SQLite: прагмы импорта, индексы сортировок товаров строятся в конце')
 
     def detect_encoding(self, file_path):
-        """Автоматически определяет кодировку файла"""
+        """Определяет кодировку файла по образцам (shop.file_encoding)"""
         try:
-            with open(file_path, 'rb') as file:
-                raw_data = file.read(10000)  # Читаем первые 10KB для определения кодировки
-                result = chardet.detect(raw_data)
-                detected_encoding = result['encoding']
-                confidence = result['confidence']
-                
-                self.stdout.write(f'Определена кодировка: {detected_encoding} (уверенность: {confidence:.2f})')
-                
-                # Популярные кодировки для русских файлов
-                common_encodings = ['utf-8', 'cp1251', 'windows-1251', 'iso-8859-1']
-                
-                if detected_encoding and detected_encoding.lower() in common_encodings:
-                    return detected_encoding
-                else:
-                    self.stdout.write('Пробуем популярные кодировки...')
-                    return 'cp1251' 
-                    
+            encoding = detect_encoding(file_path)
+            self.stdout.write(f'Определена кодировка: {encoding}')
+            return encoding
         except Exception as e:
             self.stdout.write(f'Ошибка определения кодировки: {e}')
             return 'cp1251'
 
     def try_read_file(self, file_path, encoding):
+        """Декодируются ли образцы файла в этой кодировке (файл целиком не читается)"""
         try:
-            with open(file_path, 'r', encoding=encoding) as file:
-                for i, line in enumerate(file):
-                    if i >= 5: 
-                        break
-                return True
-        except UnicodeDecodeError:
-            return False
+            return is_decodable(file_path, encoding)
         except Exception:
             return False
 
     def parse_csv_line(self, line, delimiter='#'):
         """Парсит строку CSV с учетом специфики формата 1С"""
-        # Удаляем лишние разделители в конце
-        line = line.rstrip(delimiter).strip()
-        # Разбиваем по разделителю
-        fields = line.split(delimiter)
-        
-        # Убеждаемся, что у нас есть все нужные поля (8 полей)
-        while len(fields) < 8:
-            fields.append('')
-            
-        return {
-            'TMP_ID': fields[0].strip() if len(fields) > 0 else '',
-            'NAME': fields[1].strip() if len(fields) > 1 else '',
-            'PROPERTY_PRODUCER_ID': fields[2].strip() if len(fields) > 2 else '',
-            'PROPERTY_TMC_NUMBER': fields[3].strip() if len(fields) > 3 else '',
-            'PROPERTY_ARTIKYL_NUMBER': fields[4].strip() if len(fields) > 4 else '',
-            'PROPERTY_MODEL_AVTO': fields[5].strip() if len(fields) > 5 else '',
-            'PROPERTY_CROSS_NUMBER': fields[6].strip() if len(fields) > 6 else '',
-            'SECTION_ID': fields[7].strip() if len(fields) > 7 else '',
-        }
+        return parse_csv_line(line, delimiter)
 
-    def count_lines_in_file(self, file_path, encoding, delimiter='#'):
-        """Подсчитывает количество строк в CSV файле, исключая заголовок"""
+    def count_lines_in_file(self, file_path, encoding=None, delimiter='#'):
+        """
+        Подсчитывает количество строк в CSV файле, исключая заголовок.
+        Считает байты перевода строки в отображенном в память файле, не
+        декодируя текст (import_inspect.count_csv_rows)
+        """
         try:
-            with open(file_path, 'r', encoding=encoding) as file:
-                lines = file.readlines()
-                # Исключаем заголовок (первую строку)
-                return len(lines) - 1 if len(lines) > 0 else 0
+            return count_csv_rows(file_path)
         except Exception as e:
             logger.error(f"Ошибка подсчета строк в файле: {e}")
             return 0
 
+    def make_product_slug(self, name, tmp_id):
+        """Slug товара из названия и TMP_ID - уникален вместе с TMP_ID, без проверок в базе"""
+        return make_product_slug(name, tmp_id)
+
+    def iter_csv_lines(self, file_path, encoding, skip_rows=0, start_offset=0, start_line=0):
+        """
+        Потоково читает файл построчно (заголовок - строка 0) и выдает
+        (номер строки, байтовое смещение конца строки, текст строки).
+        Строки до skip_rows не декодируются. Ошибка декодирования одной
+        строки не прерывает чтение остальных - она выдается вместо текста.
+        С start_offset после заголовка чтение сразу переходит к этому
+        смещению (строка start_line + 1) - загруженная часть не читается
+        """
+        def decode(raw_line):
+            try:
+                return raw_line.decode(encoding)
+            except UnicodeDecodeError as e:
+                return e
+        
+        with open(file_path, 'rb') as file:
+            offset = 0
+            lines = enumerate(file)
+            if start_offset:
+                header = file.readline()
+                yield 0, len(header), decode(header)
+                file.seek(start_offset)
+                offset = start_offset
+                lines = enumerate(file, start=start_line + 1)
+            for line_num, raw_line in lines:
+                offset += len(raw_line)
+                if 0 < line_num <= skip_rows:
+                    continue
+                yield line_num, offset, decode(raw_line)
+
+    def iter_rows(self, file_path, encoding, delimiter, skip_rows=0, start_offset=0, start_line=0):
+        """
+        Как iter_csv_lines, но строки данных выдаются уже разобранными
+        (поля товара или исключение); заголовок - текстом
+        """
+        for line_num, offset, line in self.iter_csv_lines(file_path, encoding, skip_rows, start_offset, start_line):
+            if line_num and not isinstance(line, Exception):
+                line = transform_or_error(transform_csv_line, line, delimiter)
+            yield line_num, offset, line
+
+    def iter_parallel_rows(self, file_path, encoding, delimiter, workers, skip_rows=0, start_offset=0, start_line=0):
+        """
+        То же, что iter_rows, но строки разбираются в пуле из workers процессов
+        диапазонами по CSV_CHUNK_BYTES. Заголовок и пропускаемые строки читает
+        текущий процесс, номера строк назначаются по порядку при выдаче
+        """
+        with open(file_path, 'rb') as file:
+            header = file.readline()
+            try:
+                yield 0, len(header), header.decode(encoding)
+            except UnicodeDecodeError as e:
+                yield 0, len(header), e
+            line_num, start = start_line, start_offset
+            if not start_offset:
+                start = len(header)
+                for _ in range(skip_rows):
+                    raw_line = file.readline()
+                    if not raw_line:
+                        return
+                    start += len(raw_line)
+                line_num = max(skip_rows, 0)
+        
+        chunks = ((file_path, chunk_start, chunk_end, encoding, delimiter) for chunk_start, chunk_end in csv_chunk_ranges(file_path, start))
+        for results in map_chunks(transform_csv_chunk, chunks, workers):
+            for offset, row in results:
+                line_num += 1
+                yield line_num, offset, row
+
     def handle(self, *args, **options):
+        if options.get('bulk_load'):
+            # Вся загрузка - в режиме массовой загрузки SQLite: индексы строятся в конце
+            self.stdout.write('Режим массовой загрузки: прагмы импорта, индексы товаров строятся в конце')
+            with bulk_load_session():
+                result = self.run_import(*args, **options)
+                indexes_started = time.perf_counter()
+            if options.get('import_file_id'):
+                ImportFile.add_phase_timing(options['import_file_id'], 'indexes', time.perf_counter() - indexes_started)
+            return result
+        return self.run_import(*args, **options)
+
+    def run_import(self, *args, **options):
         csv_file = options['csv_file']
         batch_size = options['batch_size']
         skip_rows = options['skip_rows']
@@ -108,62 +171,86 @@ class Command(BaseCommand):
         import_file_id = options.get('import_file_id')
         clear_existing = options.get('clear_existing', False)
         test_lines = options.get('test_lines', 0)
+        mark_disappeared = options.get('mark_disappeared', False)
+        diff_mode = options.get('diff', False) or mark_disappeared
+        use_staging = options.get('staging', False)
+        workers = max(options.get('workers') or 1, 1)
+        resume = options.get('resume', False)
         import_file = None
+        checkpoint = None
         
         if import_file_id:
             import_file = ImportFile.objects.filter(id=import_file_id).first()
-            if import_file:
+            if import_file and resume:
+                if import_file.committed_row and import_file.checkpoint.get('offset'):
+                    checkpoint = import_file.checkpoint
+                    self.stdout.write(f'Продолжаем импорт после строки {import_file.committed_row}')
+                else:
+                    self.stdout.write(self.style.WARNING('Контрольной точки нет, импорт начнется с начала файла'))
+            if checkpoint is not None:
+                ImportFile.objects.filter(id=import_file.id).update(
+                    status='processing', processed=False, started_at=timezone.now(),
+                )
+            elif import_file:
                 # Сбрасываем старые ошибки/счётчики на старте
                 ImportFile.objects.filter(id=import_file.id).update(
                     status='processing',
+                    started_at=timezone.now(),
+                    phase_timings={},
+                    batch_timings=[],
                     error_log='',
                     processed=False,
                     current_row=0,
                     processed_rows=0,
                     created_products=0,
                     updated_products=0,
+                    unchanged_products=0,
+                    removed_products=0,
                     error_count=0,
+                    committed_row=0,
+                    checkpoint={},
                 )
         
+        # Счетчики по ходу импорта идут в канал прогресса (файл), в базу - не чаще
+        # раза в несколько секунд; через него же приходит отмена из админки
+        if import_file:
+            discard_progress(import_file.id)
+        self.progress = progress = ImportProgress(import_file.id if import_file else None)
+        # Замеры продолжаются с контрольной точки вместе со счетчиками
+        if checkpoint is not None:
+            self.timings = timings = ImportTimings(import_file.phase_timings, import_file.batch_timings)
+        else:
+            self.timings = timings = ImportTimings()
+        
         # Очищаем существующие товары если указан флаг
         if clear_existing:
             self.stdout.write('Очищаем существующие товары...')
             deleted_count = Product.objects.count()
             Product.objects.all().delete()
+            fts.clear_index()
+            bump_catalog_version()
             self.stdout.write(f'Удалено {deleted_count} существующих товаров')
             logger.info(f"Удалено {deleted_count} существующих товаров")
             
             # Очищаем кэши
-            existing_tmp_ids = set()
-            existing_codes = set()
             all_categories = {}
             all_brands = {}
         else:
             # Загружаем существующие данные в память для быстрого поиска
             self.stdout.write('Загружаем существующие данные в память...')
             
-            existing_tmp_ids = set(Product.objects.values_list('tmp_id', flat=True))
-            existing_codes = set(Product.objects.values_list('slug', flat=True))
             all_categories = {cat.slug: cat for cat in Category.objects.all()}
             all_brands = {brand.slug: brand for brand in Brand.objects.all()}
             
-            self.stdout.write(f'Загружено {len(existing_tmp_ids)} существующих товаров по TMP_ID')
-            self.stdout.write(f'Загружено {len(existing_codes)} существующих товаров по коду')
             self.stdout.write(f'Загружено {len(all_categories)} существующих категорий')
             self.stdout.write(f'Загружено {len(all_brands)} существующих брендов')
             
-            logger.info(f"Загружено {len(existing_tmp_ids)} существующих товаров по TMP_ID")
-            logger.info(f"Загружено {len(existing_codes)} существующих товаров по коду")
             logger.info(f"Загружено {len(all_categories)} существующих категорий")
             logger.info(f"Загружено {len(all_brands)} существующих брендов")
         
         # Инициализируем кэши и счетчики
         categories_cache = {}
         brands_cache = {}
-        created_categories = 0
-        created_brands = 0
-        created_products = 0
-        updated_products = 0
         errors = 0
         processed_rows = 0
         
@@ -176,10 +263,36 @@ class Command(BaseCommand):
             logger.error(error_msg)
             if import_file:
                 ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
+                progress.finish('failed')
             return
 
+        # Хэш файла привязывает контрольные точки к содержимому: продолжить
+        # можно только импорт того же файла
+        if import_file:
+            file_hash = ImportFile.compute_file_hash(csv_file)
+            if checkpoint is not None and file_hash != import_file.file_hash:
+                error_msg = 'Файл изменился после контрольной точки, продолжить импорт нельзя - запустите его заново'
+                self.stdout.write(self.style.ERROR(error_msg))
+                logger.error(error_msg)
+                ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
+                progress.finish('failed')
+                return
+            ImportFile.objects.filter(id=import_file.id).update(file_hash=file_hash)
+        
+        if checkpoint is not None:
+            # Продолжаем в той же кодировке, в которой импорт начинался
+            encoding = checkpoint.get('encoding', encoding)
         if encoding == 'auto':
             encoding = self.detect_encoding(csv_file)
+        if not supports_byte_lines(encoding):
+            # Файл читается строками по байту перевода строки - UTF-16/32 так не разобрать
+            error_msg = f'Кодировка {encoding} не поддерживается: сохраните выгрузку в UTF-8 или cp1251'
+            self.stdout.write(self.style.ERROR(error_msg))
+            logger.error(error_msg)
+            if import_file:
+                ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
+                progress.finish('failed')
+            return
         
         encodings_to_try = [encoding, 'cp1251', 'windows-1251', 'utf-8-sig', 'utf-8']
         
@@ -197,6 +310,7 @@ class Command(BaseCommand):
             logger.error(error_msg)
             if import_file:
                 ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
+                progress.finish('failed')
             return
 
         # Подсчитываем общее количество строк
@@ -205,301 +319,343 @@ class Command(BaseCommand):
         logger.info(f"Всего строк в файле: {total_lines}")
         if import_file:
             ImportFile.objects.filter(id=import_file.id).update(total_rows=total_lines)
+        progress.start(total_rows=total_lines, phase='rows')
 
         products_batch = []
-        products_to_update = []
         
         stats = defaultdict(int)
+        
+        # В режиме сравнения запоминаем все TMP_ID выгрузки, чтобы найти пропавшие товары.
+        # При частичном импорте (пропуск/лимит строк) пропавшие не определяются
+        seen_tmp_ids = None
+        if diff_mode:
+            if skip_rows or test_lines or checkpoint is not None:
+                self.stdout.write(self.style.WARNING('Режим сравнения отключен: импортируется только часть файла'))
+                mark_disappeared = False
+            else:
+                seen_tmp_ids = set()
+
+        # В режиме staging строки копятся во временной таблице, а бренды,
+        # категории и slug разрешаются при переносе в каталог
+        loader = None
+        if use_staging:
+            if staging_available():
+                loader = StagingLoader(batch_size=batch_size)
+                loader.create()
+                self.stdout.write('Загрузка через staging-таблицу')
+            else:
+                self.stdout.write(self.style.WARNING('Staging-загрузка доступна только для SQLite, используем обычный импорт'))
 
         try:
             if not disable_transactions:
                 connection.autocommit = False
             
-            with open(csv_file, 'r', encoding=working_encoding) as file:
-                lines = file.readlines()
-                
-                # Пропускаем заголовок (первую строку)
-                if len(lines) == 0:
-                    self.stdout.write(self.style.ERROR('Файл пустой'))
-                    return
-                
-                header_line = lines[0].strip()
-                self.stdout.write(f'Заголовок: {header_line}')
-                logger.info(f"Заголовок CSV: {header_line}")
-                
-                # Проверяем на дублирующиеся tmp_id
-                tmp_ids_in_csv = set()
-                duplicate_tmp_ids = set()
-                
-                for line_num, line in enumerate(lines[1:], start=1):  # Пропускаем заголовок
-                    try:
-                        row = self.parse_csv_line(line, delimiter)
-                    tmp_id = row.get('TMP_ID', '').strip()
-                    if tmp_id:
-                        if tmp_id in tmp_ids_in_csv:
-                            duplicate_tmp_ids.add(tmp_id)
-                        else:
-                            tmp_ids_in_csv.add(tmp_id)
-                    except Exception as e:
-                        logger.warning(f"Ошибка парсинга строки {line_num} при проверке дубликатов: {e}")
+            file_size = os.path.getsize(csv_file) or 1
+            start_offset = start_line = 0
+            if checkpoint is not None:
+                # Счетчики продолжаются с контрольной точки
+                start_offset, start_line = checkpoint['offset'], import_file.committed_row
+                processed_rows = checkpoint.get('processed_rows', 0)
+                errors = checkpoint.get('errors', 0)
+                stats.update(checkpoint.get('stats', {}))
+            if workers > 1:
+                lines = self.iter_parallel_rows(csv_file, working_encoding, delimiter, workers, skip_rows, start_offset, start_line)
+            else:
+                lines = self.iter_rows(csv_file, working_encoding, delimiter, skip_rows, start_offset, start_line)
+            lines = timings.timed_rows(lines)
+            timings.reset_batch()
+            # Последняя полностью обработанная строка и смещение ее конца
+            position = (start_line, start_offset)
+            
+            # Заголовок (первая строка)
+            header = next(lines, None)
+            if header is None:
+                self.stdout.write(self.style.ERROR('Файл пустой'))
+                return
+            
+            header_line = str(header[2]).strip()
+            self.stdout.write(f'Заголовок: {header_line}')
+            logger.info(f"Заголовок CSV: {header_line}")
+            
+            # Основной импорт - один потоковый проход по файлу; дубликаты
+            # TMP_ID учитываются по ходу импорта. Строки приходят уже
+            # разобранными (import_transform) - здесь только то, что требует базы
+            cancelled = False
+            for line_num, bytes_read, row in lines:
+                if progress.is_cancelled():
+                    cancelled = True
+                    break
+                try:
+                    # Ограничиваем количество строк для тестирования
+                    if test_lines > 0 and line_num > test_lines:
+                        self.stdout.write(f'Достигнут лимит тестовых строк: {test_lines}')
+                        break
+                    position = (line_num, bytes_read)
+                    
+                    if isinstance(row, Exception):
+                        raise row
+                    if row is None:
+                        stats['skipped_empty'] += 1
                         continue
-                
-                if duplicate_tmp_ids:
-                    self.stdout.write(self.style.WARNING(f'Найдено {len(duplicate_tmp_ids)} дублирующихся TMP_ID в CSV файле'))
-                    logger.warning(f"Найдено {len(duplicate_tmp_ids)} дублирующихся TMP_ID в CSV файле")
-                
-                self.stdout.write(f'Уникальных TMP_ID в CSV: {len(tmp_ids_in_csv)}')
-                logger.info(f"Уникальных TMP_ID в CSV: {len(tmp_ids_in_csv)}")
-                
-                # Основной импорт
-                for line_num, line in enumerate(lines[1:], start=1):  # Пропускаем заголовок
-                    try:
-                        # Пропускаем уже обработанные строки
-                        if line_num <= skip_rows:
-                            continue
-                            
-                        # Ограничиваем количество строк для тестирования
-                        if test_lines > 0 and line_num > test_lines:
-                            self.stdout.write(f'Достигнут лимит тестовых строк: {test_lines}')
-                            break
-                        
-                        # Парсим строку
-                        row = self.parse_csv_line(line, delimiter)
-                        
-                        # Парсим данные по новой структуре
-                        tmp_id = row.get('TMP_ID', '').strip()
-                        name = row.get('NAME', '').strip()
-                        producer_id = row.get('PROPERTY_PRODUCER_ID', '').strip()
-                        tmc_number = row.get('PROPERTY_TMC_NUMBER', '').strip()
-                        artikyl_number = row.get('PROPERTY_ARTIKYL_NUMBER', '').strip()
-                        model_avto = row.get('PROPERTY_MODEL_AVTO', '').strip()
-                        cross_number = row.get('PROPERTY_CROSS_NUMBER', '').strip()
-                        section_id = row.get('SECTION_ID', '').strip()
-                        
-                        # Логируем первые несколько строк для отладки
-                        if line_num <= 5:
-                            logger.info(f"Строка {line_num}: TMP_ID={tmp_id}, NAME={name}, PRODUCER={producer_id}, SECTION={section_id}, TMC={tmc_number}")
-                            self.stdout.write(f"Отладка строки {line_num}: TMP_ID={tmp_id}, NAME={name}, PRODUCER={producer_id}")
-                        
-                        # МИНИМАЛЬНАЯ ОБРАБОТКА - ПЕРЕНОСИМ КАК ЕСТЬ!
-                        
-                        # Обрабатываем только критичные пустые поля
-                        if not tmp_id:
-                            tmp_id = "Недоступно"
-                            logger.warning(f"Строка {line_num}: Пустой TMP_ID, установлен 'Недоступно'")
-                        
-                        if not name:
-                            name = "Недоступно"
-                            logger.warning(f"Строка {line_num}: Пустое название, установлено 'Недоступно'")
-                        
-                        # Логируем обработку
-                        if line_num <= 10 or line_num % 10000 == 0:
-                            self.stdout.write(f"Строка {line_num}: TMP_ID='{tmp_id}', NAME='{name[:30]}...'")
-                        
-                        # Очищаем SECTION_ID от квадратных скобок и других символов
-                        if section_id:
-                            section_id = section_id.replace('[', '').replace(']', '').replace(';', '').strip()
-                        
-                        # Обрабатываем дубликаты по TMP_ID (только суффиксы)
-                        original_tmp_id = tmp_id
-                        counter = 1
-                        while tmp_id in existing_tmp_ids:
-                            tmp_id = f"{original_tmp_id}-dup{counter}"
-                            counter += 1
-                        
-                        if tmp_id != original_tmp_id:
-                            logger.warning(f"Строка {line_num}: Дубликат TMP_ID '{original_tmp_id}', изменен на '{tmp_id}'")
-                        
-                        # Логируем отсутствие данных (без изменений)
-                        if not producer_id:
-                            logger.info(f"Строка {line_num}: Товар {tmp_id} без производителя")
-                        if not section_id:
-                            logger.info(f"Строка {line_num}: Товар {tmp_id} без категории")
-                        
-                        # Логируем каждые 1000 строк для отслеживания прогресса
-                        if line_num % 1000 == 0:
-                            logger.info(f"Обработано строк: {line_num}/{total_lines} ({(line_num/total_lines)*100:.1f}%)")
-                            if import_file:
-                                # Промежуточное обновление прогресса
-                                ImportFile.objects.filter(id=import_file.id).update(
-                                    current_row=line_num,
-                                    processed_rows=processed_rows,
-                                    created_products=stats['new_products'],
-                                    error_count=errors,
-                                )
-                        
-                        brand = None
-                        if producer_id:
-                            # Создаем slug из названия бренда, а не используем название как slug
-                            brand_slug = slugify(producer_id)
-                            if brand_slug in all_brands:
-                                brand = all_brands[brand_slug]
-                                if line_num <= 5:
+                    
+                    tmp_id = row['tmp_id']
+                    name = row['name']
+                    producer_id = row['producer']
+                    section_id = row['section_id']
+                    
+                    # Логируем первые несколько строк для отладки
+                    if line_num <= 5:
+                        logger.info(f"Строка {line_num}: TMP_ID={tmp_id}, NAME={name}, PRODUCER={producer_id}, SECTION={section_id}, TMC={row['catalog_number']}")
+                        self.stdout.write(f"Отладка строки {line_num}: TMP_ID={tmp_id}, NAME={name}, PRODUCER={producer_id}")
+                    
+                    # МИНИМАЛЬНАЯ ОБРАБОТКА - ПЕРЕНОСИМ КАК ЕСТЬ!
+                    # (строки без TMP_ID отсеяны при разборе как ошибки)
+                    if seen_tmp_ids is not None:
+                        seen_tmp_ids.add(tmp_id)
+                    
+                    # Логируем обработку
+                    if line_num <= 10 or line_num % 10000 == 0:
+                        self.stdout.write(f"Строка {line_num}: TMP_ID='{tmp_id}', NAME='{name[:30]}...'")
+                    
+                    # Существующий товар с тем же TMP_ID обновляется при сохранении пачки (upsert)
+                    
+                    # Логируем отсутствие данных (без изменений)
+                    if not producer_id:
+                        logger.info(f"Строка {line_num}: Товар {tmp_id} без производителя")
+                    if not section_id:
+                        logger.info(f"Строка {line_num}: Товар {tmp_id} без категории")
+                    
+                    # Логируем каждые 1000 строк для отслеживания прогресса
+                    if line_num % 1000 == 0:
+                        logger.info(f"Обработано строк: {line_num}/{total_lines} ({bytes_read / file_size * 100:.1f}% файла)")
+                        # Промежуточное обновление прогресса
+                        progress.update(
+                            current_row=line_num,
+                            processed_rows=processed_rows,
+                            created_products=stats['new_products'],
+                            updated_products=stats['updated_products'],
+                            error_count=errors,
+                        )
+                    
+                    if loader is not None:
+                        if not producer_id or not section_id:
+                            raise ValueError(f'товар {tmp_id} без производителя или категории')
+                        loader.add(
+                            line_num,
+                            tmp_id=tmp_id,
+                            name=name[:200],
+                            slug=row['slug'],
+                            producer=producer_id,
+                            section_id=section_id,
+                            code=tmp_id,
+                            catalog_number=row['catalog_number'] or tmp_id,
+                            cross_number=row['cross_number'],
+                            artikyl_number=row['artikyl_number'],
+                            applicability=row['applicability'],
+                            in_stock=True,
+                        )
+                        processed_rows += 1
+                        if not loader.rows:
+                            # Пачка только что записана в staging-таблицу
+                            timings.batch(line_num, loader.batch_size)
+                        continue
+                    
+                    brand = None
+                    if producer_id:
+                        # Создаем slug из названия бренда, а не используем название как slug
+                        brand_slug = row['brand_slug']
+                        if brand_slug in all_brands:
+                            brand = all_brands[brand_slug]
+                            if line_num <= 5:
                                 logger.info(f"Найден существующий бренд: {brand.name} (slug: {brand_slug})")
-                            elif brand_slug not in brands_cache:
-                                brand, created = Brand.objects.get_or_create(
-                                    slug=brand_slug,
-                                    defaults={
-                                        'name': producer_id,  # Сохраняем оригинальное название
-                                        'description': f'Автоматически созданный бренд для {producer_id}'
-                                    }
-                                )
-                                all_brands[brand_slug] = brand
-                                brands_cache[brand_slug] = brand
-                                if created:
-                                    stats['new_brands'] += 1
-                                    self.stdout.write(f'Создан бренд: {brand.name}')
-                                    logger.info(f"Создан новый бренд: {brand.name} (slug: {brand_slug})")
-                        else:
-                                brand = brands_cache[brand_slug]
+                        elif brand_slug not in brands_cache:
+                            brand, created = Brand.objects.get_or_create(
+                                slug=brand_slug,
+                                defaults={
+                                    'name': producer_id,  # Сохраняем оригинальное название
+                                    'description': f'Автоматически созданный бренд для {producer_id}'
+                                }
+                            )
+                            all_brands[brand_slug] = brand
+                            brands_cache[brand_slug] = brand
+                            if created:
+                                stats['new_brands'] += 1
+                                self.stdout.write(f'Создан бренд: {brand.name}')
+                                logger.info(f"Создан новый бренд: {brand.name} (slug: {brand_slug})")
                         else:
-                            logger.warning(f"Строка {line_num}: Отсутствует производитель для товара {tmp_id}")
-                        
-                        # Создаем/получаем категорию (с кэшем)
-                        category = None
-                        if section_id:
-                            # Создаем slug из SECTION_ID, а не используем SECTION_ID как slug
-                            category_slug = slugify(f"category-{section_id}")
-                            if category_slug in all_categories:
-                                category = all_categories[category_slug]
-                                if line_num <= 5:
+                            brand = brands_cache[brand_slug]
+                    else:
+                        logger.warning(f"Строка {line_num}: Отсутствует производитель для товара {tmp_id}")
+                    
+                    # Создаем/получаем категорию (с кэшем)
+                    category = None
+                    if section_id:
+                        # Создаем slug из SECTION_ID, а не используем SECTION_ID как slug
+                        category_slug = row['category_slug']
+                        if category_slug in all_categories:
+                            category = all_categories[category_slug]
+                            if line_num <= 5:
                                 logger.info(f"Найдена существующая категория: {category.name} (slug: {category_slug})")
-                            elif category_slug not in categories_cache:
-                                # Создаем категорию сразу
-                                category, created = Category.objects.get_or_create(
-                                    slug=category_slug,
-                                    defaults={
-                                        'name': f'Категория {section_id}',
-                                        'description': f'Автоматически созданная категория для {section_id}'
-                                    }
-                                )
-                                all_categories[category_slug] = category
-                                categories_cache[category_slug] = category
-                                if created:
-                                    stats['new_categories'] += 1
-                                    self.stdout.write(f'Создана категория: {category.name}')
-                                    logger.info(f"Создана новая категория: {category.name} (slug: {category_slug})")
+                        elif category_slug not in categories_cache:
+                            # Создаем категорию сразу
+                            category, created = Category.objects.get_or_create(
+                                slug=category_slug,
+                                defaults={
+                                    'name': f'Категория {section_id}',
+                                    'description': f'Автоматически созданная категория для {section_id}'
+                                }
+                            )
+                            all_categories[category_slug] = category
+                            categories_cache[category_slug] = category
+                            if created:
+                                stats['new_categories'] += 1
+                                self.stdout.write(f'Создана категория: {category.name}')
+                                logger.info(f"Создана новая категория: {category.name} (slug: {category_slug})")
                         else:
-                                category = categories_cache[category_slug]
-                        else:
-                            logger.warning(f"Строка {line_num}: Отсутствует категория для товара {tmp_id}")
-                        
-                        # Создаем безопасный slug для товара
-                        # Очищаем название товара
-                        clean_name = slugify(name)[:30] if name else 'product'
-                        
-                        # Очищаем TMP_ID от всех спецсимволов
-                        clean_tmp_id = re.sub(r'[^a-zA-Z0-9]', '', tmp_id) if tmp_id else 'unknown'
-                        
-                        # Создаем базовый slug
-                        base_slug = f"{clean_name}-{clean_tmp_id}"
-                        
-                        # Дополнительно очищаем весь slug
-                        slug = slugify(base_slug)
-                        
-                        # Если slug пустой, создаем дефолтный
-                        if not slug:
-                            slug = f"product-{clean_tmp_id}"
-                        
-                        # Проверяем уникальность
-                        counter = 1
-                        original_slug = slug
-                        while slug in existing_codes:
-                            slug = f"{original_slug}-{counter}"
-                            counter += 1
-                        
-                        existing_codes.add(slug)  # Добавляем в кэш
-                        existing_tmp_ids.add(tmp_id)  # Добавляем в кэш
-                        
-                        product = Product(
-                            tmp_id=tmp_id,
-                            name=name[:200], 
-                            slug=slug,
-                            category=category,
-                            brand=brand,
-                            code=tmp_id,  # Используем TMP_ID как код товара
-                            catalog_number=tmc_number or tmp_id,  # TMC_NUMBER как каталожный номер
-                            cross_number=cross_number[:100] if cross_number else '',
-                            artikyl_number=artikyl_number[:100] if artikyl_number else '',
-                            applicability=model_avto[:500] if model_avto else 'Уточняйте',
-                            price=0,
-                            in_stock=True,
-                            is_new=True,
+                            category = categories_cache[category_slug]
+                    else:
+                        logger.warning(f"Строка {line_num}: Отсутствует категория для товара {tmp_id}")
+                    
+                    # Бренд и категория обязательны - без них товар не сохранится,
+                    # поэтому такая строка считается ошибочной, а не валит всю пачку
+                    if brand is None or category is None:
+                        raise ValueError(f'товар {tmp_id} без производителя или категории')
+                    
+                    product = Product(
+                        tmp_id=tmp_id,
+                        name=name[:200], 
+                        slug=row['slug'],  # уникален вместе с TMP_ID - без проверок
+                        category=category,
+                        brand=brand,
+                        code=tmp_id,  # Используем TMP_ID как код товара
+                        catalog_number=row['catalog_number'] or tmp_id,  # TMC_NUMBER как каталожный номер
+                        cross_number=row['cross_number'],
+                        artikyl_number=row['artikyl_number'],
+                        applicability=row['applicability'],
+                        price=0,
+                        in_stock=True,
+                        is_new=True,
+                    )
+                    
+                    # Логируем создание товара для отладки
+                    if line_num <= 5:
+                        logger.info(f"Создается товар: {product.name}, бренд: {product.brand.name if product.brand else 'Нет'}, категория: {product.category.name if product.category else 'Нет'}")
+                    
+                    products_batch.append(product)
+                    processed_rows += 1
+                    
+                    if processed_rows % 1000 == 0:
+                        # Прогресс по прочитанным байтам точен и при пропущенных/ошибочных строках
+                        percent = bytes_read / file_size * 100
+                        self.stdout.write(f'Прогресс: {percent:.1f}% ({line_num}/{total_lines}) | Создано товаров: {stats["new_products"]}')
+                        progress.update(
+                            current_row=line_num,
+                            processed_rows=processed_rows,
+                            created_products=stats['new_products'],
+                            updated_products=stats['updated_products'],
+                            error_count=errors,
                         )
-                        
-                        # Логируем создание товара для отладки
-                        if line_num <= 5:
-                            logger.info(f"Создается товар: {product.name}, бренд: {product.brand.name if product.brand else 'Нет'}, категория: {product.category.name if product.category else 'Нет'}")
-                        
-                        products_batch.append(product)
-                        stats['new_products'] += 1
-                        processed_rows += 1
-                        
-                        if stats['new_products'] % 100 == 0:
-                            logger.info(f"Создано товаров: {stats['new_products']}, обработано строк: {processed_rows}")
-                        
-                        if processed_rows % 1000 == 0:
-                            progress = (processed_rows / total_lines) * 100
-                            self.stdout.write(f'Прогресс: {progress:.1f}% ({processed_rows}/{total_lines}) | Создано товаров: {stats["new_products"]}')
+                    
+                    if len(products_batch) >= batch_size:
+                        # Пачка и контрольная точка сохраняются в одной транзакции
+                        with timings.writing(), transaction.atomic():
+                            self._save_products_batch(products_batch, stats)
                             if import_file:
-                                ImportFile.objects.filter(id=import_file.id).update(
-                                    current_row=processed_rows,
-                                    processed_rows=processed_rows,
-                                    created_products=stats['new_products'],
-                                    error_count=errors,
-                                )
+                                self._save_checkpoint(import_file, position, processed_rows, errors, stats, working_encoding)
+                        timings.batch(line_num, len(products_batch))
+                        logger.info(f"Сохранена пачка товаров: {len(products_batch)}")
+                        products_batch = []
                         
-                        if len(products_batch) >= batch_size:
-                            self._save_products_batch(products_batch)
-                            logger.info(f"Сохранена пачка товаров: {len(products_batch)}")
-                            products_batch = []
-                            if import_file:
-                                ImportFile.objects.filter(id=import_file.id).update(
-                                    processed_rows=processed_rows,
-                                    created_products=stats['new_products']
-                                )
-                            
-                    except Exception as e:
-                        errors += 1
-                        if errors <= 10:  
-                            error_msg = f'Ошибка в строке {line_num}: {str(e)}'
-                            self.stdout.write(self.style.ERROR(error_msg))
-                            logger.error(f"Ошибка в строке {line_num}: {str(e)}")
-                        if import_file:
-                            ImportFile.objects.filter(id=import_file.id).update(error_count=errors)
-                        continue
-                
-                if products_batch:
-                    self._save_products_batch(products_batch)
-                    logger.info(f"Сохранена финальная пачка товаров: {len(products_batch)}")
-                
+                except Exception as e:
+                    errors += 1
+                    if errors <= 10:  
+                        error_msg = f'Ошибка в строке {line_num}: {str(e)}'
+                        self.stdout.write(self.style.ERROR(error_msg))
+                        logger.error(f"Ошибка в строке {line_num}: {str(e)}")
+                    progress.update(error_count=errors)
+                    continue
+            
+            if cancelled:
+                # Несохраненная пачка отбрасывается: импорт продолжается с контрольной точки
+                self.stdout.write(self.style.WARNING(f'Импорт отменен пользователем после строки {position[0]}'))
+                logger.info(f"Импорт отменен пользователем, последняя обработанная строка: {position[0]}")
+                if loader is not None:
+                    loader.drop()
                 if not disable_transactions:
                     connection.autocommit = True
-                
-                final_stats = (
-                    f'\nИмпорт завершен!\n'
-                    f'Обработано строк: {processed_rows}\n'
-                    f'Создано категорий: {stats["new_categories"]}\n'
-                    f'Создано брендов: {stats["new_brands"]}\n'
-                    f'Создано товаров: {stats["new_products"]}\n'
-                    f'Пропущено пустых строк: {stats["skipped_empty"]}\n'
-                    f'Существующих товаров: {stats["existing_products"]}\n'
-                    f'Ошибок: {errors}'
-                )
-                
-                self.stdout.write(self.style.SUCCESS(final_stats))
-                logger.info(f"Импорт завершен успешно: {final_stats}")
                 if import_file:
-                    ImportFile.objects.filter(id=import_file.id).update(
-                        processed=True,
-                        processed_at=timezone.now(),
-                        status='completed',
-                        current_row=processed_rows,
-                        processed_rows=processed_rows,
-                        created_products=stats['new_products'],
-                        error_count=errors,
+                    ImportFile.objects.filter(id=import_file.id, cancelled=False).update(
+                        status='cancelled', cancelled=True, cancelled_at=timezone.now(),
                     )
-                
+                    ImportFile.objects.filter(id=import_file.id).update(**timings.as_fields())
+                progress.finish('cancelled')
+                return
+            
+            if products_batch:
+                with timings.writing(), transaction.atomic():
+                    self._save_products_batch(products_batch, stats)
+                    if import_file:
+                        self._save_checkpoint(import_file, position, processed_rows, errors, stats, working_encoding)
+                timings.batch(position[0], len(products_batch))
+                logger.info(f"Сохранена финальная пачка товаров: {len(products_batch)}")
+            
+            if loader is not None:
+                progress.set_phase('merge')
+                with timings.phase('merge'):
+                    errors += self._merge_staging(loader, stats)
+
+            if seen_tmp_ids is not None:
+                progress.set_phase('disappeared')
+                with timings.phase('disappeared'):
+                    self._process_disappeared(seen_tmp_ids, mark_disappeared, stats)
+            
+            # Пересчитываем группы аналогов по всему каталогу
+            self.stdout.write('Пересчитываем группы аналогов...')
+            progress.set_phase('analogs')
+            try:
+                with timings.phase('analogs'):
+                    changed_groups = rebuild_analog_groups()
+                bump_catalog_version()
+                self.stdout.write(f'Группы аналогов обновлены у {changed_groups} товаров')
+            except Exception as e:
+                logger.error(f"Ошибка пересчета групп аналогов: {str(e)}")
+            
+            if not disable_transactions:
+                connection.autocommit = True
+            
+            final_stats = (
+                f'\nИмпорт завершен!\n'
+                f'Обработано строк: {processed_rows}\n'
+                f'Создано категорий: {stats["new_categories"]}\n'
+                f'Создано брендов: {stats["new_brands"]}\n'
+                f'Создано товаров: {stats["new_products"]}\n'
+                f'Пропущено пустых строк: {stats["skipped_empty"]}\n'
+                f'Обновлено товаров: {stats["updated_products"]}\n'
+                f'Без изменений: {stats["unchanged_products"]}\n'
+                f'Пропало из выгрузки: {stats["removed_products"]}\n'
+                f'Повторов TMP_ID в пачке: {stats["duplicate_tmp_ids"]}\n'
+                f'Ошибок: {errors}'
+            )
+            
+            self.stdout.write(self.style.SUCCESS(final_stats))
+            logger.info(f"Импорт завершен успешно: {final_stats}")
+            if import_file:
+                ImportFile.objects.filter(id=import_file.id).update(
+                    processed=True,
+                    processed_at=timezone.now(),
+                    status='completed',
+                    current_row=position[0],
+                    processed_rows=processed_rows,
+                    created_products=stats['new_products'],
+                    updated_products=stats['updated_products'],
+                    unchanged_products=stats['unchanged_products'],
+                    removed_products=stats['removed_products'],
+                    error_count=errors,
+                    **timings.as_fields(),
+                )
+                progress.saved()
+            progress.finish('completed')
+            
         except Exception as e:
             error_msg = f'Критическая ошибка: {str(e)}'
             self.stdout.write(self.style.ERROR(error_msg))
@@ -507,22 +663,82 @@ class Command(BaseCommand):
             if not disable_transactions:
                 connection.autocommit = True
             if import_file:
-                ImportFile.objects.filter(id=import_file.id).update(status='failed', error_log=error_msg)
+                ImportFile.objects.filter(id=import_file.id).update(
+                    status='failed', error_log=error_msg, **timings.as_fields(),
+                )
+                progress.finish('failed')
+        finally:
+            progress.close()
+
+    def _process_disappeared(self, seen_tmp_ids, mark_out_of_stock, stats):
+        """Товары, которых нет в выгрузке: считаются и (по флагу) снимаются с наличия"""
+        disappeared = Product.find_disappeared(seen_tmp_ids, mark_out_of_stock=mark_out_of_stock)
+        stats['removed_products'] = len(disappeared)
+        if disappeared and mark_out_of_stock:
+            bump_catalog_version()
+            self.stdout.write(f'Снято с наличия товаров, пропавших из выгрузки: {len(disappeared)}')
+        else:
+            self.stdout.write(f'Товаров, пропавших из выгрузки: {len(disappeared)}')
+        logger.info(f"Пропало из выгрузки: {len(disappeared)}, снято с наличия: {mark_out_of_stock}")
 
-    def _save_products_batch(self, products_batch):
+    def _save_checkpoint(self, import_file, position, processed_rows, errors, stats, encoding):
+        """Контрольная точка после сохраненной пачки: строка, смещение ее конца и счетчики"""
+        line_num, offset = position
+        ImportFile.objects.filter(id=import_file.id).update(
+            committed_row=line_num,
+            checkpoint={
+                'offset': offset,
+                'encoding': encoding,
+                'processed_rows': processed_rows,
+                'errors': errors,
+                'stats': dict(stats),
+            },
+            current_row=line_num,
+            processed_rows=processed_rows,
+            created_products=stats['new_products'],
+            updated_products=stats['updated_products'],
+            unchanged_products=stats['unchanged_products'],
+            error_count=errors,
+            **self.timings.as_fields(),
+        )
+        self.progress.saved(
+            current_row=line_num,
+            processed_rows=processed_rows,
+            created_products=stats['new_products'],
+            updated_products=stats['updated_products'],
+            error_count=errors,
+        )
+
+    def _merge_staging(self, loader, stats):
+        """Переносит строки из staging-таблицы в каталог одной транзакцией; возвращает число ошибочных строк"""
+        self.stdout.write(f'Переносим в каталог {loader.loaded + len(loader.rows)} строк из staging-таблицы...')
+        try:
+            result = loader.merge()
+        finally:
+            loader.drop()
+        changed_tmp_ids = result.pop('changed_tmp_ids')
+        unresolved = result.pop('unresolved_rows')
+        for key, value in result.items():
+            stats[key] += value
+        if changed_tmp_ids:
+            bump_catalog_version()
+        self.stdout.write(f'Перенесено: создано {result["new_products"]}, обновлено {result["updated_products"]}, без изменений {result["unchanged_products"]}')
+        # Строки без категории не перенесены - это ошибки строк
+        for line_num, tmp_id in unresolved[:10]:
+            self.stdout.write(self.style.ERROR(f'Ошибка в строке {line_num}: не найдена категория товара {tmp_id}'))
+        if unresolved:
+            logger.error(f"Не перенесено строк без категории: {len(unresolved)}")
+        return len(unresolved)
+
+    def _save_products_batch(self, products_batch, stats):
+        """Сохраняет пачку товаров: новые создаются, изменившиеся обновляются по TMP_ID"""
+        created, updated, unchanged = [], [], []
         try:
             logger.info(f"Попытка сохранения пачки из {len(products_batch)} товаров")
+            created, updated, unchanged = Product.upsert_by_tmp_id(products_batch)
             
-            created_products = Product.objects.bulk_create(products_batch, ignore_conflicts=True)
-            
-            actual_count = len(created_products)
-            logger.info(f"Фактически создано товаров: {actual_count} из {len(products_batch)}")
-            
-            if actual_count < len(products_batch):
-                logger.warning(f"Пропущено товаров из-за конфликтов: {len(products_batch) - actual_count}")
-            
-            self.stdout.write(f'Сохранена пачка из {len(products_batch)} товаров')
-            logger.info(f"Успешно сохранена пачка из {len(products_batch)} товаров")
+            self.stdout.write(f'Сохранена пачка из {len(products_batch)} товаров: создано {len(created)}, обновлено {len(updated)}, без изменений {len(unchanged)}')
+            logger.info(f"Сохранена пачка: создано={len(created)}, обновлено={len(updated)}, без изменений={len(unchanged)}")
             
         except Exception as e:
             error_msg = f'Ошибка сохранения пачки товаров: {str(e)}'
@@ -530,7 +746,27 @@ class Command(BaseCommand):
             logger.error(f"Ошибка сохранения пачки товаров: {str(e)}")
             for product in products_batch:
                 try:
-                    product.save()
+                    product_created, product_updated, product_unchanged = Product.upsert_by_tmp_id([product])
+                    created += product_created
+                    updated += product_updated
+                    unchanged += product_unchanged
                     logger.info(f"Товар {product.tmp_id} сохранен по одному")
                 except Exception as single_error:
-                    logger.error(f"Не удалось сохранить товар {product.tmp_id}: {str(single_error)}") 
\ No newline at end of file
+                    logger.error(f"Не удалось сохранить товар {product.tmp_id}: {str(single_error)}")
+        
+        stats['new_products'] += len(created)
+        stats['updated_products'] += len(updated)
+        stats['unchanged_products'] += len(unchanged)
+        stats['duplicate_tmp_ids'] += len(products_batch) - len(created) - len(updated) - len(unchanged)
+        
+        # Обновляем поисковые индексы только для созданных и измененных товаров
+        changed_tmp_ids = created + updated
+        if not changed_tmp_ids:
+            return
+        try:
+            Product.update_root_sections(changed_tmp_ids, field='tmp_id')
+            ProductNumber.rebuild_for(changed_tmp_ids, field='tmp_id')
+            fts.index_products(changed_tmp_ids, field='tmp_id')
+            bump_catalog_version()
+        except Exception as e:
+            logger.error(f"Ошибка обновления поисковых индексов: {str(e)}")
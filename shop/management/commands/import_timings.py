@@ -0,0 +1,42 @@
+from statistics import median
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from shop.import_metrics import batch_rate
+from shop.models import ImportFile
+
+
+class Command(BaseCommand):
+    help = 'Сравнение скорости последних импортов по сохраненным замерам (ImportFile.phase_timings/batch_timings)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=10, help='Сколько последних завершенных импортов показать (по умолчанию 10)')
+        parser.add_argument('--threshold', type=float, default=0.8,
+                            help='Импорт медленнее этой доли медианы предыдущих считается регрессией (по умолчанию 0.8)')
+
+    def handle(self, *args, **options):
+        imports = list(
+            ImportFile.objects.filter(status='completed')
+            .exclude(batch_timings=[])
+            .order_by('-started_at')[:max(options['limit'], 1)]
+        )
+        if not imports:
+            self.stdout.write('Завершенных импортов с замерами нет')
+            return
+
+        imports.reverse()
+        rates = []
+        for import_file in imports:
+            # Сквозная скорость (все этапы) и скорость основного цикла по пачкам
+            rate = import_file.processing_speed
+            phases = ', '.join(f'{name} {seconds:.1f}с' for name, seconds in import_file.phase_timings.items())
+            started = timezone.localtime(import_file.started_at).strftime('%d.%m.%Y %H:%M') if import_file.started_at else '-'
+            line = (f'📊 #{import_file.pk} {started} {import_file.original_filename}: {rate:,.0f} строк/с '
+                    f'(пачки {batch_rate(import_file.batch_timings):,.0f} строк/с) | {phases}')
+
+            # Сравнение с медианой предыдущих запусков
+            if rates and rate < median(rates) * options['threshold']:
+                self.stdout.write(self.style.WARNING(f'{line} | ⚠️ медленнее медианы ({median(rates):,.0f} строк/с)'))
+            else:
+                self.stdout.write(line)
+            rates.append(rate)
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from shop.models import Product, ProductNumber
+from shop.analogs import rebuild_analog_groups
+from shop.catalog_cache import bump_catalog_version
+from shop import fts
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Пересборка поисковых индексов товаров: номера, группы аналогов, полнотекстовый индекс'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help='Размер пачки товаров (по умолчанию 5000)')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        self.stdout.write('🔄 Пересобираем индекс номеров товаров...')
+        logger.info("Начинаем пересборку индекса номеров товаров")
+
+        product_ids = list(Product.objects.order_by('id').values_list('id', flat=True))
+        total = len(product_ids)
+
+        for start in range(0, total, batch_size):
+            ProductNumber.rebuild_for(product_ids[start:start + batch_size])
+            self.stdout.write(f'⏳ Обработано товаров: {min(start + batch_size, total)}/{total}')
+
+        total_numbers = ProductNumber.objects.count()
+        self.stdout.write(self.style.SUCCESS(f'✅ Индекс номеров пересобран: {total} товаров, {total_numbers} номеров'))
+        logger.info(f"Индекс номеров пересобран: товаров={total}, номеров={total_numbers}")
+
+        self.stdout.write('🔗 Пересчитываем группы аналогов...')
+        changed_groups = rebuild_analog_groups()
+        self.stdout.write(self.style.SUCCESS(f'✅ Группы аналогов пересчитаны, изменено товаров: {changed_groups}'))
+
+        self.stdout.write('🔎 Пересобираем полнотекстовый индекс...')
+        if fts.rebuild_index():
+            self.stdout.write(self.style.SUCCESS('✅ Полнотекстовый индекс пересобран'))
+        else:
+            self.stdout.write(self.style.WARNING('⚠️ FTS5 недоступен, текстовый поиск работает через icontains'))
+
+        bump_catalog_version()
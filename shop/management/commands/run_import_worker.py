@@ -0,0 +1,126 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from shop.db_tuning import restore_deferred_indexes
+from shop.import_progress import request_cancel
+from shop.models import ImportFile
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Фоновый воркер импорта: берет файлы из очереди (ImportFile) и импортирует каждый в отдельном процессе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Обработать очередь и завершиться')
+        parser.add_argument('--poll-interval', type=int, default=5, help='Интервал опроса очереди, сек (по умолчанию 5)')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Размер пачки, передаваемый команде импорта')
+        parser.add_argument('--workers', type=int, default=1, help='Число процессов разбора строк, передаваемое команде импорта')
+        parser.add_argument('--bulk-load', action='store_true', help='Импортировать в режиме массовой загрузки SQLite (--bulk-load команды импорта)')
+
+    def handle(self, *args, **options):
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.heartbeat_interval = getattr(settings, 'IMPORT_WORKER_HEARTBEAT_INTERVAL', 10)
+        self.stale_after = getattr(settings, 'IMPORT_WORKER_STALE_AFTER', 120)
+        self.max_attempts = getattr(settings, 'IMPORT_WORKER_MAX_ATTEMPTS', 3)
+        self.cancel_grace = getattr(settings, 'IMPORT_WORKER_CANCEL_GRACE', 15)
+        self.batch_size = options['batch_size']
+        self.parse_workers = options['workers']
+        self.bulk_load = options['bulk_load']
+        poll_interval = max(options['poll_interval'], 1)
+
+        self.stdout.write(f'👷 Воркер импорта {self.worker_id} запущен')
+        logger.info(f"Воркер импорта {self.worker_id} запущен")
+        self.restore_indexes()
+        try:
+            while True:
+                requeued, failed = ImportFile.recover_stale(self.stale_after, self.max_attempts)
+                if requeued or failed:
+                    self.stdout.write(self.style.WARNING(f'♻️ Упавшие импорты: возвращено в очередь {requeued}, ошибок {failed}'))
+                    logger.warning(f"Восстановление упавших импортов: в очередь={requeued}, ошибок={failed}")
+
+                job = ImportFile.claim_next(self.worker_id)
+                if job is not None:
+                    self.run_job(job)
+                    continue
+                if options['once']:
+                    break
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            self.stdout.write('⏹️ Воркер остановлен')
+
+    def build_command(self, job):
+        """Команда импорта для файла; если есть контрольная точка, импорт продолжается с нее"""
+        command = 'import_dbf' if job.is_dbf_file else 'import_products_new'
+        args = [
+            sys.executable, '-m', 'django', command, job.file.path,
+            '--settings', settings.SETTINGS_MODULE,
+            '--import-file-id', str(job.pk),
+            '--batch-size', str(self.batch_size),
+            '--disable-transactions',
+        ]
+        if self.parse_workers > 1:
+            args += ['--workers', str(self.parse_workers)]
+        if self.bulk_load:
+            args.append('--bulk-load')
+        if job.committed_row:
+            args.append('--resume')
+        return args
+
+    def restore_indexes(self):
+        """Строит индексы, оставшиеся снятыми после упавшего импорта с --bulk-load"""
+        restored = restore_deferred_indexes()
+        if restored:
+            self.stdout.write(self.style.WARNING(f'🧱 Восстановлены индексы после упавшего импорта: {", ".join(restored)}'))
+            logger.warning(f"Восстановлены индексы после упавшего импорта: {restored}")
+
+    def run_job(self, job):
+        args = self.build_command(job)
+        self.stdout.write(f'▶️ Импорт #{job.pk} {job.original_filename} (попытка {job.attempts})')
+        logger.info(f"Воркер {self.worker_id}: импорт #{job.pk}, попытка {job.attempts}, команда: {' '.join(args[3:])}")
+
+        process = subprocess.Popen(args, cwd=str(settings.BASE_DIR))
+        while True:
+            try:
+                returncode = process.wait(timeout=self.heartbeat_interval)
+                break
+            except subprocess.TimeoutExpired:
+                pass
+            if not ImportFile.heartbeat(job.pk, self.worker_id):
+                # Импорт отменен в админке (или передан другому воркеру)
+                self.stdout.write(f'⏹️ Импорт #{job.pk} отменен, останавливаем процесс')
+                logger.info(f"Импорт #{job.pk} отменен, процесс импорта остановлен")
+                # Сначала просим команду остановиться самой (она проверяет отмену
+                # по файлу канала прогресса), и только потом завершаем процесс
+                request_cancel(job.pk)
+                try:
+                    process.wait(timeout=self.cancel_grace)
+                except subprocess.TimeoutExpired:
+                    process.terminate()
+                    try:
+                        process.wait(timeout=30)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                        process.wait()
+                self.restore_indexes()
+                return
+
+        job.refresh_from_db()
+        if job.status == 'processing':
+            # Процесс импорта завершился, не записав итог (упал или был убит)
+            reason = f'Процесс импорта завершился с кодом {returncode}'
+            requeued, _ = ImportFile.requeue_or_fail(
+                ImportFile.objects.filter(pk=job.pk, worker_id=self.worker_id), self.max_attempts, reason
+            )
+            self.stdout.write(self.style.ERROR(f'❌ {reason}' + (', импорт возвращен в очередь' if requeued else '')))
+            logger.error(f"Импорт #{job.pk}: {reason}, возвращен в очередь: {bool(requeued)}")
+            self.restore_indexes()
+        else:
+            self.stdout.write(f'🏁 Импорт #{job.pk} завершен со статусом {job.status}')
+            logger.info(f"Импорт #{job.pk} завершен со статусом {job.status}")
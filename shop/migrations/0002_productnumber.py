@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:09
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+NUMBER_FIELDS = ('code', 'tmp_id', 'catalog_number', 'artikyl_number', 'cross_number')
+STRIP_RE = re.compile(r'[\s\-./\\]+')
+
+
+def normalize(value):
+    if not value:
+        return ''
+    return STRIP_RE.sub('', str(value)).upper()[:100]
+
+
+def fill_product_numbers(apps, schema_editor):
+    """Заполняет индекс номеров для уже существующих товаров"""
+    Product = apps.get_model('shop', 'Product')
+    OeKod = apps.get_model('shop', 'OeKod')
+    ProductNumber = apps.get_model('shop', 'ProductNumber')
+
+    numbers = {}
+    for row in Product.objects.values_list('id', *NUMBER_FIELDS).iterator(chunk_size=5000):
+        numbers[row[0]] = {normalize(value) for value in row[1:]}
+    for product_id, oe_kod in OeKod.objects.values_list('product_id', 'oe_kod').iterator(chunk_size=5000):
+        numbers.setdefault(product_id, set()).add(normalize(oe_kod))
+
+    ProductNumber.objects.bulk_create(
+        (
+            ProductNumber(product_id=product_id, number=number)
+            for product_id, product_numbers in numbers.items()
+            for number in product_numbers
+            if number
+        ),
+        batch_size=5000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='importfile',
+            name='file',
+            field=models.FileField(upload_to='imports/', verbose_name='Файл импорта (CSV/DBF)'),
+        ),
+        migrations.CreateModel(
+            name='ProductNumber',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(max_length=100, verbose_name='Нормализованный номер')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='numbers', to='shop.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Номер товара',
+                'verbose_name_plural': 'Номера товаров',
+                'indexes': [models.Index(fields=['number', 'product'], name='shop_produc_number_ad74cb_idx')],
+            },
+        ),
+        migrations.RunPython(fill_product_numbers, migrations.RunPython.noop),
+    ]
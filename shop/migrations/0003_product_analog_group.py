@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0002_productnumber'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='analog_group',
+            field=models.BigIntegerField(blank=True, db_index=True, editable=False, null=True, verbose_name='Группа аналогов'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, OperationalError
+
+
+FTS_TABLE = 'shop_product_fts'
+
+
+def create_fts_table(apps, schema_editor):
+    """Создает таблицу FTS5 и индексирует существующие товары (только SQLite с FTS5)"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            "name, brand, description, applicability, "
+            "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4')"
+        )
+    except OperationalError:
+        # SQLite собран без FTS5 - поиск будет работать через icontains
+        return
+    schema_editor.execute(
+        f"INSERT INTO {FTS_TABLE} (rowid, name, brand, description, applicability) "
+        "SELECT p.id, "
+        "REPLACE(REPLACE(p.name, 'ё', 'е'), 'Ё', 'Е'), "
+        "REPLACE(REPLACE(COALESCE(b.name, ''), 'ё', 'е'), 'Ё', 'Е'), "
+        "REPLACE(REPLACE(p.description, 'ё', 'е'), 'Ё', 'Е'), "
+        "REPLACE(REPLACE(p.applicability, 'ё', 'е'), 'Ё', 'Е') "
+        "FROM shop_product p LEFT JOIN shop_brand b ON b.id = p.brand_id"
+    )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0003_product_analog_group'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:20
+
+from django.db import migrations, models
+
+
+def fill_root_sections(apps, schema_editor):
+    Category = apps.get_model('shop', 'Category')
+    Product = apps.get_model('shop', 'Product')
+
+    categories = list(Category.objects.only('id', 'parent_id', 'slug'))
+    categories_by_id = {category.id: category for category in categories}
+    for category in categories:
+        root, depth, visited = category, 0, {category.id}
+        while root.parent_id in categories_by_id and root.parent_id not in visited:
+            root = categories_by_id[root.parent_id]
+            visited.add(root.id)
+            depth += 1
+        category.root_section = root.slug
+        category.depth = depth
+    Category.objects.bulk_update(categories, ['root_section', 'depth'], batch_size=500)
+
+    Product.objects.update(root_section=models.Subquery(
+        Category.objects.filter(pk=models.OuterRef('category_id')).values('root_section')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_product_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='depth',
+            field=models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Уровень вложенности'),
+        ),
+        migrations.AddField(
+            model_name='category',
+            name='root_section',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=50, verbose_name='Корневой раздел'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='root_section',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=50, verbose_name='Корневой раздел'),
+        ),
+        migrations.RunPython(fill_root_sections, migrations.RunPython.noop),
+    ]
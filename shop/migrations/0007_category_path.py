@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:21
+
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    Category = apps.get_model('shop', 'Category')
+
+    categories = list(Category.objects.only('id', 'parent_id'))
+    categories_by_id = {category.id: category for category in categories}
+    for category in categories:
+        root, chain = category, [category.id]
+        while root.parent_id in categories_by_id and root.parent_id not in chain:
+            root = categories_by_id[root.parent_id]
+            chain.append(root.id)
+        category.path = '/' + ''.join(f'{category_id}/' for category_id in reversed(chain))
+    Category.objects.bulk_update(categories, ['path'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0006_category_root_section'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255, verbose_name='Путь в дереве'),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:23
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def prepare_tmp_ids(apps, schema_editor):
+    """Пустые tmp_id -> NULL, повторяющиеся (кроме самого старого товара) получают суффикс -dupN"""
+    Product = apps.get_model('shop', 'Product')
+
+    Product.objects.filter(tmp_id='').update(tmp_id=None)
+
+    taken = set(Product.objects.exclude(tmp_id=None).values_list('tmp_id', flat=True))
+    duplicates = (
+        Product.objects.exclude(tmp_id=None)
+        .values('tmp_id').annotate(total=Count('id')).filter(total__gt=1)
+        .values_list('tmp_id', flat=True)
+    )
+    for tmp_id in list(duplicates):
+        product_ids = list(Product.objects.filter(tmp_id=tmp_id).order_by('id').values_list('id', flat=True))
+        counter = 1
+        for product_id in product_ids[1:]:
+            while f'{tmp_id}-dup{counter}' in taken:
+                counter += 1
+            new_tmp_id = f'{tmp_id}-dup{counter}'
+            taken.add(new_tmp_id)
+            Product.objects.filter(id=product_id).update(tmp_id=new_tmp_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_category_path'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='tmp_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True, verbose_name='ID в 1С'),
+        ),
+        migrations.RunPython(prepare_tmp_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='product',
+            name='tmp_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True, verbose_name='ID в 1С'),
+        ),
+    ]
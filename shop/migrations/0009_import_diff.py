@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_product_tmp_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importfile',
+            name='removed_products',
+            field=models.IntegerField(default=0, verbose_name='Пропало из выгрузки'),
+        ),
+        migrations.AddField(
+            model_name='importfile',
+            name='unchanged_products',
+            field=models.IntegerField(default=0, verbose_name='Товаров без изменений'),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='import_hash',
+            field=models.CharField(blank=True, editable=False, max_length=32, verbose_name='Хэш данных импорта'),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_import_diff'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importfile',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0, verbose_name='Попыток запуска'),
+        ),
+        migrations.AddField(
+            model_name='importfile',
+            name='committed_row',
+            field=models.IntegerField(default=0, verbose_name='Последняя сохраненная строка'),
+        ),
+        migrations.AddField(
+            model_name='importfile',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Последний сигнал воркера'),
+        ),
+        migrations.AddField(
+            model_name='importfile',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Поставлен в очередь'),
+        ),
+        migrations.AddField(
+            model_name='importfile',
+            name='worker_id',
+            field=models.CharField(blank=True, max_length=100, verbose_name='Воркер'),
+        ),
+        migrations.AlterField(
+            model_name='importfile',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Ожидает'), ('queued', 'В очереди'), ('processing', 'Обрабатывается'), ('completed', 'Завершен'), ('failed', 'Ошибка'), ('cancelled', 'Отменен')], default='pending', max_length=50, verbose_name='Статус'),
+        ),
+    ]
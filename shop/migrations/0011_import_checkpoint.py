@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_import_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importfile',
+            name='checkpoint',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Контрольная точка'),
+        ),
+        migrations.AddField(
+            model_name='importfile',
+            name='file_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, verbose_name='Хэш файла'),
+        ),
+    ]
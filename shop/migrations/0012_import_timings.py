@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 19:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_import_checkpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importfile',
+            name='batch_timings',
+            field=models.JSONField(blank=True, default=list, editable=False, verbose_name='Замеры по пачкам'),
+        ),
+        migrations.AddField(
+            model_name='importfile',
+            name='phase_timings',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Время этапов, сек'),
+        ),
+        migrations.AddField(
+            model_name='importfile',
+            name='started_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Начало импорта'),
+        ),
+    ]
@@ -1,5 +1,8 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Exists, F, Q
 from django.urls import reverse
+from collections import defaultdict
+import hashlib
 import re
 
 
@@ -11,6 +14,12 @@ class Category(models.Model):
     image = models.ImageField(upload_to='categories/', blank=True, verbose_name='Изображение')
     is_active = models.BooleanField(default=True, verbose_name='Активна')
     order = models.PositiveIntegerField(default=0, verbose_name='Порядок сортировки')
+    # Денормализованные поля дерева, пересчитываются в save() и rebuild_tree_fields()
+    root_section = models.CharField(max_length=50, blank=True, db_index=True, editable=False, verbose_name='Корневой раздел')
+    depth = models.PositiveSmallIntegerField(default=0, editable=False, verbose_name='Уровень вложенности')
+    # Материализованный путь из id предков и самой категории: "/3/17/42/".
+    # Поддерево - все категории, чей path начинается с path корня поддерева
+    path = models.CharField(max_length=255, blank=True, db_index=True, editable=False, verbose_name='Путь в дереве')
     
     class Meta:
         verbose_name = 'Категория'
@@ -25,25 +34,97 @@ class Category(models.Model):
     def get_absolute_url(self):
         return reverse('shop:category', kwargs={'slug': self.slug})
     
-    @property
-    def level(self):
-        """Уровень вложенности категории с защитой от рекурсии"""
-        if not self.parent:
-            return 0
+    def save(self, *args, **kwargs):
+        previous = None
+        if self.pk:
+            previous = Category.objects.filter(pk=self.pk).values('parent_id', 'slug').first()
+        
+        # SECTION_ID корневой категории хранится в ее slug
+        if self.parent_id:
+            parent = self.parent
+            self.root_section = parent.root_section or parent.slug
+            self.depth = parent.depth + 1
+            parent_path = parent.path or f'/{parent.pk}/'
+        else:
+            self.root_section = self.slug
+            self.depth = 0
+            parent_path = '/'
+        if self.pk:
+            self.path = f'{parent_path}{self.pk}/'
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'root_section', 'depth', 'path'}
+        super().save(*args, **kwargs)
         
-        # Защита от циклов - максимум 5 уровней
-        visited = set()
-        current = self
-        level = 0
+        # У новой категории id появляется только после вставки
+        if self.path != f'{parent_path}{self.pk}/':
+            self.path = f'{parent_path}{self.pk}/'
+            Category.objects.filter(pk=self.pk).update(path=self.path)
         
-        while current.parent and current.id not in visited:
-            visited.add(current.id)
-            current = current.parent
-            level += 1
-            if level > 5:  # Максимум 5 уровней
-                break
-                
-        return level
+        # Перенос в другую ветку или смена slug меняет поля всего поддерева и его товаров
+        if previous and (previous['parent_id'] != self.parent_id or previous['slug'] != self.slug):
+            Product.objects.filter(category=self).update(root_section=self.root_section)
+            Category.rebuild_tree_fields()
+    
+    @classmethod
+    def rebuild_tree_fields(cls):
+        """
+        Пересчитывает root_section, depth и path всех категорий (дерево
+        собирается в памяти одним запросом) и root_section товаров измененных
+        категорий. Возвращает количество измененных категорий
+        """
+        categories = list(cls.objects.only('id', 'parent_id', 'slug', 'root_section', 'depth', 'path'))
+        categories_by_id = {category.id: category for category in categories}
+        
+        changed = []
+        for category in categories:
+            root, chain = category, [category.id]
+            # Защита от циклов: родитель, уже встреченный на пути, считается корнем
+            while root.parent_id in categories_by_id and root.parent_id not in chain:
+                root = categories_by_id[root.parent_id]
+                chain.append(root.id)
+            path = '/' + ''.join(f'{category_id}/' for category_id in reversed(chain))
+            depth = len(chain) - 1
+            if (category.root_section, category.depth, category.path) != (root.slug, depth, path):
+                section_changed = category.root_section != root.slug
+                category.root_section, category.depth, category.path = root.slug, depth, path
+                changed.append((category, section_changed))
+        
+        with transaction.atomic():
+            cls.objects.bulk_update([category for category, _ in changed], ['root_section', 'depth', 'path'], batch_size=500)
+            by_section = defaultdict(list)
+            for category, section_changed in changed:
+                if section_changed:
+                    by_section[category.root_section].append(category.id)
+            for root_section, category_ids in by_section.items():
+                Product.objects.filter(category_id__in=category_ids).update(root_section=root_section)
+        return len(changed)
+    
+    @classmethod
+    def subtree_q(cls, slugs, field='category'):
+        """
+        Q для товаров (или других моделей с FK на категорию) из поддеревьев
+        категорий с указанными slug, вместе с самими категориями. Подзапрос
+        выбирает id категорий, чей path начинается с path выбранных, а товары
+        отбираются по индексу внешнего ключа
+        """
+        subtree_roots = cls.objects.filter(
+            models.lookups.StartsWith(models.OuterRef('path'), models.F('path')),
+            slug__in=slugs,
+        )
+        return Q(**{f'{field}__in': cls.objects.filter(models.Exists(subtree_roots)).values('pk')})
+    
+    def get_descendants(self, include_self=False):
+        """Все категории поддерева одним запросом по индексу path"""
+        queryset = Category.objects.filter(path__startswith=self.path)
+        if not include_self:
+            queryset = queryset.exclude(pk=self.pk)
+        return queryset
+    
+    @property
+    def level(self):
+        """Уровень вложенности категории"""
+        return self.depth
 
 
 class SubCategory(models.Model):
@@ -84,7 +165,9 @@ class Brand(models.Model):
 
 
 class Product(models.Model):
-    tmp_id = models.CharField(max_length=100, blank=True, verbose_name='ID в 1С', db_index=True)
+    # Ключ товара в выгрузках 1С: импорт обновляет товар с тем же tmp_id (upsert).
+    # NULL у товаров, заведенных вручную - уникальность на них не распространяется
+    tmp_id = models.CharField(max_length=100, blank=True, null=True, unique=True, verbose_name='ID в 1С')
     name = models.CharField(max_length=200, verbose_name='Название')
     slug = models.SlugField(unique=True, verbose_name='URL')
     category = models.ForeignKey(Category, on_delete=models.CASCADE, verbose_name='Категория')
@@ -101,6 +184,11 @@ class Product(models.Model):
     in_stock = models.BooleanField(default=True, verbose_name='В наличии')
     is_featured = models.BooleanField(default=False, verbose_name='Популярный товар')
     is_new = models.BooleanField(default=False, verbose_name='Новый товар')
+    analog_group = models.BigIntegerField(null=True, blank=True, db_index=True, editable=False, verbose_name='Группа аналогов')
+    # Хэш полей из выгрузки 1С (IMPORT_HASH_FIELDS) на момент последнего импорта
+    import_hash = models.CharField(max_length=32, blank=True, editable=False, verbose_name='Хэш данных импорта')
+    # SECTION_ID корневой категории (копия Category.root_section) - для пути к изображению и фильтра по разделу
+    root_section = models.CharField(max_length=50, blank=True, db_index=True, editable=False, verbose_name='Корневой раздел')
     created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')
     updated_at = models.DateTimeField(auto_now=True, verbose_name='Дата обновления')
     
@@ -108,6 +196,12 @@ class Product(models.Model):
         verbose_name = 'Товар'
         verbose_name_plural = 'Товары'
         ordering = ['-created_at']
+        # Составные индексы под сортировки каталога и keyset-пагинацию
+        indexes = [
+            models.Index(fields=['in_stock', 'created_at', 'id'], name='product_stock_created_idx'),
+            models.Index(fields=['in_stock', 'price', 'id'], name='product_stock_price_idx'),
+            models.Index(fields=['in_stock', 'name', 'id'], name='product_stock_name_idx'),
+        ]
     
     def __str__(self):
         return self.name
@@ -115,36 +209,164 @@ class Product(models.Model):
     def get_absolute_url(self):
         return reverse('shop:product', kwargs={'slug': self.slug})
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Номера на момент загрузки - save() перестраивает индекс номеров и
+        # группы аналогов, только если они изменились
+        loaded = dict(zip(field_names, values))
+        if all(field in loaded for field in ProductNumber.NUMBER_FIELDS):
+            instance._loaded_numbers = {field: loaded[field] for field in ProductNumber.NUMBER_FIELDS}
+        return instance
+    
+    def _numbers_changed(self):
+        loaded = getattr(self, '_loaded_numbers', None)
+        return loaded is None or any(getattr(self, field) != value for field, value in loaded.items())
+    
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self.category_id and (update_fields is None or 'category' in update_fields):
+            self.root_section = self.category.root_section
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | {'root_section'}
+        numbers_changed = self._numbers_changed()
+        super().save(*args, **kwargs)
+        # Поддерживаем индекс номеров в актуальном состоянии (правка цены или
+        # флагов витрины группы аналогов не пересчитывает)
+        update_fields = kwargs.get('update_fields')
+        if numbers_changed and (update_fields is None or set(update_fields) & set(ProductNumber.NUMBER_FIELDS)):
+            from .analogs import update_analog_groups
+            ProductNumber.rebuild_for([self.pk])
+            update_analog_groups([self.pk])
+            self._loaded_numbers = {field: getattr(self, field) for field in ProductNumber.NUMBER_FIELDS}
+    
+    def delete(self, *args, **kwargs):
+        from .analogs import update_analog_groups
+        from .catalog_cache import bump_catalog_version
+        from . import fts
+        # Удаление товара может разбить его группу аналогов
+        group_members = []
+        if self.analog_group:
+            group_members = list(Product.objects.filter(analog_group=self.analog_group).exclude(pk=self.pk).values_list('pk', flat=True))
+        product_id = self.pk
+        result = super().delete(*args, **kwargs)
+        update_analog_groups(group_members)
+        fts.remove_products([product_id])
+        bump_catalog_version()
+        return result
+    
     @property
     def discount_percent(self):
         if self.old_price and self.old_price > self.price:
             return int(((self.old_price - self.price) / self.old_price) * 100)
         return 0
     
+    # Поля, которые импорт из 1С обновляет у существующих товаров. slug не
+    # меняется (URL товара стабилен), цена и флаги витрины ведутся на сайте
+    IMPORT_UPDATE_FIELDS = (
+        'name', 'category', 'brand', 'code', 'catalog_number', 'cross_number',
+        'artikyl_number', 'applicability', 'in_stock',
+    )
+    
+    # Поля, по которым считается import_hash (наличие учитывается отдельно)
+    IMPORT_HASH_FIELDS = tuple(field for field in IMPORT_UPDATE_FIELDS if field != 'in_stock')
+    
+    @staticmethod
+    def hash_import_values(*values):
+        """md5 значений полей в порядке IMPORT_HASH_FIELDS (используется и в SQL загрузки через staging)"""
+        data = '\x1f'.join('' if value is None else str(value) for value in values)
+        return hashlib.md5(data.encode('utf-8')).hexdigest()
+    
+    def compute_import_hash(self):
+        """Хэш значений IMPORT_HASH_FIELDS - по нему импорт определяет, изменилась ли строка"""
+        return self.hash_import_values(*(getattr(self, self._meta.get_field(field).attname) for field in self.IMPORT_HASH_FIELDS))
+    
+    @classmethod
+    def upsert_by_tmp_id(cls, products, batch_size=1000):
+        """
+        Сохраняет товары из импорта одним INSERT ... ON CONFLICT (tmp_id) DO UPDATE.
+        Строки, у которых совпадает import_hash и наличие, не записываются.
+        При повторе tmp_id в пачке побеждает последняя строка.
+        Возвращает списки tmp_id: (созданные, обновленные, без изменений)
+        """
+        by_tmp_id = {}
+        for product in products:
+            product.import_hash = product.compute_import_hash()
+            by_tmp_id[product.tmp_id] = product
+        
+        tmp_ids = list(by_tmp_id)
+        existing = {}
+        for start in range(0, len(tmp_ids), 500):
+            rows = cls.objects.filter(tmp_id__in=tmp_ids[start:start + 500]).values_list('tmp_id', 'import_hash', 'in_stock')
+            for tmp_id, import_hash, in_stock in rows:
+                existing[tmp_id] = (import_hash, in_stock)
+        
+        created, updated, unchanged, to_save = [], [], [], []
+        for tmp_id, product in by_tmp_id.items():
+            if tmp_id not in existing:
+                created.append(tmp_id)
+            elif existing[tmp_id] != (product.import_hash, product.in_stock):
+                updated.append(tmp_id)
+            else:
+                unchanged.append(tmp_id)
+                continue
+            to_save.append(product)
+        
+        if to_save:
+            # Точка сохранения: при ошибке откатывается только эта пачка, и
+            # импорт может повторить ее по одному товару
+            with transaction.atomic():
+                cls.objects.bulk_create(
+                    to_save,
+                    batch_size=batch_size,
+                    update_conflicts=True,
+                    unique_fields=['tmp_id'],
+                    update_fields=[*cls.IMPORT_UPDATE_FIELDS, 'import_hash', 'updated_at'],
+                )
+        return created, updated, unchanged
+    
+    @classmethod
+    def find_disappeared(cls, seen_tmp_ids, mark_out_of_stock=False, chunk_size=1000):
+        """
+        Товары из 1С (с tmp_id), которые есть в наличии, но отсутствуют в
+        последней выгрузке. С mark_out_of_stock снимает их с наличия.
+        Возвращает список tmp_id пропавших товаров
+        """
+        disappeared = [
+            tmp_id for tmp_id in
+            cls.objects.exclude(tmp_id=None).filter(in_stock=True).values_list('tmp_id', flat=True).iterator(chunk_size=5000)
+            if tmp_id not in seen_tmp_ids
+        ]
+        if mark_out_of_stock:
+            for start in range(0, len(disappeared), chunk_size):
+                cls.objects.filter(tmp_id__in=disappeared[start:start + chunk_size]).update(in_stock=False)
+        return disappeared
+    
+    @classmethod
+    def update_root_sections(cls, values, field='id', chunk_size=500):
+        """Копирует root_section из категории товарам, отобранным по значениям поля (после импорта)"""
+        root_section = models.Subquery(
+            Category.objects.filter(pk=models.OuterRef('category_id')).values('root_section')[:1]
+        )
+        values = [value for value in values if value]
+        for start in range(0, len(values), chunk_size):
+            cls.objects.filter(**{f'{field}__in': values[start:start + chunk_size]}).update(root_section=root_section)
+    
     @property
     def main_image_path(self):
         """Возвращает путь к главному изображению по структуре section_id/tmp_id"""
-        if self.category and self.tmp_id:
-            # Получаем SECTION_ID из родительской категории или самой категории
-            root_category = self.category
-            while root_category.parent:
-                root_category = root_category.parent
-            
-            # SECTION_ID теперь хранится прямо в slug без префикса
-            section_id = root_category.slug
-            return f'{section_id}/{self.tmp_id}.jpg'
+        # SECTION_ID корневой категории хранится в самом товаре - без запросов к категориям
+        if self.root_section and self.tmp_id:
+            return f'{self.root_section}/{self.tmp_id}.jpg'
         return None
     
     @property  
     def has_main_image(self):
-        """Проверяет существование главного изображения"""
-        if self.main_image_path:
-            import os
-            from django.conf import settings
-            
-            # Проверяем существование файла
-            full_path = os.path.join(settings.BASE_DIR, 'images', self.main_image_path)
-            return os.path.exists(full_path)
+        """Проверяет существование главного изображения по манифесту (без обращения к диску)"""
+        main_image_path = self.main_image_path
+        if main_image_path:
+            from .image_manifest import has_image
+            return has_image(main_image_path)
         return False
     
     @property
@@ -183,6 +405,18 @@ class ProductAnalog(models.Model):
     
     def __str__(self):
         return f"{self.product.name} -> {self.analog_product.name}"
+    
+    def save(self, *args, **kwargs):
+        from .analogs import update_analog_groups
+        super().save(*args, **kwargs)
+        update_analog_groups([self.product_id, self.analog_product_id])
+    
+    def delete(self, *args, **kwargs):
+        from .analogs import update_analog_groups
+        product_ids = [self.product_id, self.analog_product_id]
+        result = super().delete(*args, **kwargs)
+        update_analog_groups(product_ids)
+        return result
 
 
 class OeKod(models.Model):
@@ -202,6 +436,20 @@ class OeKod(models.Model):
     def __str__(self):
         return f"{self.product.name} -> {self.oe_kod}"
     
+    def save(self, *args, **kwargs):
+        from .analogs import update_analog_groups
+        super().save(*args, **kwargs)
+        ProductNumber.rebuild_for([self.product_id])
+        update_analog_groups([self.product_id])
+    
+    def delete(self, *args, **kwargs):
+        from .analogs import update_analog_groups
+        product_id = self.product_id
+        result = super().delete(*args, **kwargs)
+        ProductNumber.rebuild_for([product_id])
+        update_analog_groups([product_id])
+        return result
+    
     @classmethod
     def is_number_search(cls, search_term):
         """Определяет является ли поисковый запрос номером детали"""
@@ -228,6 +476,69 @@ class OeKod(models.Model):
         return False
 
 
+class ProductNumber(models.Model):
+    """Нормализованные номера товара для поиска по индексу"""
+    # Поля товара, номера из которых попадают в индекс (плюс номера OE)
+    NUMBER_FIELDS = ('code', 'tmp_id', 'catalog_number', 'artikyl_number', 'cross_number')
+    # Символы, которые не учитываются при сравнении номеров
+    STRIP_RE = re.compile(r'[\s\-./\\]+')
+    
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='numbers', verbose_name='Товар')
+    number = models.CharField(max_length=100, verbose_name='Нормализованный номер')
+    
+    class Meta:
+        verbose_name = 'Номер товара'
+        verbose_name_plural = 'Номера товаров'
+        indexes = [
+            models.Index(fields=['number', 'product']),
+        ]
+    
+    def __str__(self):
+        return f"{self.product_id} -> {self.number}"
+    
+    @classmethod
+    def normalize(cls, value):
+        """Приводит номер к каноническому виду: верхний регистр, без пробелов, дефисов, точек и слешей"""
+        if not value:
+            return ''
+        return cls.STRIP_RE.sub('', str(value)).upper()[:100]
+    
+    @classmethod
+    def search_q(cls, search_term, prefix=False, field='numbers__number'):
+        """Q-объект для поиска по индексу номеров (точное совпадение или диапазон по префиксу)"""
+        term = cls.normalize(search_term)
+        if not term:
+            return Q(pk__in=[])
+        if prefix:
+            # Диапазон вместо LIKE, чтобы запрос всегда шел по индексу
+            return Q(**{f'{field}__gte': term, f'{field}__lt': term + '\uffff'})
+        return Q(**{field: term})
+    
+    @classmethod
+    def rebuild_for(cls, values, field='id', chunk_size=500):
+        """Пересобирает индекс номеров для товаров, отобранных по значениям поля (по умолчанию id)"""
+        values = [value for value in values if value]
+        for start in range(0, len(values), chunk_size):
+            chunk = values[start:start + chunk_size]
+            numbers = defaultdict(set)
+            
+            rows = Product.objects.filter(**{f'{field}__in': chunk}).values_list('id', *cls.NUMBER_FIELDS)
+            for row in rows:
+                numbers[row[0]].update(cls.normalize(value) for value in row[1:])
+            product_ids = list(numbers)
+            for product_id, oe_kod in OeKod.objects.filter(product_id__in=product_ids).values_list('product_id', 'oe_kod'):
+                numbers[product_id].add(cls.normalize(oe_kod))
+            
+            with transaction.atomic():
+                cls.objects.filter(product_id__in=product_ids).delete()
+                cls.objects.bulk_create([
+                    cls(product_id=product_id, number=number)
+                    for product_id, product_numbers in numbers.items()
+                    for number in product_numbers
+                    if number
+                ])
+
+
 class ImportFile(models.Model):
     """Модель для загрузки CSV и DBF файлов импорта"""
     file = models.FileField(upload_to='imports/', verbose_name='Файл импорта (CSV/DBF)')
@@ -240,6 +551,7 @@ class ImportFile(models.Model):
     status = models.CharField(max_length=50, default='pending', verbose_name='Статус',
                              choices=[
                                  ('pending', 'Ожидает'),
+                                 ('queued', 'В очереди'),
                                  ('processing', 'Обрабатывается'),
                                  ('completed', 'Завершен'),
                                  ('failed', 'Ошибка'),
@@ -250,6 +562,8 @@ class ImportFile(models.Model):
     processed_rows = models.IntegerField(default=0, verbose_name='Обработано строк')
     created_products = models.IntegerField(default=0, verbose_name='Создано товаров')
     updated_products = models.IntegerField(default=0, verbose_name='Обновлено товаров')
+    unchanged_products = models.IntegerField(default=0, verbose_name='Товаров без изменений')
+    removed_products = models.IntegerField(default=0, verbose_name='Пропало из выгрузки')
     error_count = models.IntegerField(default=0, verbose_name='Количество ошибок')
     error_log = models.TextField(blank=True, verbose_name='Лог ошибок')
     
@@ -257,6 +571,26 @@ class ImportFile(models.Model):
     cancelled = models.BooleanField(default=False, verbose_name='Отменен')
     cancelled_at = models.DateTimeField(null=True, blank=True, verbose_name='Дата отмены')
     
+    # Очередь фонового воркера (run_import_worker)
+    queued_at = models.DateTimeField(null=True, blank=True, verbose_name='Поставлен в очередь')
+    worker_id = models.CharField(max_length=100, blank=True, verbose_name='Воркер')
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='Последний сигнал воркера')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попыток запуска')
+    # Номер строки/записи, до которой товары гарантированно сохранены - с нее
+    # продолжается импорт после падения воркера
+    committed_row = models.IntegerField(default=0, verbose_name='Последняя сохраненная строка')
+    # Контрольная точка последней сохраненной пачки: байтовое смещение (CSV),
+    # processed_rows, error_count и счетчики товаров на тот момент
+    checkpoint = models.JSONField(default=dict, blank=True, editable=False, verbose_name='Контрольная точка')
+    # SHA-256 файла: продолжить импорт можно только того же самого файла
+    file_hash = models.CharField(max_length=64, blank=True, editable=False, verbose_name='Хэш файла')
+    
+    # Замеры импорта (shop.import_metrics): начало последнего запуска, время
+    # этапов в секундах и ряд по пачкам [строка, строк, разбор мс, разрешение мс, запись мс]
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Начало импорта')
+    phase_timings = models.JSONField(default=dict, blank=True, editable=False, verbose_name='Время этапов, сек')
+    batch_timings = models.JSONField(default=list, blank=True, editable=False, verbose_name='Замеры по пачкам')
+    
     # Прогресс в процентах
     @property
     def progress_percent(self):
@@ -268,30 +602,80 @@ class ImportFile(models.Model):
         except (ValueError, TypeError, ZeroDivisionError):
             return 0
     
-    # Скорость обработки
+    # Средняя скорость импорта, строк/сек: по суммарному времени этапов (с
+    # переносом из staging, аналогами и индексами), а до первой сохраненной
+    # пачки - по времени с начала импорта
     @property
     def processing_speed(self):
-        if not self.processed_at or self.status != 'processing':
-            return 0
-        try:
-            from django.utils import timezone
-            elapsed = (timezone.now() - self.uploaded_at).total_seconds()
-            if elapsed > 0:
-                return int(self.current_row / elapsed)
-            return 0
-        except (ValueError, TypeError, ZeroDivisionError):
+        from .import_metrics import batch_rate
+        elapsed = sum(self.phase_timings.values())
+        if elapsed and self.processed_rows:
+            return int(self.processed_rows / elapsed)
+        if self.batch_timings:
+            return int(batch_rate(self.batch_timings))
+        if not self.started_at:
             return 0
+        from django.utils import timezone
+        end = timezone.now() if self.status == 'processing' else (self.processed_at or timezone.now())
+        elapsed = (end - self.started_at).total_seconds()
+        return int(self.processed_rows / elapsed) if elapsed > 0 else 0
+    
+    # Текущая скорость, строк/сек: по последним пачкам
+    @property
+    def rows_per_sec(self):
+        from .import_metrics import ROLLING_BATCHES, batch_rate
+        return int(batch_rate(self.batch_timings[-ROLLING_BATCHES:]))
+    
+    # Оценка оставшегося времени импорта, сек (None - оценить нельзя)
+    @property
+    def eta_seconds(self):
+        rate = self.rows_per_sec
+        if self.status != 'processing' or not rate or not self.total_rows:
+            return None
+        return int(max(self.total_rows - self.current_row, 0) / rate)
     
+    @classmethod
+    def add_phase_timing(cls, pk, phase, seconds):
+        """Добавляет время этапа, замеренного вне команды импорта (например, построение индексов)"""
+        import_file = cls.objects.filter(pk=pk).only('phase_timings').first()
+        if import_file is None:
+            return
+        timings = dict(import_file.phase_timings)
+        timings[phase] = round(timings.get(phase, 0) + seconds, 3)
+        cls.objects.filter(pk=pk).update(phase_timings=timings)
+    
+    def apply_live_progress(self):
+        """
+        Подставляет свежие счетчики из канала прогресса (файла, который пишет
+        команда импорта) - в базе они обновляются лишь раз в несколько секунд
+        """
+        from .import_progress import COUNTER_FIELDS, read_progress
+        if self.status != 'processing':
+            return self
+        values = read_progress(self.pk) or {}
+        for field in COUNTER_FIELDS:
+            if field in values:
+                setattr(self, field, values[field])
+        return self
+    
+    # Статусы, в которых импорт можно отменить
+    CANCELLABLE_STATUSES = ('pending', 'queued', 'processing')
+
     # Можно ли отменить импорт
     @property
     def can_cancel(self):
-        return self.status in ['pending', 'processing'] and not self.cancelled
+        return self.status in self.CANCELLABLE_STATUSES and not self.cancelled
     
     # Можно ли запустить импорт
     @property
     def can_start(self):
         return self.status == 'pending' and not self.processed and not self.cancelled
     
+    # Можно ли продолжить прерванный импорт с контрольной точки
+    @property
+    def can_resume(self):
+        return self.status in ['failed', 'cancelled'] and self.committed_row > 0 and bool(self.file_hash)
+    
     class Meta:
         verbose_name = 'Импорт файл'
         verbose_name_plural = 'Импорт файлы'
@@ -300,6 +684,134 @@ class ImportFile(models.Model):
     def __str__(self):
         return f"{self.original_filename} ({self.uploaded_at})"
     
+    def enqueue(self, resume=False):
+        """
+        Ставит импорт в очередь фонового воркера. С resume контрольная точка
+        сохраняется, и воркер продолжит импорт после последней сохраненной пачки
+        """
+        from django.utils import timezone
+        from .import_progress import discard
+        fields = dict(
+            status='queued',
+            queued_at=timezone.now(),
+            processed=False,
+            cancelled=False,
+            cancelled_at=None,
+            worker_id='',
+            heartbeat_at=None,
+            attempts=0,
+            error_log='',
+        )
+        if not resume:
+            fields.update(committed_row=0, checkpoint={})
+        ImportFile.objects.filter(pk=self.pk).update(**fields)
+        # Запрос отмены от прошлого запуска не должен остановить новый
+        discard(self.pk)
+        self.refresh_from_db()
+    
+    def cancel(self):
+        """
+        Отменяет импорт. Записываются только поля отмены: счетчики и
+        контрольную точку в этой записи ведет работающая команда импорта.
+        Команда узнает об отмене по файлу канала прогресса. False - импорт
+        уже нельзя отменить
+        """
+        from django.utils import timezone
+        from .import_progress import request_cancel
+        cancelled = ImportFile.objects.filter(
+            pk=self.pk, status__in=self.CANCELLABLE_STATUSES, cancelled=False,
+        ).update(cancelled=True, cancelled_at=timezone.now(), status='cancelled')
+        if cancelled:
+            request_cancel(self.pk)
+        self.refresh_from_db()
+        return bool(cancelled)
+    
+    @staticmethod
+    def compute_file_hash(path, chunk_size=1024 * 1024):
+        """SHA-256 содержимого файла (читается блоками, память не зависит от размера)"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    @classmethod
+    def claim_next(cls, worker_id):
+        """
+        Забирает самый старый импорт из очереди и переводит его в processing.
+        Импорт берется только если никакой другой не выполняется: проверка и
+        захват - один условный UPDATE, поэтому два воркера не возьмут работу
+        одновременно. Возвращает ImportFile или None
+        """
+        from django.utils import timezone
+        with transaction.atomic():
+            job = (
+                cls.objects.select_for_update(skip_locked=True)
+                .filter(status='queued', cancelled=False)
+                .order_by('queued_at', 'id')
+                .first()
+            )
+            if job is None:
+                return None
+            claimed = cls.objects.filter(pk=job.pk, status='queued').filter(
+                ~Exists(cls.objects.filter(status='processing'))
+            ).update(
+                status='processing',
+                worker_id=worker_id,
+                heartbeat_at=timezone.now(),
+                attempts=F('attempts') + 1,
+            )
+        if not claimed:
+            return None
+        job.refresh_from_db()
+        return job
+    
+    @classmethod
+    def heartbeat(cls, pk, worker_id):
+        """
+        Отметка воркера. False - импорт отменен или передан другому воркеру.
+        Импорт, для которого команда уже записала итог (completed/failed), но
+        еще выполняет завершающие этапы, не отменен: True, воркер ждет выхода процесса
+        """
+        from django.utils import timezone
+        if cls.objects.filter(pk=pk, worker_id=worker_id, status='processing', cancelled=False).update(
+            heartbeat_at=timezone.now()
+        ):
+            return True
+        return cls.objects.filter(pk=pk, worker_id=worker_id, cancelled=False).exclude(status='cancelled').exists()
+    
+    @classmethod
+    def requeue_or_fail(cls, queryset, max_attempts, reason):
+        """
+        Возвращает упавшие импорты в очередь (продолжение с committed_row),
+        а исчерпавшие попытки помечает ошибкой. Возвращает (в очереди, ошибок)
+        """
+        from django.utils import timezone
+        failed = queryset.filter(attempts__gte=max_attempts).update(
+            status='failed',
+            worker_id='',
+            heartbeat_at=None,
+            error_log=f'{reason}. Исчерпано попыток запуска: {max_attempts}',
+        )
+        requeued = queryset.filter(attempts__lt=max_attempts).update(
+            status='queued',
+            queued_at=timezone.now(),
+            worker_id='',
+            heartbeat_at=None,
+        )
+        return requeued, failed
+    
+    @classmethod
+    def recover_stale(cls, stale_after, max_attempts):
+        """Импорты воркеров, переставших отправлять heartbeat дольше stale_after секунд"""
+        from datetime import timedelta
+        from django.utils import timezone
+        stale = cls.objects.filter(
+            status='processing',
+            heartbeat_at__lt=timezone.now() - timedelta(seconds=stale_after),
+        ).exclude(worker_id='')
+        return cls.requeue_or_fail(stale, max_attempts, 'Воркер импорта перестал отвечать')
+    
     @property
     def is_dbf_file(self):
         """Проверяет, является ли файл DBF файлом"""
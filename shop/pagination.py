@@ -0,0 +1,81 @@
+"""
+Keyset (seek) пагинация каталога.
+
+Вместо OFFSET следующая страница выбирается условием "после последнего
+товара предыдущей страницы" по составному ключу (поле сортировки, id),
+который покрывается индексом. Курсор передается в параметре after= в виде
+подписанного токена, поэтому страница 3000 стоит столько же, сколько первая.
+"""
+from datetime import datetime
+from decimal import Decimal
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db.models import Q
+
+# Сортировки каталога и их ключи; id - уникальный "тай-брейк"
+KEYSET_ORDERINGS = {
+    'newest': ('-created_at', '-id'),
+    'price_asc': ('price', 'id'),
+    'price_desc': ('-price', '-id'),
+    'name': ('name', 'id'),
+}
+
+_CURSOR_SALT = 'shop.catalog.cursor'
+
+_PARSERS = {
+    'created_at': datetime.fromisoformat,
+    'price': Decimal,
+    'name': str,
+}
+
+
+def _field_name(ordering):
+    return ordering[0].lstrip('-')
+
+
+def encode_cursor(sort, obj):
+    """Токен курсора, указывающий на товар obj в сортировке sort"""
+    field = _field_name(KEYSET_ORDERINGS[sort])
+    value = getattr(obj, field)
+    value = value.isoformat() if isinstance(value, datetime) else str(value)
+    return signing.dumps([sort, value, obj.pk], salt=_CURSOR_SALT, compress=True)
+
+
+def decode_cursor(token, sort):
+    """Возвращает (значение, id) из токена или None, если токен поврежден или от другой сортировки"""
+    try:
+        cursor_sort, value, pk = signing.loads(token, salt=_CURSOR_SALT)
+        if cursor_sort != sort:
+            return None
+        return _PARSERS[_field_name(KEYSET_ORDERINGS[sort])](value), int(pk)
+    except (signing.BadSignature, ValueError, TypeError, KeyError, ArithmeticError):
+        return None
+
+
+def keyset_q(sort, cursor):
+    """Условие "строго после курсора" для сортировки sort"""
+    field_ordering, _ = KEYSET_ORDERINGS[sort]
+    field = field_ordering.lstrip('-')
+    lookup = 'lt' if field_ordering.startswith('-') else 'gt'
+    value, pk = cursor
+    return Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': pk})
+
+
+def approximate_count(queryset):
+    """
+    Приблизительное общее количество товаров для keyset-режима: COUNT
+    кэшируется на CATALOG_APPROXIMATE_TOTAL_TTL секунд. Возвращает None, если выключено
+    """
+    ttl = getattr(settings, 'CATALOG_APPROXIMATE_TOTAL_TTL', 600)
+    if not ttl:
+        return None
+    try:
+        sql = str(queryset.query)
+    except EmptyResultSet:
+        return 0
+    key = 'catalog-count:' + hashlib.md5(sql.encode('utf-8')).hexdigest()
+    return cache.get_or_set(key, queryset.count, ttl)
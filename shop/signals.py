@@ -0,0 +1,47 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import fts
+from .db_tuning import configure_connection
+from .catalog_cache import bump_catalog_version
+from .models import Product, Brand, Category, OeKod, ProductAnalog
+
+
+# WAL и busy_timeout для каждого нового соединения с SQLite
+connection_created.connect(configure_connection, dispatch_uid='shop_configure_connection')
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, update_fields=None, **kwargs):
+    """Обновляет полнотекстовый индекс при сохранении товара"""
+    if update_fields is None or set(update_fields) & set(fts.INDEXED_FIELDS):
+        fts.index_products([instance.pk])
+
+
+@receiver(post_save, sender=Brand)
+def index_brand_products(sender, instance, created, **kwargs):
+    """Название бренда хранится в индексе товаров - переиндексируем товары бренда"""
+    if not created:
+        fts.index_products(list(instance.product_set.values_list('id', flat=True)))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+@receiver(post_save, sender=OeKod)
+@receiver(post_save, sender=ProductAnalog)
+@receiver(post_delete, sender=Brand)
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=OeKod)
+@receiver(post_delete, sender=ProductAnalog)
+def invalidate_catalog_cache(sender, **kwargs):
+    """Любое изменение данных каталога сбрасывает кэш результатов"""
+    bump_catalog_version()
+
+
+# Удаление товаров намеренно не обрабатывается сигналом: обработчик post_delete
+# заставил бы Django удалять товары по одному при массовой очистке. Записи
+# удаленных товаров отсекаются соединением с shop_product и удаляются при
+# пересборке индекса (rebuild_search_index). Кэш каталога при удалении
+# сбрасывает Product.delete() и команды импорта.
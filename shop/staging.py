@@ -0,0 +1,238 @@
+"""
+Загрузка импорта через промежуточную (staging) таблицу.
+
+Вместо построчного создания объектов Product импорт проходит три шага:
+
+1. Строки выгрузки как есть пачками (executemany) пишутся во временную
+   таблицу без индексов - это самая дешевая операция и она не трогает
+   каталог.
+2. Бренды, категории, id существующих товаров, import_hash и уникальность
+   slug новых товаров разрешаются запросами над всей таблицей сразу.
+3. Товары переносятся в shop_product одним INSERT ... ON CONFLICT (tmp_id)
+   DO UPDATE. Шаги 2-3 и пересборка индексов номеров/FTS выполняются в одной
+   транзакции: сайт видит либо старый каталог, либо полностью новый.
+
+Поддерживается только SQLite (как и FTS-поиск): хэш строк считается в SQL
+функцией, зарегистрированной на соединении. Для других баз команды импорта
+используют обычное сохранение пачками (Product.upsert_by_tmp_id).
+"""
+import logging
+
+from django.db import connection, transaction
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, Concat
+from django.utils import timezone
+
+from .models import Brand, Category, Product, ProductNumber
+from . import fts
+from .import_transform import brand_slug, category_slug
+
+logger = logging.getLogger(__name__)
+
+STAGING_TABLE = 'shop_import_staging'
+
+HASH_FUNCTION = 'shop_import_hash'
+
+# Колонки, которые заполняет команда импорта (остальные вычисляются при слиянии)
+ROW_COLUMNS = (
+    'line_num', 'tmp_id', 'name', 'slug', 'producer', 'section_id', 'code', 'catalog_number',
+    'cross_number', 'artikyl_number', 'applicability', 'in_stock',
+)
+
+# Сколько раз дополнять slug номером строки, если он все еще занят. Slug
+# импорта уникален вместе с TMP_ID (make_product_slug), так что занятым он
+# бывает только у товара, которому slug задали вручную
+SLUG_ROUNDS = 3
+
+
+def staging_available():
+    """Можно ли загружать через staging-таблицу на текущей базе"""
+    return connection.vendor == 'sqlite'
+
+
+class StagingLoader:
+    """
+    Загрузчик одного импорта: add() копит строки и пишет их в staging-таблицу
+    пачками, merge() разрешает ссылки и переносит товары в каталог
+    """
+
+    def __init__(self, batch_size=5000):
+        self.batch_size = batch_size
+        self.rows = []
+        self.loaded = 0
+
+    def create(self):
+        """Создает пустую временную таблицу (видна только текущему соединению)"""
+        connection.ensure_connection()
+        connection.connection.create_function(HASH_FUNCTION, -1, Product.hash_import_values, deterministic=True)
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS temp.{STAGING_TABLE}')
+            cursor.execute(
+                f'CREATE TEMP TABLE {STAGING_TABLE} ('
+                'line_num INTEGER, tmp_id TEXT, name TEXT, slug TEXT, producer TEXT, section_id TEXT, '
+                'code TEXT, catalog_number TEXT, cross_number TEXT, artikyl_number TEXT, applicability TEXT, '
+                'in_stock INTEGER, brand_slug TEXT, category_slug TEXT, brand_id INTEGER, category_id INTEGER, '
+                'product_id INTEGER, import_hash TEXT, changed INTEGER DEFAULT 0)'
+            )
+
+    def add(self, line_num, **values):
+        """Добавляет строку выгрузки (значения по ROW_COLUMNS, кроме line_num)"""
+        self.rows.append((line_num, *(values[column] for column in ROW_COLUMNS[1:])))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        placeholders = ', '.join(['%s'] * (len(ROW_COLUMNS) + 2))
+        rows = [(*row, brand_slug(row[4]), category_slug(row[5])) for row in self.rows]
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {STAGING_TABLE} ({", ".join(ROW_COLUMNS)}, brand_slug, category_slug) VALUES ({placeholders})',
+                rows,
+            )
+        self.loaded += len(self.rows)
+        self.rows = []
+
+    def drop(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS temp.{STAGING_TABLE}')
+
+    def merge(self):
+        """
+        Переносит загруженные строки в каталог. Возвращает статистику:
+        new_brands, new_categories, new_products, updated_products,
+        unchanged_products, duplicate_tmp_ids, список changed_tmp_ids и
+        список unresolved_rows - (номер строки, TMP_ID) строк, для которых не
+        нашлась категория; они в каталог не переносятся и не считаются
+        """
+        self.flush()
+        stats = {}
+        with connection.cursor() as cursor:
+            # Повтор TMP_ID в выгрузке: побеждает последняя строка
+            cursor.execute(
+                f'DELETE FROM {STAGING_TABLE} WHERE rowid NOT IN '
+                f'(SELECT MAX(rowid) FROM {STAGING_TABLE} GROUP BY tmp_id)'
+            )
+            stats['duplicate_tmp_ids'] = cursor.rowcount
+            # Индексы строятся один раз после загрузки, а не на каждую вставку
+            for column in ('tmp_id', 'slug', 'brand_slug', 'category_slug'):
+                cursor.execute(f'CREATE INDEX temp.{STAGING_TABLE}_{column} ON {STAGING_TABLE} ({column})')
+
+        with transaction.atomic():
+            stats['new_brands'] = self._create_brands()
+            stats['new_categories'] = self._create_categories()
+            with connection.cursor() as cursor:
+                self._resolve(cursor)
+                stats['unresolved_rows'] = self._drop_unresolved(cursor)
+                stats.update(self._count_changes(cursor))
+                cursor.execute(f'SELECT tmp_id FROM {STAGING_TABLE} WHERE changed = 1')
+                stats['changed_tmp_ids'] = [row[0] for row in cursor.fetchall()]
+                self._merge_products(cursor)
+            ProductNumber.rebuild_for(stats['changed_tmp_ids'], field='tmp_id')
+            fts.index_products(stats['changed_tmp_ids'], field='tmp_id')
+        logger.info(
+            f"Staging: загружено={self.loaded}, создано={stats['new_products']}, "
+            f"обновлено={stats['updated_products']}, без изменений={stats['unchanged_products']}"
+        )
+        return stats
+
+    def _missing(self, slug_column, value_column, table):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT s.{slug_column}, MIN(s.{value_column}) FROM {STAGING_TABLE} s '
+                f'WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.slug = s.{slug_column}) '
+                f'GROUP BY s.{slug_column}'
+            )
+            return cursor.fetchall()
+
+    def _create_brands(self):
+        brands = [
+            Brand(slug=slug, name=producer, description=f'Автоматически созданный бренд для {producer}')
+            for slug, producer in self._missing('brand_slug', 'producer', Brand._meta.db_table)
+        ]
+        Brand.objects.bulk_create(brands)
+        return len(brands)
+
+    def _create_categories(self):
+        # Созданные импортом категории - корневые, их SECTION_ID хранится в slug
+        categories = [
+            Category(
+                slug=slug, name=f'Категория {section_id}', root_section=slug, depth=0,
+                description=f'Автоматически созданная категория для {section_id}',
+            )
+            for slug, section_id in self._missing('category_slug', 'section_id', Category._meta.db_table)
+        ]
+        Category.objects.bulk_create(categories)
+        if categories:
+            Category.objects.filter(slug__in=[category.slug for category in categories]).update(
+                path=Concat(Value('/'), Cast('pk', CharField()), Value('/'))
+            )
+        return len(categories)
+
+    def _resolve(self, cursor):
+        """Проставляет id брендов, категорий и товаров, хэш и свободные slug новых товаров"""
+        cursor.execute(
+            f'UPDATE {STAGING_TABLE} SET '
+            f'brand_id = (SELECT id FROM {Brand._meta.db_table} WHERE slug = brand_slug), '
+            f'category_id = (SELECT id FROM {Category._meta.db_table} WHERE slug = category_slug), '
+            f'product_id = (SELECT id FROM {Product._meta.db_table} WHERE tmp_id = {STAGING_TABLE}.tmp_id)'
+        )
+        hash_columns = ', '.join(Product._meta.get_field(field).attname for field in Product.IMPORT_HASH_FIELDS)
+        cursor.execute(f'UPDATE {STAGING_TABLE} SET import_hash = {HASH_FUNCTION}({hash_columns})')
+
+        # slug существующих товаров не меняется, новым занятый slug дополняется номером строки
+        for _ in range(SLUG_ROUNDS):
+            cursor.execute(
+                f'UPDATE {STAGING_TABLE} SET slug = slug || \'-\' || line_num '
+                f'WHERE product_id IS NULL AND ('
+                f'EXISTS (SELECT 1 FROM {Product._meta.db_table} p WHERE p.slug = {STAGING_TABLE}.slug) '
+                f'OR EXISTS (SELECT 1 FROM {STAGING_TABLE} s WHERE s.slug = {STAGING_TABLE}.slug '
+                f'AND s.line_num < {STAGING_TABLE}.line_num AND s.product_id IS NULL))'
+            )
+            if not cursor.rowcount:
+                break
+
+    def _drop_unresolved(self, cursor):
+        """Убирает строки без категории (слияние соединяет товары с категорией) и возвращает их"""
+        cursor.execute(f'SELECT line_num, tmp_id FROM {STAGING_TABLE} WHERE category_id IS NULL ORDER BY line_num')
+        unresolved = cursor.fetchall()
+        if unresolved:
+            cursor.execute(f'DELETE FROM {STAGING_TABLE} WHERE category_id IS NULL')
+        return unresolved
+
+    def _count_changes(self, cursor):
+        cursor.execute(
+            f'UPDATE {STAGING_TABLE} SET changed = 1 WHERE product_id IS NULL OR EXISTS ('
+            f'SELECT 1 FROM {Product._meta.db_table} p WHERE p.id = {STAGING_TABLE}.product_id '
+            f'AND (p.import_hash != {STAGING_TABLE}.import_hash OR p.in_stock != {STAGING_TABLE}.in_stock))'
+        )
+        cursor.execute(
+            f'SELECT COUNT(*), '
+            f'COALESCE(SUM(changed = 1 AND product_id IS NULL), 0), '
+            f'COALESCE(SUM(changed = 1 AND product_id IS NOT NULL), 0) FROM {STAGING_TABLE}'
+        )
+        total, created, updated = cursor.fetchone()
+        return {'new_products': created, 'updated_products': updated, 'unchanged_products': total - created - updated}
+
+    def _merge_products(self, cursor):
+        """Один INSERT ... ON CONFLICT для всех новых и изменившихся товаров"""
+        update_columns = [
+            Product._meta.get_field(field).attname
+            for field in Product.IMPORT_UPDATE_FIELDS
+        ] + ['import_hash', 'root_section', 'updated_at']
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        cursor.execute(
+            f'INSERT INTO {Product._meta.db_table} ('
+            'tmp_id, name, slug, category_id, brand_id, code, catalog_number, cross_number, artikyl_number, '
+            'description, price, applicability, in_stock, is_featured, is_new, import_hash, root_section, '
+            'created_at, updated_at) '
+            'SELECT s.tmp_id, s.name, s.slug, s.category_id, s.brand_id, s.code, s.catalog_number, '
+            's.cross_number, s.artikyl_number, \'\', 0, s.applicability, s.in_stock, 0, 1, s.import_hash, '
+            'c.root_section, %s, %s '
+            f'FROM {STAGING_TABLE} s JOIN {Category._meta.db_table} c ON c.id = s.category_id '
+            'WHERE s.changed = 1 '
+            'ON CONFLICT (tmp_id) DO UPDATE SET '
+            + ', '.join(f'{column} = excluded.{column}' for column in update_columns),
+            [now, now],
+        )
@@ -1,3 +1,968 @@
-from django.test import TestCase
+import json
+import os
+import struct
+import tempfile
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import skipIf
+from unittest.mock import patch
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.text import slugify
+
+from . import image_manifest
+from .catalog_cache import VERSION_KEY, bump_catalog_version
+from .db_tuning import DEFERRED_INDEX_TABLE, bulk_load_session, defer_indexes, restore_deferred_indexes
+from .file_encoding import WINDOW_SIZE, detect_encoding, is_decodable, supports_byte_lines
+from .import_inspect import count_csv_rows, inspect_file, inspect_import_file, sniff_delimiter
+from .import_metrics import ImportTimings
+from .import_progress import ImportProgress, cancel_requested, progress_events, progress_path, read_progress, request_cancel
+from .import_transform import DBF_FIELDS, csv_chunk_ranges, make_product_slug, dbf_chunk_ranges, map_chunks, transform_csv_chunk, transform_dbf_chunk
+from .models import Brand, Category, ImportFile, OeKod, Product, ProductAnalog, ProductNumber
+from .staging import StagingLoader
+from .dbf_reader import DBFReader
+from .management.commands.import_dbf import Command as ImportDbfCommand
+from .management.commands.import_products_new import Command as ImportCsvCommand
+from .management.commands.run_import_worker import Command as ImportWorkerCommand
+from .views import CatalogView
+
+try:
+    from dbfread import DBF
+except ImportError:
+    DBF = None
+
+# Общий файловый кэш 'imports' (версия каталога, кодировки файлов) в тестах
+# заменяется кэшем в памяти, чтобы тесты не писали в BASE_DIR/cache
+TEST_CACHES = {
+    **settings.CACHES,
+    'imports': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-imports'},
+}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ShopTestCase(TestCase):
+    """Общая основа тестов магазина: кэши TEST_CACHES и временные каталоги"""
+
+    def make_tmp_dir(self):
+        """Временный каталог, удаляемый после теста. Возвращает его путь"""
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        return tmp_dir.name
+
+
+@override_settings(
+    IMAGES_ROOT=os.path.join(tempfile.gettempdir(), 'test_images'),
+    IMAGE_MANIFEST_PATH=os.path.join(tempfile.gettempdir(), 'test_images_manifest.json'),
+)
+class CatalogQueryCountTest(ShopTestCase):
+    """Страница каталога должна выполнять фиксированное число запросов"""
+
+    # Верхняя граница запросов на страницу каталога. Если тест упал -
+    # где-то появился лишний COUNT/EXISTS или N+1 в шаблоне
+    MAX_QUERIES = 6
+
+    @classmethod
+    def setUpTestData(cls):
+        brands = [Brand.objects.create(name=f'Бренд {i}', slug=f'brand-{i}') for i in range(3)]
+        for i in range(3):
+            category = Category.objects.create(name=f'Категория {i}', slug=f'category-{i}')
+            Category.objects.create(name=f'Подкатегория {i}', slug=f'subcategory-{i}', parent=category)
+            for j in range(5):
+                Product.objects.create(
+                    tmp_id=f'{i}{j:05d}',
+                    code=f'{i}{j:05d}',
+                    name=f'Фильтр масляный {i}-{j}',
+                    slug=f'product-{i}-{j}',
+                    category=category,
+                    brand=brands[j % 3],
+                    catalog_number=f'AB-{i}{j}00',
+                    price=100 + i * 10 + j,
+                )
+
+    def setUp(self):
+        caches['catalog'].clear()
+
+    def assertCatalogQueries(self, params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('shop:catalog'), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(
+            len(queries), self.MAX_QUERIES,
+            '\n'.join(query['sql'] for query in queries.captured_queries)
+        )
+        return response
+
+    def test_catalog_page(self):
+        response = self.assertCatalogQueries({})
+        self.assertEqual(response.context['paginator'].count, 15)
+
+    def test_catalog_filters(self):
+        response = self.assertCatalogQueries({
+            'category': ['category-0', 'category-1'],
+            'brand': ['brand-0'],
+            'min_price': '100',
+            'max_price': '200',
+            'sort': 'price_asc',
+        })
+        self.assertEqual(response.context['paginator'].count, 4)
+
+        # Фасеты считаются по всей отфильтрованной выборке
+        facets = response.context['facets']
+        self.assertEqual((facets['min_price'], facets['max_price']), (100, 113))
+        self.assertEqual({brand.slug: brand.product_count for brand in facets['brands']}['brand-0'], 4)
+        self.assertEqual([category.product_count for category in facets['main_categories']], [2, 2, 0])
+
+    def test_root_section(self):
+        # Подкатегория переносится в другую ветку через админку (save)
+        subcategory = Category.objects.get(slug='subcategory-0')
+        Product.objects.filter(slug='product-0-0').update(category=subcategory)
+        Product.update_root_sections(['product-0-0'], field='slug')
+        self.assertEqual((subcategory.root_section, subcategory.depth), ('category-0', 1))
+
+        subcategory.parent = Category.objects.get(slug='category-1')
+        subcategory.save()
+        moved = Product.objects.get(slug='product-0-0')
+        self.assertEqual(moved.root_section, 'category-1')
+        with self.assertNumQueries(0):
+            self.assertEqual(moved.main_image_path, 'category-1/000000.jpg')
+
+        response = self.assertCatalogQueries({'section': 'category-1'})
+        self.assertEqual(response.context['paginator'].count, 6)
+
+    def test_category_subtree(self):
+        root = Category.objects.get(slug='category-2')
+        child = Category.objects.get(slug='subcategory-2')
+        grandchild = Category.objects.create(name='Уровень 3', slug='subcategory-2-1', parent=child)
+        self.assertEqual(grandchild.path, f'/{root.pk}/{child.pk}/{grandchild.pk}/')
+        self.assertEqual(grandchild.level, 2)
+        self.assertEqual(set(root.get_descendants()), {child, grandchild})
+
+        Product.objects.filter(slug='product-2-0').update(category=grandchild)
+        response = self.assertCatalogQueries({'category': 'category-2'})
+        self.assertEqual(response.context['paginator'].count, 5)
+        response = self.assertCatalogQueries({'category': 'subcategory-2'})
+        self.assertEqual([product.slug for product in response.context['products']], ['product-2-0'])
+
+        # Перенос ветки пересчитывает пути потомков
+        child.parent = Category.objects.get(slug='category-0')
+        child.save()
+        grandchild.refresh_from_db()
+        self.assertTrue(grandchild.path.startswith(child.path))
+        self.assertEqual(grandchild.root_section, 'category-0')
+        response = self.assertCatalogQueries({'category': 'category-0'})
+        self.assertEqual(response.context['paginator'].count, 6)
+
+    def test_number_search(self):
+        # Регистр и разделители в номере не важны
+        for search in ('ab0100', 'AB 0100', 'ab-0100'):
+            response = self.assertCatalogQueries({'search': search})
+            self.assertEqual([product.slug for product in response.context['products']], ['product-0-1'])
+
+        # Найденный товар тянет за собой свою группу аналогов
+        ProductAnalog.objects.create(
+            product=Product.objects.get(slug='product-0-1'),
+            analog_product=Product.objects.get(slug='product-1-1'),
+        )
+        response = self.assertCatalogQueries({'search': 'AB-0100'})
+        self.assertEqual({product.slug for product in response.context['products']}, {'product-0-1', 'product-1-1'})
+
+    def test_short_number_search(self):
+        # Короткий номер: номера товара - точно, номера OE - по началу
+        OeKod.objects.create(product=Product.objects.get(slug='product-2-3'), oe_kod='X7777')
+        response = self.assertCatalogQueries({'search': 'x77'})
+        self.assertEqual([product.slug for product in response.context['products']], ['product-2-3'])
+        response = self.assertCatalogQueries({'search': '2000'})
+        self.assertEqual(response.context['paginator'].count, 0)
+
+    def test_text_search(self):
+        response = self.assertCatalogQueries({'search': 'фильтры'})
+        self.assertEqual(response.context['paginator'].count, 15)
+
+    def test_keyset_pagination(self):
+        seen = []
+        params = {'sort': 'price_asc'}
+        with self.settings(CATALOG_APPROXIMATE_TOTAL_TTL=0):
+            response = self.client.get(reverse('shop:catalog'), params)
+            # Первая страница в обычном режиме, переходим по курсору
+            cursor_query = response.context['next_cursor_query']
+            self.assertEqual(cursor_query, '')
+            with patch.object(CatalogView, 'paginate_by', 4):
+                response = self.client.get(reverse('shop:catalog'), params)
+                seen += [product.slug for product in response.context['products']]
+                cursor_query = response.context['next_cursor_query']
+                while cursor_query:
+                    with CaptureQueriesContext(connection) as queries:
+                        response = self.client.get(reverse('shop:catalog') + '?' + cursor_query)
+                    self.assertLessEqual(len(queries), self.MAX_QUERIES)
+                    self.assertIn('keyset', response.context)
+                    seen += [product.slug for product in response.context['products']]
+                    cursor_query = response.context['next_cursor_query']
+
+        expected = list(Product.objects.order_by('price', 'id').values_list('slug', flat=True))
+        self.assertEqual(seen, expected)
+
+    def test_keyset_bad_cursor(self):
+        response = self.client.get(reverse('shop:catalog'), {'after': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_result_cache(self):
+        params = {'brand': ['brand-1'], 'sort': 'price_desc'}
+        first = self.assertCatalogQueries(params)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.get(reverse('shop:catalog'), params)
+        # Из кэша: только товары страницы и их изображения
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(
+            [product.slug for product in second.context['products']],
+            [product.slug for product in first.context['products']],
+        )
+        self.assertEqual(second.context['facets']['min_price'], first.context['facets']['min_price'])
+
+        # Изменение товара сбрасывает кэш
+        Product.objects.filter(slug='product-0-1').update(price=1000)
+        bump_catalog_version()
+        third = self.client.get(reverse('shop:catalog'), params)
+        self.assertEqual(third.context['products'][0].slug, 'product-0-1')
+        self.assertEqual(third.context['facets']['max_price'], 1000)
+
+    def test_import_invalidates_cache(self):
+        # Версия каталога - в общем файловом кэше, как у процессов сайта и воркера
+        tmp_dir = self.make_tmp_dir()
+        shared = {**TEST_CACHES, 'imports': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(tmp_dir, 'cache'),
+        }}
+        path = os.path.join(tmp_dir, 'import.csv')
+        with open(path, 'wb') as f:
+            f.write('TMP_ID#NAME#PRODUCER#TMC#ART#MODEL#CROSS#SECTION\n'.encode('cp1251'))
+            f.write('000001#Фильтр масляный новый#Бренд 1#AB-0100#X1#ВАЗ#C1#[0]#\n'.encode('cp1251'))
+
+        params = {'sort': 'price_asc'}
+        with self.settings(CACHES=shared):
+            self.client.get(reverse('shop:catalog'), params)
+            with CaptureQueriesContext(connection) as cached:
+                self.client.get(reverse('shop:catalog'), params)
+
+            call_command('import_products_new', path, encoding='cp1251', stdout=StringIO())
+            self.assertIsNone(caches['catalog'].get(VERSION_KEY))
+            self.assertIsNotNone(caches['imports'].get(VERSION_KEY))
+
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('shop:catalog'), params)
+        self.assertGreater(len(queries), len(cached))
+        self.assertIn('Фильтр масляный новый', [product.name for product in response.context['products']])
+
+
+class ProductUpsertTest(ShopTestCase):
+    """Повторный импорт обновляет товары по tmp_id, а не создает дубликаты"""
+
+    def setUp(self):
+        self.brand = Brand.objects.create(name='Бренд', slug='brand')
+        self.category = Category.objects.create(name='Раздел', slug='section')
+
+    def make_products(self, names):
+        return [
+            Product(tmp_id=f'T{i}', code=f'T{i}', name=name, slug=f'product-{i}', category=self.category,
+                    brand=self.brand, catalog_number=f'N{i}', price=0)
+            for i, name in enumerate(names)
+        ]
+
+    def test_upsert_by_tmp_id(self):
+        created, updated, unchanged = Product.upsert_by_tmp_id(self.make_products(['А', 'Б', 'В']))
+        self.assertEqual((len(created), len(updated), len(unchanged)), (3, 0, 0))
+
+        Product.objects.filter(tmp_id='T0').update(price=150)
+        created, updated, unchanged = Product.upsert_by_tmp_id(self.make_products(['А', 'Б изменен', 'В']))
+        self.assertEqual((created, updated, unchanged), ([], ['T1'], ['T0', 'T2']))
+        self.assertEqual(Product.objects.count(), 3)
+        self.assertEqual(Product.objects.get(tmp_id='T1').name, 'Б изменен')
+        # Цена ведется на сайте и импортом не перезаписывается
+        self.assertEqual(Product.objects.get(tmp_id='T0').price, 150)
+
+    def test_disappeared_products(self):
+        Product.upsert_by_tmp_id(self.make_products(['А', 'Б', 'В']))
+        manual = Product.objects.create(name='Ручной', slug='manual', category=self.category, brand=self.brand, price=1)
+
+        disappeared = Product.find_disappeared({'T0', 'T2'}, mark_out_of_stock=True)
+        self.assertEqual(disappeared, ['T1'])
+        self.assertFalse(Product.objects.get(tmp_id='T1').in_stock)
+        # Товары, заведенные вручную, к выгрузке не относятся
+        self.assertTrue(Product.objects.get(pk=manual.pk).in_stock)
+
+        # Вернувшийся в выгрузку товар снова в наличии
+        created, updated, unchanged = Product.upsert_by_tmp_id(self.make_products(['А', 'Б', 'В']))
+        self.assertEqual(updated, ['T1'])
+        self.assertTrue(Product.objects.get(tmp_id='T1').in_stock)
+
+    def test_save_rebuilds_numbers_on_change(self):
+        Product.upsert_by_tmp_id(self.make_products(['А']))
+        product = Product.objects.get(tmp_id='T0')
+        with patch('shop.analogs.update_analog_groups') as update_groups:
+            product.price, product.is_featured = 200, True
+            product.save()
+            update_groups.assert_not_called()
+
+            product.catalog_number = 'AB 0100'
+            product.save()
+            update_groups.assert_called_once_with([product.pk])
+        self.assertTrue(ProductNumber.objects.filter(product=product, number='AB0100').exists())
+
+    def test_rows_without_tmp_id(self):
+        tmp_dir = self.make_tmp_dir()
+        path = os.path.join(tmp_dir, 'import.csv')
+
+        def run_import(lines):
+            with open(path, 'wb') as f:
+                f.write('TMP_ID#NAME#PRODUCER#TMC#ART#MODEL#CROSS#SECTION\n'.encode('cp1251'))
+                for line in lines:
+                    f.write(f'{line}#BOSCH#N#A#ВАЗ#C#[10]#\n'.encode('cp1251') if line else b'\r\n')
+            out = StringIO()
+            call_command('import_products_new', path, encoding='cp1251', mark_disappeared=True, stdout=out)
+            return out.getvalue()
+
+        output = run_import(['T1#Фильтр', '#Без ключа', '', 'T2#Свеча'])
+        # Пустая строка пропускается, строка без TMP_ID - ошибка
+        self.assertIn('Пропущено пустых строк: 1', output)
+        self.assertIn('Ошибок: 1', output)
+        # Следующая выгрузка сдвинута на строку: строка без TMP_ID стоит там, где была T2
+        run_import(['T0#Новый', 'T1#Фильтр', '#Другой без ключа', 'T2#Свеча'])
+
+        products = dict(Product.objects.filter(tmp_id__isnull=False).values_list('tmp_id', 'name'))
+        self.assertEqual(products, {'T0': 'Новый', 'T1': 'Фильтр', 'T2': 'Свеча'})
+        self.assertTrue(all(Product.objects.filter(tmp_id__in=products).values_list('in_stock', flat=True)))
+
+
+class StagingLoaderTest(ShopTestCase):
+    """Импорт через staging-таблицу: ссылки и slug разрешаются в SQL, товары переносятся одним запросом"""
+
+    def load(self, rows):
+        loader = StagingLoader(batch_size=2)
+        loader.create()
+        self.addCleanup(loader.drop)
+        for line_num, (tmp_id, name, producer, section_id) in enumerate(rows, start=1):
+            loader.add(
+                line_num, tmp_id=tmp_id, name=name, slug='product', producer=producer, section_id=section_id,
+                code=tmp_id, catalog_number=f'N-{tmp_id}', cross_number='', artikyl_number='',
+                applicability='Уточняйте', in_stock=True,
+            )
+        return loader.merge()
+
+    def test_merge(self):
+        Product.upsert_by_tmp_id([Product(
+            tmp_id='S1', code='S1', name='Старое', slug='product', catalog_number='N-S1', price=5, applicability='Уточняйте',
+            category=Category.objects.create(name='Раздел', slug='category-10'),
+            brand=Brand.objects.create(name='BOSCH', slug='bosch'),
+        )])
+
+        stats = self.load([
+            ('S1', 'Новое', 'BOSCH', '10'),
+            ('S2', 'Фильтр', 'MANN', '20'),
+            ('S3', 'Фильтр', 'MANN', '20'),
+            ('S3', 'Фильтр повтор', 'MANN', '20'),
+        ])
+        self.assertEqual(
+            (stats['new_products'], stats['updated_products'], stats['unchanged_products'], stats['duplicate_tmp_ids']),
+            (2, 1, 0, 1),
+        )
+        self.assertEqual((stats['new_brands'], stats['new_categories']), (1, 1))
+
+        existing = Product.objects.get(tmp_id='S1')
+        self.assertEqual((existing.name, existing.slug, existing.price), ('Новое', 'product', 5))
+        self.assertEqual(existing.import_hash, existing.compute_import_hash())
+
+        new = Product.objects.get(tmp_id='S3')
+        self.assertEqual(new.name, 'Фильтр повтор')
+        self.assertEqual((new.brand.slug, new.root_section, new.category.path), ('mann', 'category-20', f'/{new.category_id}/'))
+        self.assertEqual(len(set(Product.objects.values_list('slug', flat=True))), 3)
+        self.assertTrue(new.numbers.filter(number='NS3').exists())
+
+        # Повторная загрузка тех же данных ничего не меняет
+        stats = self.load([('S1', 'Новое', 'BOSCH', '10')])
+        self.assertEqual((stats['unchanged_products'], stats['changed_tmp_ids']), (1, []))
+
+    def test_unresolved_category(self):
+        Category.objects.create(name='Раздел', slug='category-10')
+        # Категория раздела 20 не создана - строка не переносится и не считается созданной
+        with patch.object(StagingLoader, '_create_categories', return_value=0):
+            stats = self.load([('S1', 'Фильтр', 'BOSCH', '10'), ('S2', 'Свеча', 'BOSCH', '20')])
+        self.assertEqual(stats['unresolved_rows'], [(2, 'S2')])
+        self.assertEqual((stats['new_products'], stats['changed_tmp_ids']), (1, ['S1']))
+        self.assertEqual(list(Product.objects.values_list('tmp_id', flat=True)), ['S1'])
+
+
+class ProductSlugTest(ShopTestCase):
+    """Slug импорта выводится из TMP_ID: детерминирован и не повторяется без проверок в базе"""
+
+    def test_unique_per_tmp_id(self):
+        tmp_ids = ['A-1', 'A1', 'a1', 'A_1', 'A 1', 'ЦБ-001', 'ЦБ001', '5f', '_5f_']
+        with self.assertNumQueries(0):
+            slugs = [make_product_slug('Фильтр масляный MANN W 712/75', tmp_id) for tmp_id in tmp_ids]
+        self.assertEqual(len(set(slugs)), len(tmp_ids))
+        self.assertEqual(slugs, [make_product_slug('Фильтр масляный MANN W 712/75', tmp_id) for tmp_id in tmp_ids])
+        self.assertEqual(make_product_slug('Oil filter', 'T00001'), 'oil-filter--T00001')
+        # Название не влияет на уникальность: ключ - TMP_ID после '--'
+        self.assertNotEqual(make_product_slug('a', 'b--c'), make_product_slug('a--b', 'c'))
+
+    def test_never_matches_slugify(self):
+        # Slug старых товаров получен slugify и не содержит '--'
+        slug = make_product_slug('Oil filter', 'T00001')
+        self.assertNotEqual(slugify(slug), slug)
+        self.assertLessEqual(len(make_product_slug('x' * 200, '1234567890')), 50)
+
+    def test_length_bound(self):
+        tmp_ids = ['ТОВАР-0000123456', 'ТОВАР-0000123457', 'A' * 60, 'A' * 61, 'Ц' * 100, 'x' * 20, 'x' * 21, '_' * 4]
+        slugs = [make_product_slug('Фильтр масляный MANN W 712/75', tmp_id) for tmp_id in tmp_ids]
+        self.assertTrue(all(len(slug) <= 50 for slug in slugs), slugs)
+        self.assertEqual(len(set(slugs)), len(tmp_ids))
+        # Для длинного кириллического TMP_ID название остается в slug
+        self.assertTrue(slugs[0].startswith('mann-w-71275--_h'), slugs[0])
+        self.assertEqual(slugs[5], make_product_slug('Фильтр масляный MANN W 712/75', 'x' * 20))
+        self.assertTrue(slugs[5].endswith('--' + 'x' * 20))
+        self.assertRegex(slugs[6], r'--_h[0-9a-f]{16}$')
+
+
+class ImportQueueTest(ShopTestCase):
+    """Админка ставит импорт в очередь, воркер забирает его по одному и восстанавливает после падения"""
+
+    def make_job(self, name):
+        job = ImportFile.objects.create(file=f'imports/{name}', original_filename=name)
+        job.enqueue()
+        return job
+
+    def test_claim_one_at_a_time(self):
+        first = self.make_job('first.csv')
+        second = self.make_job('second.dbf')
+
+        claimed = ImportFile.claim_next('worker-1')
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (first.pk, 'processing', 1))
+        # Пока идет импорт, второй воркер ничего не получает
+        self.assertIsNone(ImportFile.claim_next('worker-2'))
+
+        self.assertTrue(ImportFile.heartbeat(first.pk, 'worker-1'))
+        self.assertFalse(ImportFile.heartbeat(first.pk, 'worker-2'))
+
+        # Итог записан, процесс еще выполняет завершающие этапы - это не отмена
+        ImportFile.objects.filter(pk=first.pk).update(status='completed')
+        self.assertTrue(ImportFile.heartbeat(first.pk, 'worker-1'))
+        self.assertEqual(ImportFile.claim_next('worker-2').pk, second.pk)
+
+        ImportFile.objects.filter(pk=second.pk).update(status='cancelled', cancelled=True)
+        self.assertFalse(ImportFile.heartbeat(second.pk, 'worker-2'))
+        # Перезапущенный из админки импорт (worker_id сброшен) - чужой
+        ImportFile.objects.get(pk=first.pk).enqueue()
+        self.assertFalse(ImportFile.heartbeat(first.pk, 'worker-1'))
+
+    def test_recover_stale(self):
+        job = self.make_job('crash.csv')
+        ImportFile.claim_next('worker-1')
+        ImportFile.objects.filter(pk=job.pk).update(committed_row=5000)
+        self.assertEqual(ImportFile.recover_stale(stale_after=60, max_attempts=2), (0, 0))
+
+        ImportFile.objects.filter(pk=job.pk).update(heartbeat_at=job.uploaded_at - timedelta(hours=1))
+        self.assertEqual(ImportFile.recover_stale(stale_after=60, max_attempts=2), (1, 0))
+
+        # Повторная попытка продолжает импорт с последней сохраненной строки
+        job = ImportFile.claim_next('worker-2')
+        command = ImportWorkerCommand()
+        command.batch_size, command.parse_workers, command.bulk_load = 100, 1, False
+        args = command.build_command(job)
+        self.assertIn('--resume', args)
+
+        ImportFile.objects.filter(pk=job.pk).update(heartbeat_at=job.uploaded_at - timedelta(hours=1))
+        self.assertEqual(ImportFile.recover_stale(stale_after=60, max_attempts=2), (0, 1))
+        self.assertEqual(ImportFile.objects.get(pk=job.pk).status, 'failed')
+
+
+def write_dbf(path, fields, records, deleted=()):
+    """Минимальный DBF (dBase III): fields=[(имя, длина)] или [(имя, длина, тип)], по умолчанию тип C"""
+    fields = [(name, length, *rest, 'C')[:3] for name, length, *rest in fields]
+    record_len = 1 + sum(length for _, length, _ in fields)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<BBBBIHH20x', 3, 124, 1, 1, len(records), 32 + 32 * len(fields) + 1, record_len))
+        for name, length, field_type in fields:
+            f.write(struct.pack('<11sc4xBB14x', name.encode('ascii'), field_type.encode('ascii'), length, 0))
+        f.write(b'\r')
+        for i, values in enumerate(records):
+            f.write(b'*' if i in deleted else b' ')
+            for (_, length, field_type), value in zip(fields, values):
+                value = str(value).encode('cp1251')[:length]
+                f.write(value.rjust(length, b' ') if field_type == 'N' else value.ljust(length, b' '))
+        f.write(b'\x1a')
+
+
+class ImportCheckpointTest(ShopTestCase):
+    """Прерванный импорт продолжается с контрольной точки без повторного чтения загруженной части"""
+
+    def setUp(self):
+        self.tmp_dir = self.make_tmp_dir()
+
+    def test_csv_resume_offset(self):
+        path = os.path.join(self.tmp_dir, 'import.csv')
+        with open(path, 'wb') as f:
+            f.write('TMP_ID#NAME\n'.encode('cp1251'))
+            for i in range(1, 6):
+                f.write(f'{i}#Товар {i}\n'.encode('cp1251'))
+
+        lines = list(ImportCsvCommand().iter_csv_lines(path, 'cp1251'))
+        line_num, offset, _ = lines[2]
+        resumed = list(ImportCsvCommand().iter_csv_lines(path, 'cp1251', start_offset=offset, start_line=line_num))
+        self.assertEqual(resumed[0][0], 0)
+        self.assertEqual(resumed[1:], lines[3:])
+
+    def test_dbf_resume_offset(self):
+        path = os.path.join(self.tmp_dir, 'import.dbf')
+        write_dbf(path, [('TMP_ID', 10)], [[f'R{i}'] for i in range(10)], deleted={1, 4})
+        command = ImportDbfCommand()
+        table = DBFReader(path, 'cp1251', ['TMP_ID'])
+
+        records = list(command.iter_dbf_records(table))
+        self.assertEqual(len(records), 8)
+        resumed = list(command.iter_dbf_records(table, start_record=3))
+        self.assertEqual(resumed, records[3:])
+        self.assertEqual(resumed[0], (4, ('R5',)))
+
+    def test_enqueue_resume(self):
+        job = ImportFile.objects.create(file='imports/import.csv', original_filename='import.csv', status='failed')
+        ImportFile.objects.filter(pk=job.pk).update(committed_row=300, checkpoint={'offset': 1024}, file_hash='abc')
+        job.refresh_from_db()
+        self.assertTrue(job.can_resume)
+
+        job.enqueue(resume=True)
+        self.assertEqual((job.status, job.committed_row, job.checkpoint), ('queued', 300, {'offset': 1024}))
+        job.enqueue()
+        self.assertEqual((job.committed_row, job.checkpoint), (0, {}))
+
+
+class ParallelTransformTest(ShopTestCase):
+    """Разбор диапазонами в пуле процессов дает те же строки, что и последовательный"""
+
+    def setUp(self):
+        self.tmp_dir = self.make_tmp_dir()
+
+    def test_csv_chunks(self):
+        path = os.path.join(self.tmp_dir, 'import.csv')
+        with open(path, 'wb') as f:
+            f.write('TMP_ID#NAME#PRODUCER#TMC#ART#MODEL#CROSS#SECTION\n'.encode('cp1251'))
+            for i in range(1, 40):
+                f.write(f'T{i}#Товар {i}#BOSCH#AB-{i}#X{i}#ВАЗ#C{i}#[{i % 3}]#\n'.encode('cp1251'))
+            f.write(b'T40#\x98\n')
+
+        command = ImportCsvCommand()
+        serial = list(command.iter_rows(path, 'cp1251', '#'))[1:]
+        with open(path, 'rb') as f:
+            header_end = len(f.readline())
+        chunks = [(path, start, end, 'cp1251', '#') for start, end in csv_chunk_ranges(path, header_end, chunk_bytes=100)]
+        self.assertGreater(len(chunks), 3)
+        parallel = [row for results in map_chunks(transform_csv_chunk, chunks, workers=2) for row in results]
+
+        self.assertEqual([offset for offset, _ in parallel], [offset for _, offset, _ in serial])
+        self.assertEqual(parallel[:-1], [(offset, row) for _, offset, row in serial[:-1]])
+        self.assertEqual(parallel[0][1]['category_slug'], 'category-1')
+        self.assertIsInstance(parallel[-1][1], ValueError)
+        # Пул используется и командой: номера строк назначаются по порядку
+        rows = list(command.iter_parallel_rows(path, 'cp1251', '#', workers=2, skip_rows=10))[1:]
+        self.assertEqual([line_num for line_num, _, _ in rows], list(range(11, 41)))
+        self.assertEqual(rows[0][2]['tmp_id'], 'T11')
+
+    def test_dbf_chunks(self):
+        path = os.path.join(self.tmp_dir, 'import.dbf')
+        write_dbf(path, [('TMP_ID', 10), ('NAME', 20)], [[f'R{i}', f'Товар {i}'] for i in range(25)], deleted={1, 4, 20})
+        command = ImportDbfCommand()
+        table = DBFReader(path, 'cp1251', DBF_FIELDS)
+
+        serial = [row for _, row in command.iter_rows(table)]
+        chunks = [(path, 'cp1251', start, end) for start, end in dbf_chunk_ranges(0, 25, chunk_records=4)]
+        parallel = [row for results in map_chunks(transform_dbf_chunk, chunks, workers=2) for row in results]
+        self.assertEqual(parallel, serial)
+        self.assertEqual(len(parallel), 22)
+
+        resumed = list(command.iter_parallel_rows(table, 'cp1251', workers=2, start_record=3))
+        self.assertEqual(resumed[0], (4, serial[3]))
+        self.assertEqual(len(resumed), 19)
+
+
+class DBFReaderTest(ShopTestCase):
+    """Чтение DBF по заголовку и фиксированным смещениям совпадает с dbfread"""
+
+    def setUp(self):
+        tmp_dir = self.make_tmp_dir()
+        self.path = os.path.join(tmp_dir, 'import.dbf')
+        fields = [('TMP_ID', 10), ('EXTRA', 30), ('NAME', 20), ('QTY', 6, 'N'), ('SECTION_ID', 8)]
+        records = [[f'R{i}', 'лишнее', f' Товар {i}', i * 3 if i % 4 else '', f'[{i % 3}]'] for i in range(12)]
+        write_dbf(self.path, fields, records, deleted={0, 7})
+
+    def test_header_and_projection(self):
+        reader = DBFReader(self.path, 'cp1251', ['NAME', 'TMP_ID', 'QTY', 'PROPERTY_P'])
+        self.assertEqual(len(reader), 12)
+        self.assertEqual(reader.count_live(), 10)
+        self.assertEqual(reader.missing_columns, ['PROPERTY_P'])
+
+        records = list(reader.iter_records())
+        self.assertEqual([index for index, _ in records], [1, 2, 3, 4, 5, 6, 8, 9, 10, 11])
+        self.assertEqual(records[0][1], ('Товар 1', 'R1', '3', ''))
+        self.assertEqual(records[3][1], ('Товар 4', 'R4', '', ''))
+        # Следующая за 6-й неудаленной - удаленная запись 7, чтение ее пропускает
+        self.assertEqual(reader.record_index(6), 7)
+        self.assertEqual(list(reader.iter_records(7, 10)), records[6:8])
+
+    @skipIf(DBF is None, 'dbfread не установлен')
+    def test_matches_dbfread(self):
+        columns = ['TMP_ID', 'NAME', 'SECTION_ID']
+        expected = [
+            tuple(str(record[column]).strip() for column in columns)
+            for record in DBF(self.path, encoding='cp1251', load=False)
+        ]
+        self.assertEqual(list(DBFReader(self.path, 'cp1251', columns)), expected)
+
+
+class BulkLoadSessionTest(ShopTestCase):
+    """Режим массовой загрузки снимает неуникальные индексы товаров и строит их в конце"""
+
+    def product_indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'shop_product' AND sql IS NOT NULL")
+            return {row[0] for row in cursor.fetchall()}
+
+    def test_connection_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], 5000)
+
+    def test_session_rebuilds_indexes(self):
+        indexes = self.product_indexes()
+        self.assertIn('product_stock_price_idx', indexes)
+
+        with bulk_load_session():
+            # Сняты только индексы сортировок; внешние ключи и фильтры каталога на месте
+            self.assertEqual(
+                self.product_indexes(),
+                {'shop_product_brand_id_505fec11', 'shop_product_category_id_14d7eea8',
+                 'shop_product_analog_group_2b8ea6bb', 'shop_product_root_section_f7dec8e0'},
+            )
+            with connection.cursor() as cursor:
+                # Уникальные индексы (tmp_id, slug) нужны upsert - они остаются
+                cursor.execute("PRAGMA index_list('shop_product')")
+                self.assertEqual(sum(row[2] for row in cursor.fetchall()), 2)
+                cursor.execute('PRAGMA cache_size')
+                self.assertEqual(cursor.fetchone()[0], -262144)
+
+        self.assertEqual(self.product_indexes(), indexes)
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA cache_size')
+            self.assertNotEqual(cursor.fetchone()[0], -262144)
+
+    def test_restore_after_crash(self):
+        indexes = self.product_indexes()
+        deferred = defer_indexes()
+        self.assertTrue(deferred)
+        # Импорт упал, не построив индексы: их SQL остался в базе
+        self.assertEqual(sorted(restore_deferred_indexes()), sorted(deferred))
+        self.assertEqual(self.product_indexes(), indexes)
+        self.assertEqual(restore_deferred_indexes(), [])
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [DEFERRED_INDEX_TABLE])
+            self.assertIsNone(cursor.fetchone())
+
+
+class ImportProgressTest(ShopTestCase):
+    """Счетчики импорта идут в файл прогресса, в базу - не чаще интервала; отмена - тем же каналом"""
+
+    def setUp(self):
+        tmp_dir = self.make_tmp_dir()
+        settings_override = override_settings(
+            IMPORT_PROGRESS_DIR=tmp_dir, IMPORT_PROGRESS_WRITE_INTERVAL=0, IMPORT_PROGRESS_FLUSH_INTERVAL=3600,
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.job = ImportFile.objects.create(file='imports/import.csv', original_filename='import.csv', status='processing')
+
+    def test_updates_skip_database(self):
+        progress = ImportProgress(self.job.pk)
+        with self.assertNumQueries(0):
+            for row in range(1, 1001):
+                progress.update(current_row=row, processed_rows=row)
+        self.assertEqual(read_progress(self.job.pk)['current_row'], 1000)
+        self.assertEqual(ImportFile.objects.get(pk=self.job.pk).current_row, 0)
+
+        # Админка видит свежие счетчики из файла
+        self.assertEqual(ImportFile.objects.get(pk=self.job.pk).apply_live_progress().current_row, 1000)
+
+        progress.close()
+        self.assertEqual(ImportFile.objects.get(pk=self.job.pk).processed_rows, 1000)
+        # Файл с итогом остается до следующего запуска
+        self.job.enqueue()
+        self.assertFalse(os.path.exists(progress_path(self.job.pk)))
+
+    def test_cancel(self):
+        progress = ImportProgress(self.job.pk)
+        progress.checked_at -= 60
+        self.assertFalse(progress.is_cancelled())
+
+        request_cancel(self.job.pk)
+        # Файл отмены проверяется не чаще раза в секунду
+        self.assertFalse(progress.is_cancelled())
+        progress.checked_at -= 60
+        with self.assertNumQueries(0):
+            self.assertTrue(progress.is_cancelled())
+
+        # Новый запуск из очереди не видит старую отмену
+        self.job.enqueue()
+        self.assertFalse(cancel_requested(self.job.pk))
+
+    def test_cancel_keeps_checkpoint(self):
+        # Админка загрузила запись, потом команда сохранила пачку
+        stale = ImportFile.objects.get(pk=self.job.pk)
+        ImportFile.objects.filter(pk=self.job.pk).update(committed_row=500, processed_rows=500, checkpoint={'offset': 2048})
+
+        self.assertTrue(stale.cancel())
+        job = ImportFile.objects.get(pk=self.job.pk)
+        self.assertEqual((job.status, job.cancelled), ('cancelled', True))
+        self.assertEqual((job.committed_row, job.processed_rows, job.checkpoint), (500, 500, {'offset': 2048}))
+        self.assertTrue(cancel_requested(self.job.pk))
+        self.assertFalse(stale.cancel())
+
+    def test_event_stream(self):
+        progress = ImportProgress(self.job.pk)
+        progress.start(total_rows=1000, phase='rows')
+        steps = iter([
+            lambda: progress.update(current_row=100),
+            lambda: None,
+            lambda: progress.update(current_row=300),
+            lambda: progress.set_phase('analogs'),
+            lambda: progress.finish('completed'),
+        ])
+        clock = [time.time()]
+
+        def sleep(seconds):
+            # Каждый тик команда записывает новый отсчет на секунду позже
+            clock[0] += 1
+            with patch('shop.import_progress.time.time', return_value=clock[0]):
+                next(steps)()
+
+        initial = {'status': 'processing', 'current_row': 0, 'total_rows': 1000}
+        with self.assertNumQueries(0):
+            events = list(progress_events(self.job.pk, initial, heartbeat_interval=1, sleep=sleep))
+
+        parsed = [
+            (lines[0][len('event: '):], json.loads(lines[1][len('data: '):]))
+            for lines in (event.split('\n') for event in events) if lines[0].startswith('event: ')
+        ]
+        names = [name for name, _ in parsed]
+        self.assertEqual(names, ['progress', 'phase', 'progress', 'progress', 'phase', 'progress', 'phase', 'progress', 'done'])
+        rates = [(data['rows_per_sec'], data['eta_seconds']) for name, data in parsed if data.get('current_row') == 300]
+        # 200 строк за 2 секунды, осталось 700 строк; смена этапа скорость не меняет
+        self.assertEqual(set(rates), {(100, 7)})
+        self.assertIn(': heartbeat\n\n', events)
+        self.assertEqual(parsed[-1], ('done', {'status': 'completed'}))
+
+
+class ImportInspectTest(ShopTestCase):
+    """Анализ при загрузке: образец для кодировки, разделителя и оценки строк, заголовок DBF"""
+
+    def setUp(self):
+        self.tmp_dir = self.make_tmp_dir()
+
+    def test_csv(self):
+        path = os.path.join(self.tmp_dir, 'import.csv')
+        with open(path, 'wb') as f:
+            f.write('TMP_ID#NAME#PRODUCER\n'.encode('cp1251'))
+            for i in range(1, 1001):
+                f.write(f'{i}#Товар; деталь {i}#Бренд\n'.encode('cp1251'))
+            f.write('1001#Последняя#Бренд'.encode('cp1251'))
+        info = inspect_file(path)
+        # Файл меньше образца - число строк точное
+        self.assertEqual((info['type'], info['total_rows'], info['estimated'], info['delimiter']), ('CSV', 1001, False, '#'))
+        self.assertNotIn(info['encoding'], ('utf-8', 'ascii'))
+
+        with open(path, 'ab') as f:
+            for i in range(1002, 10001):
+                f.write(f'\n{i}#Товар; деталь {i}#Бренд'.encode('cp1251'))
+        info = inspect_file(path)
+        self.assertTrue(info['estimated'])
+        self.assertEqual(count_csv_rows(path), 10000)
+        self.assertAlmostEqual(info['total_rows'], 10000, delta=500)
+
+        with open(path, 'wb') as f:
+            pass
+        self.assertEqual(count_csv_rows(path), 0)
+        self.assertEqual(sniff_delimiter('a;b;c\n1;2;3\n'), ';')
+
+    def test_upload_count(self):
+        path = os.path.join(self.tmp_dir, 'import.dbf')
+        write_dbf(path, [('TMP_ID', 10)], [[f'R{i}'] for i in range(10)], deleted={1})
+        self.assertEqual(inspect_file(path), {'type': 'DBF', 'total_rows': 10, 'estimated': False})
+
+        job = ImportFile.objects.create(file='import.dbf', original_filename='import.dbf')
+        with override_settings(MEDIA_ROOT=self.tmp_dir):
+            self.assertEqual(inspect_import_file(job.pk)['total_rows'], 10)
+        self.assertEqual(ImportFile.objects.get(pk=job.pk).total_rows, 10)
+
+        # Число, уже записанное импортом, оценка не перезаписывает
+        ImportFile.objects.filter(pk=job.pk).update(total_rows=9)
+        with override_settings(MEDIA_ROOT=self.tmp_dir):
+            inspect_import_file(job.pk)
+        self.assertEqual(ImportFile.objects.get(pk=job.pk).total_rows, 9)
+
+
+class FileEncodingTest(ShopTestCase):
+    """Кодировка по BOM, образцу для chardet и строгому декодированию окон; кэш по отпечатку файла"""
+
+    def setUp(self):
+        tmp_dir = self.make_tmp_dir()
+        self.addCleanup(caches['imports'].clear)
+        self.path = os.path.join(tmp_dir, 'import.csv')
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def test_bom(self):
+        self.write(b'\xef\xbb\xbf' + 'TMP_ID#NAME\n1#Шина\n'.encode('utf-8'))
+        self.assertEqual(detect_encoding(self.path), 'utf-8-sig')
+
+        # UTF-16 определяется, но импорт CSV (строки по байту b'\\n') его не принимает
+        self.write('TMP_ID#NAME#PRODUCER#TMC#ART#MODEL#CROSS#SECTION\n1#Шина#BOSCH#N#A#ВАЗ#C#[10]#\n'.encode('utf-16'))
+        self.assertEqual(detect_encoding(self.path), 'utf-16')
+        self.assertFalse(supports_byte_lines('utf-16'))
+        self.assertTrue(supports_byte_lines('cp1251'))
+        out = StringIO()
+        call_command('import_products_new', self.path, stdout=out)
+        self.assertIn('Кодировка utf-16 не поддерживается', out.getvalue())
+        self.assertFalse(Product.objects.exists())
+
+    def test_sampled_windows(self):
+        # Начало файла - ASCII, кириллица только дальше: решают окна по всему файлу
+        head = ''.join(f'{i}#Tyre {i}#Brand\n' for i in range(5000))
+        tail = ''.join(f'{i}#Шина зимняя {i}#Бренд\n' for i in range(5000))
+        self.write((head + tail).encode('cp1251'))
+        self.assertEqual(detect_encoding(self.path), 'cp1251')
+        self.assertFalse(is_decodable(self.path, 'utf-8'))
+
+        caches['imports'].clear()
+        # Окна UTF-8 начинаются и кончаются посреди двухбайтовых символов
+        data = (head + tail).encode('utf-8')
+        self.assertGreater(len(data), WINDOW_SIZE * 8)
+        self.write(data)
+        self.assertEqual(detect_encoding(self.path), 'utf-8')
+        self.assertTrue(is_decodable(self.path, 'utf-8'))
+
+    def test_cache(self):
+        self.write('TMP_ID#NAME\n1#Шина\n'.encode('cp1251') * 1000)
+        self.assertEqual(detect_encoding(self.path), 'cp1251')
+        with patch('shop.file_encoding.chardet') as chardet:
+            self.assertEqual(detect_encoding(self.path), 'cp1251')
+        chardet.detect.assert_not_called()
+
+
+class ImportTimingsTest(ShopTestCase):
+    """Замеры импорта: разбор, разрешение и запись по пачкам, скорость и ETA по последним пачкам"""
+
+    def test_batch_series(self):
+        timings = ImportTimings()
+        clock = iter(range(0, 1000))
+        with patch('shop.import_metrics.time.perf_counter', side_effect=lambda: next(clock)):
+            timings.reset_batch()                       # 0
+            rows = timings.timed_rows(iter([1, 2]))
+            self.assertEqual(next(rows), 1)             # разбор 1..2
+            self.assertEqual(next(rows), 2)             # разбор 3..4
+            with timings.writing():                     # запись 5..6
+                pass
+            timings.batch(2, 2)                         # 7: разрешение 7 - 2 - 1 = 4
+        self.assertEqual(timings.batches, [[2, 2, 2000, 4000, 1000]])
+        self.assertEqual(dict(timings.phases), {'parse': 2, 'resolve': 4, 'write': 1})
+
+    def test_compact(self):
+        with override_settings(IMPORT_TIMING_MAX_BATCHES=4):
+            timings = ImportTimings(batches=[[row * 10, 10, 100, 200, 300] for row in range(1, 5)])
+        timings.batches.append([50, 10, 100, 200, 300])
+        timings.compact()
+        self.assertEqual(timings.batches, [[20, 20, 200, 400, 600], [40, 20, 200, 400, 600], [50, 10, 100, 200, 300]])
+
+    def test_speed_and_eta(self):
+        job = ImportFile.objects.create(
+            file='imports/import.csv', original_filename='import.csv', status='processing',
+            total_rows=10000, current_row=4000,
+            # 1000 строк за секунду, последние 5 пачек - 2000 строк в секунду
+            batch_timings=[[1000, 1000, 500, 300, 200]] + [[1000 + i * 600, 600, 100, 100, 100] for i in range(1, 6)],
+        )
+        self.assertEqual(job.rows_per_sec, 2000)
+        self.assertEqual(job.eta_seconds, 3)
+        self.assertEqual(job.processing_speed, int(4000 / 2.5))
+        # С временем этапов - сквозная скорость по всем этапам
+        job.processed_rows, job.phase_timings = 4000, {'parse': 1, 'resolve': 1, 'write': 1, 'analogs': 1}
+        self.assertEqual(job.processing_speed, 1000)
+
+        job = ImportFile.objects.create(
+            file='imports/import.csv', original_filename='import.csv', status='processing', processed_rows=500,
+            started_at=timezone.now() - timedelta(seconds=10),
+        )
+        # До первой сохраненной пачки скорость - по времени с начала импорта (не с загрузки файла)
+        self.assertAlmostEqual(job.processing_speed, 50, delta=1)
+        self.assertIsNone(job.eta_seconds)
+
+        ImportFile.add_phase_timing(job.pk, 'indexes', 1.5)
+        ImportFile.add_phase_timing(job.pk, 'indexes', 1)
+        self.assertEqual(ImportFile.objects.get(pk=job.pk).phase_timings, {'indexes': 2.5})
+
+
+class ImageManifestTest(ShopTestCase):
+    """Наличие изображения определяется по манифесту, а не по файловой системе"""
+
+    def setUp(self):
+        tmp_dir = self.make_tmp_dir()
+        images_root = os.path.join(tmp_dir, 'images')
+        os.makedirs(os.path.join(images_root, '77'))
+        open(os.path.join(images_root, '77', '000123.jpg'), 'wb').close()
+
+        settings_override = override_settings(
+            IMAGES_ROOT=images_root,
+            IMAGE_MANIFEST_PATH=os.path.join(tmp_dir, 'manifest.json'),
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        image_manifest.reset()
+        self.addCleanup(image_manifest.reset)
+
+        brand = Brand.objects.create(name='Бренд', slug='brand')
+        root = Category.objects.create(name='Корень', slug='77')
+        category = Category.objects.create(name='Раздел', slug='77-1', parent=root)
+        self.with_image = Product.objects.create(tmp_id='000123', code='000123', name='С фото', slug='with-image', category=category, brand=brand, price=1)
+        self.without_image = Product.objects.create(tmp_id='000124', code='000124', name='Без фото', slug='without-image', category=category, brand=brand, price=1)
+
+    def test_has_main_image(self):
+        self.assertEqual(image_manifest.build_manifest(), {'77/000123.jpg'})
+        with patch('os.path.exists') as exists, patch('os.stat') as stat:
+            self.assertTrue(self.with_image.has_main_image)
+            self.assertFalse(self.without_image.has_main_image)
+        exists.assert_not_called()
+        stat.assert_not_called()
+
+    def test_manifest_reload(self):
+        image_manifest.build_manifest()
+        self.assertFalse(self.without_image.has_main_image)
+
+        # Манифест обновлен другим процессом (build_image_manifest --watch)
+        image_manifest.write_manifest({'77/000123.jpg', '77/000124.jpg'})
+        os.utime(image_manifest.manifest_path(), (0, 0))
+        with self.settings(IMAGE_MANIFEST_RELOAD_INTERVAL=0):
+            self.assertTrue(self.without_image.has_main_image)
+
+    def test_missing_manifest(self):
+        # Без манифеста запрос не сканирует папку: изображений нет, манифест строится в фоне
+        with patch.object(image_manifest, 'scan_images') as scan, \
+                patch.object(image_manifest, 'build_in_background') as build:
+            self.assertFalse(self.with_image.has_main_image)
+            self.assertFalse(self.with_image.has_main_image)
+        scan.assert_not_called()
+        build.assert_called_once()
+
+        image_manifest.build_manifest()
+        self.assertTrue(self.with_image.has_main_image)
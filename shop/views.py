@@ -1,8 +1,13 @@
 from django.shortcuts import render, get_object_or_404
+from django.http import Http404
 from django.views.generic import TemplateView, ListView, DetailView
 from django.db.models import Q
-from django.db import models
-from .models import Product, Category, Brand, OeKod
+from django.conf import settings
+from .models import Product, Category, OeKod, ProductNumber
+from . import catalog_cache, fts
+from .catalog_cache import CachedProductList
+from .facets import build_facets
+from .pagination import KEYSET_ORDERINGS, approximate_count, decode_cursor, encode_cursor, keyset_q
 import logging
 
 # Настройка логирования
@@ -15,199 +20,228 @@ class CatalogView(ListView):
     context_object_name = 'products'
     paginate_by = 100
     
+    def log_count(self, message, queryset):
+        """
+        Диагностический подсчет товаров. Выполняет COUNT только при
+        settings.CATALOG_DEBUG_COUNTS, иначе запрос к базе не делается
+        """
+        if getattr(settings, 'CATALOG_DEBUG_COUNTS', False):
+            logger.debug(f"{message}: {queryset.count()} товаров")
+    
     def get_queryset(self):
-        # Начинаем с базового queryset всех товаров в наличии
+        # План запроса строится лениво: фильтры лишь дополняют queryset,
+        # а выполняется он один раз - при пагинации (COUNT + страница)
         base_queryset = Product.objects.filter(in_stock=True)
-        
-        # Логируем базовый queryset
-        logger.info(f"Базовый queryset: {base_queryset.count()} товаров")
+        self.log_count("Базовый queryset", base_queryset)
         
         # Поиск согласно ТЗ (приоритет поиска выше фильтров)
         search = self.request.GET.get('search')
+        ranked_search = False
         if search:
             search = search.strip()
             logger.info(f"Поисковый запрос: '{search}'")
             
             # Определяем является ли запрос поиском по номеру
             if OeKod.is_number_search(search):
-                logger.info(f"Поиск по номеру: '{search}'")
-                
-                # Для коротких номеров (менее 5 символов) используем только точное совпадение
+                # Поиск идет по индексу нормализованных номеров (code, tmp_id,
+                # catalog_number, artikyl_number, cross_number и номера OE),
+                # поэтому "1234-567" и "1234567" находят один и тот же товар
                 if len(search) < 5:
-                    logger.info(f"Короткий номер, точное совпадение: '{search}'")
+                    # Для коротких номеров (менее 5 символов) номера товара сравниваем точно,
+                    # а номера OE, как и прежде, по началу номера
+                    logger.info(f"Поиск по номеру, точное совпадение: '{search}'")
                     number_search_query = (
-                        Q(code__iexact=search) |                    # TMP_ID точное совпадение
-                        Q(tmp_id__iexact=search) |                  # TMP_ID точное совпадение (дублирующее поле)
-                        Q(catalog_number__iexact=search) |          # PROPERTY_TMC_NUMBER точное совпадение
-                        Q(artikyl_number__iexact=search) |          # PROPERTY_ARTIKYL_NUMBER точное совпадение
-                        Q(cross_number__iexact=search)              # PROPERTY_CROSS_NUMBER точное совпадение
+                        ProductNumber.search_q(search) |
+                        Q(pk__in=OeKod.objects.filter(oe_kod__istartswith=search).values('product_id'))
                     )
                 else:
                     # Для длинных номеров используем точное совпадение + начинается с
-                    logger.info(f"Длинный номер, точное + частичное совпадение: '{search}'")
-                    number_search_query = (
-                        Q(code__iexact=search) |                    # TMP_ID точное совпадение
-                        Q(tmp_id__iexact=search) |                  # TMP_ID точное совпадение (дублирующее поле)
-                        Q(catalog_number__iexact=search) |          # PROPERTY_TMC_NUMBER точное совпадение
-                        Q(artikyl_number__iexact=search) |          # PROPERTY_ARTIKYL_NUMBER точное совпадение
-                        Q(cross_number__iexact=search) |            # PROPERTY_CROSS_NUMBER точное совпадение
-                        Q(code__istartswith=search) |               # TMP_ID начинается с
-                        Q(tmp_id__istartswith=search) |             # TMP_ID начинается с
-                        Q(catalog_number__istartswith=search) |     # PROPERTY_TMC_NUMBER начинается с
-                        Q(artikyl_number__istartswith=search) |     # PROPERTY_ARTIKYL_NUMBER начинается с
-                        Q(cross_number__istartswith=search)         # PROPERTY_CROSS_NUMBER начинается с
-                    )
+                    logger.info(f"Поиск по номеру, точное + частичное совпадение: '{search}'")
+                    number_search_query = ProductNumber.search_q(search, prefix=True)
                 
-                # Поиск в таблице аналогов OE
-                oe_products = Product.objects.filter(
-                    oe_analogs__oe_kod__istartswith=search
-                ).distinct()
+                # Находим товары, соответствующие поиску по номеру (используется только как подзапрос)
+                found_products = Product.objects.filter(number_search_query)
+                self.log_count("Найдено товаров по номеру", found_products)
                 
-                logger.info(f"Найдено товаров по номеру: {Product.objects.filter(number_search_query).count()}")
-                logger.info(f"Найдено товаров по OE аналогам: {oe_products.count()}")
-                
-                # Находим товары, соответствующие поиску по номеру
-                found_products = Product.objects.filter(number_search_query).distinct()
-                
-                # Объединяем результаты
-                if oe_products.exists():
-                    found_products = found_products.union(oe_products).distinct()
-                
-                if found_products.exists():
-                    logger.info(f"Всего найдено товаров по номеру: {found_products.count()}")
-                    
-                    # Этап 2: Собираем все номера найденных товаров для поиска связанных
-                    related_numbers = set()
-                    
-                    for product in found_products:
-                        # Добавляем номера товара
-                        if product.catalog_number:  # PROPERTY_TMC_NUMBER
-                            related_numbers.add(product.catalog_number)
-                        if product.artikyl_number:  # PROPERTY_ARTIKYL_NUMBER
-                            related_numbers.add(product.artikyl_number)
-                        if product.cross_number:    # PROPERTY_CROSS_NUMBER
-                            related_numbers.add(product.cross_number)
-                    
-                    logger.info(f"Связанных номеров найдено: {len(related_numbers)}")
-                    
-                    # Этап 3: Находим все товары с точным совпадением этих номеров
-                    if related_numbers:
-                        analog_query = Q()
-                        for number in related_numbers:
-                            analog_query |= (
-                                Q(catalog_number__exact=number) |  # PROPERTY_TMC_NUMBER
-                                Q(artikyl_number__exact=number) |  # PROPERTY_ARTIKYL_NUMBER  
-                                Q(cross_number__exact=number)      # PROPERTY_CROSS_NUMBER
-                            )
-                        
-                        # Финальный результат: объединяем найденные товары и их аналоги
-                        queryset = base_queryset.filter(analog_query).distinct()
-                        logger.info(f"Финальный результат поиска по номеру: {queryset.count()} товаров")
-                    else:
-                        queryset = base_queryset.filter(pk__in=[p.pk for p in found_products])
-                        logger.info(f"Результат поиска по номеру (без аналогов): {queryset.count()} товаров")
-                else:
-                    # Если по номеру ничего не найдено, возвращаем пустой результат
-                    logger.warning(f"По номеру '{search}' ничего не найдено")
-                    queryset = Product.objects.none()
+                # Аналоги найденных товаров - все товары из тех же групп аналогов
+                # (общие номера, номера OE и связи ProductAnalog), одним запросом по индексу.
+                # Товары без группы (еще не пересчитанные после импорта) берем по pk
+                analog_query = (
+                    Q(analog_group__in=found_products.exclude(analog_group=None).values('analog_group')) |
+                    Q(pk__in=found_products.values('pk'))
+                )
+                queryset = base_queryset.filter(analog_query)
+                self.log_count("Результат поиска по номеру с аналогами", queryset)
             else:
                 logger.info(f"Поиск по тексту: '{search}'")
                 
-                # ПОИСК ПО НАЗВАНИЮ И БРЕНДУ - ищем по ВСЕМ товарам независимо от фильтров
-                text_search_query = (
-                    Q(name__icontains=search) |
-                    Q(brand__name__icontains=search) |
-                    Q(description__icontains=search) |
-                    Q(applicability__icontains=search)
-                )
-                
-                queryset = base_queryset.filter(text_search_query)
-                logger.info(f"Результат поиска по тексту: {queryset.count()} товаров")
+                # Полнотекстовый поиск FTS5 с ранжированием по bm25
+                queryset = fts.search(base_queryset, search)
+                if queryset is not None:
+                    ranked_search = True
+                else:
+                    # FTS5 недоступен - ПОИСК ПО НАЗВАНИЮ И БРЕНДУ через icontains
+                    text_search_query = (
+                        Q(name__icontains=search) |
+                        Q(brand__name__icontains=search) |
+                        Q(description__icontains=search) |
+                        Q(applicability__icontains=search)
+                    )
+                    queryset = base_queryset.filter(text_search_query)
+                self.log_count("Результат поиска по тексту", queryset)
         else:
-            # Если поиска нет, применяем фильтры к базовому queryset
             queryset = base_queryset
-            logger.info("Поисковый запрос отсутствует, применяем только фильтры")
-        
-        # Применяем фильтры только если НЕ было поиска или поиск вернул результаты
-        if not search or (search and queryset.exists()):
-            # Фильтр по категории (множественный выбор)
-            category_slugs = self.request.GET.getlist('category')
-            if category_slugs:
-                logger.info(f"Применяем фильтр по категориям: {category_slugs}")
-                queryset = queryset.filter(category__slug__in=category_slugs)
-                logger.info(f"После фильтра по категориям: {queryset.count()} товаров")
-            
-            # Фильтр по бренду (множественный выбор)
-            brand_slugs = self.request.GET.getlist('brand')
-            if brand_slugs:
-                logger.info(f"Применяем фильтр по брендам: {brand_slugs}")
-                queryset = queryset.filter(brand__slug__in=brand_slugs)
-                logger.info(f"После фильтра по брендам: {queryset.count()} товаров")
-            
-            # Фильтр по цене
-            min_price = self.request.GET.get('min_price')
-            max_price = self.request.GET.get('max_price')
-            if min_price:
-                logger.info(f"Применяем фильтр по минимальной цене: {min_price}")
-                queryset = queryset.filter(price__gte=min_price)
-                logger.info(f"После фильтра по минимальной цене: {queryset.count()} товаров")
-            if max_price:
-                logger.info(f"Применяем фильтр по максимальной цене: {max_price}")
-                queryset = queryset.filter(price__lte=max_price)
-                logger.info(f"После фильтра по максимальной цене: {queryset.count()} товаров")
-        
-        # Сортировка
-        sort = self.request.GET.get('sort', 'newest')
-        if sort == 'price_asc':
-            queryset = queryset.order_by('price')
-            logger.info("Сортировка по возрастанию цены")
-        elif sort == 'price_desc':
-            queryset = queryset.order_by('-price')
-            logger.info("Сортировка по убыванию цены")
-        elif sort == 'name':
-            queryset = queryset.order_by('name')
-            logger.info("Сортировка по названию")
+        
+        # Фильтры. Пустой результат поиска остается пустым и после фильтрации,
+        # поэтому отдельная проверка exists() не нужна
+        category_slugs = self.request.GET.getlist('category')
+        if category_slugs:
+            logger.info(f"Применяем фильтр по категориям: {category_slugs}")
+            # Вместе с подкатегориями - по материализованному пути Category.path
+            queryset = queryset.filter(Category.subtree_q(category_slugs))
+            self.log_count("После фильтра по категориям", queryset)
+        
+        # Фильтр по корневому разделу (SECTION_ID) - по индексу Product.root_section
+        sections = self.request.GET.getlist('section')
+        if sections:
+            logger.info(f"Применяем фильтр по разделам: {sections}")
+            queryset = queryset.filter(root_section__in=sections)
+            self.log_count("После фильтра по разделам", queryset)
+        
+        brand_slugs = self.request.GET.getlist('brand')
+        if brand_slugs:
+            logger.info(f"Применяем фильтр по брендам: {brand_slugs}")
+            queryset = queryset.filter(brand__slug__in=brand_slugs)
+            self.log_count("После фильтра по брендам", queryset)
+        
+        min_price = self.request.GET.get('min_price')
+        max_price = self.request.GET.get('max_price')
+        if min_price:
+            queryset = queryset.filter(price__gte=min_price)
+            self.log_count("После фильтра по минимальной цене", queryset)
+        if max_price:
+            queryset = queryset.filter(price__lte=max_price)
+            self.log_count("После фильтра по максимальной цене", queryset)
+        
+        # Сортировка. id в конце ключа делает порядок однозначным - это нужно
+        # для keyset-пагинации (см. shop.pagination)
+        sort = self.request.GET.get('sort')
+        if not sort and ranked_search:
+            self.sort = 'relevance'
+            queryset = queryset.order_by('search_rank', '-created_at', '-id')
         else:
-            queryset = queryset.order_by('-created_at')
-            logger.info("Сортировка по дате создания (новые сначала)")
+            self.sort = sort if sort in KEYSET_ORDERINGS else 'newest'
+            queryset = queryset.order_by(*KEYSET_ORDERINGS[self.sort])
+        
+        # Бренд и категория нужны в каждой карточке товара, изображения - для превью
+        queryset = queryset.select_related('brand', 'category').prefetch_related('images')
+        self.result_queryset = queryset
         
-        logger.info(f"Финальный результат: {queryset.count()} товаров")
+        # Кэш результатов: упорядоченный список id и фасеты по параметрам запроса
+        self.cache_key = catalog_cache.make_key(self.request.GET)
+        self.cached_result = catalog_cache.get_result(self.cache_key)
+        products = Product.objects.select_related('brand', 'category').prefetch_related('images')
+        if self.cached_result is not None:
+            if self.cached_result['ids'] is not None:
+                return CachedProductList(self.cached_result['ids'], products)
+            return queryset
+        
+        if getattr(settings, 'CATALOG_CACHE_TTL', 0):
+            # Один запрос за id вместо COUNT; слишком большие выборки не кэшируем целиком
+            max_ids = getattr(settings, 'CATALOG_CACHE_MAX_IDS', 5000)
+            ids = list(queryset.values_list('id', flat=True)[:max_ids + 1])
+            if len(ids) <= max_ids:
+                return CachedProductList(ids, products)
         return queryset
     
+    def get_paginator(self, queryset, *args, **kwargs):
+        paginator = super().get_paginator(queryset, *args, **kwargs)
+        if self.cached_result is not None and self.cached_result['ids'] is None:
+            # Количество большой выборки берем из кэша, без COUNT
+            paginator.count = self.cached_result['count']
+        return paginator
+    
+    def paginate_queryset(self, queryset, page_size):
+        """
+        С параметром after= страница выбирается по курсору (keyset) без OFFSET
+        и без полного COUNT; иначе - обычная постраничная навигация
+        """
+        self.keyset = None
+        after = self.request.GET.get('after')
+        if not after or self.sort not in KEYSET_ORDERINGS:
+            return super().paginate_queryset(queryset, page_size)
+        
+        cursor = decode_cursor(after, self.sort)
+        if cursor is None:
+            raise Http404('Неверный курсор страницы')
+        
+        if isinstance(queryset, CachedProductList) and cursor[1] in queryset.ids:
+            # Выборка в кэше - страница берется прямо из списка id
+            start = queryset.index(cursor[1]) + 1
+            self.keyset = {
+                'has_next': start + page_size < len(queryset),
+                'approximate_total': len(queryset),
+            }
+            return (None, None, queryset[start:start + page_size], False)
+        if isinstance(queryset, CachedProductList):
+            queryset = self.result_queryset
+        
+        object_list = list(queryset.filter(keyset_q(self.sort, cursor))[:page_size + 1])
+        self.keyset = {
+            'has_next': len(object_list) > page_size,
+            'approximate_total': approximate_count(queryset),
+        }
+        return (None, None, object_list[:page_size], False)
+    
+    def get_next_cursor_query(self, object_list, has_next):
+        """Query string следующей страницы в keyset-режиме (для ссылки "далее" и rel=next)"""
+        if not has_next or not object_list or self.sort not in KEYSET_ORDERINGS:
+            return ''
+        params = self.request.GET.copy()
+        params.pop('page', None)
+        params['after'] = encode_cursor(self.sort, object_list[-1])
+        return params.urlencode()
+    
+    def store_cached_result(self, context, facets):
+        """Сохраняет в кэш результат запроса, если его размер известен без дополнительного COUNT"""
+        if isinstance(self.object_list, CachedProductList):
+            catalog_cache.set_result(self.cache_key, self.object_list.ids, len(self.object_list), facets)
+        elif context['paginator'] is not None:
+            catalog_cache.set_result(self.cache_key, None, context['paginator'].count, facets)
+    
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         
-        # Логируем контекст
-        logger.info(f"Формируем контекст для страницы каталога")
-        
-        # Основные категории (без родителя)
-        context['main_categories'] = Category.objects.filter(parent=None, is_active=True).order_by('order', 'name')
-        logger.info(f"Основных категорий: {context['main_categories'].count()}")
+        # Курсор следующей страницы: в keyset-режиме это основная навигация,
+        # в обычном - ссылка rel=next, по которой краулеры уходят в keyset-режим
+        products = list(context['products'])
+        if self.keyset is not None:
+            context['keyset'] = self.keyset
+            has_next = self.keyset['has_next']
+        else:
+            has_next = context['page_obj'].has_next() if context['is_paginated'] else False
+        context['next_cursor_query'] = self.get_next_cursor_query(products, has_next)
         
-        # Все категории для фильтра
-        context['categories'] = Category.objects.filter(is_active=True).order_by('order', 'name')
-        context['brands'] = Brand.objects.all()
-        logger.info(f"Всего категорий для фильтра: {context['categories'].count()}")
-        logger.info(f"Всего брендов для фильтра: {context['brands'].count()}")
+        # Фасеты по всей текущей выборке (а не только по странице): диапазон цен,
+        # количество товаров по брендам и категориям - одним сгруппированным запросом
+        if self.cached_result is not None:
+            facets = self.cached_result['facets']
+        else:
+            facets = build_facets(self.result_queryset)
+            self.store_cached_result(context, facets)
+        context['facets'] = facets
+        context['main_categories'] = facets['main_categories']
+        context['brands'] = facets['brands']
+        context['min_price'] = facets['min_price']
+        context['max_price'] = facets['max_price']
         
         # Выбранные фильтры для template
         context['selected_categories'] = self.request.GET.getlist('category')
         context['selected_brands'] = self.request.GET.getlist('brand')
-        logger.info(f"Выбранные категории: {context['selected_categories']}")
-        logger.info(f"Выбранные бренды: {context['selected_brands']}")
         
         # Поисковый запрос
         context['search_query'] = self.request.GET.get('search', '')
-        if context['search_query']:
-            logger.info(f"Поисковый запрос в контексте: '{context['search_query']}'")
-        
-        # Минимальная и максимальная цена для фильтра
-        if context['products']:
-            context['min_price'] = context['products'].aggregate(min_price=models.Min('price'))['min_price']
-            context['max_price'] = context['products'].aggregate(max_price=models.Max('price'))['max_price']
-            logger.info(f"Диапазон цен: {context['min_price']} - {context['max_price']}")
         
-        logger.info(f"Контекст сформирован, товаров в контексте: {context['products'].count() if context['products'] else 0}")
         return context
 
 
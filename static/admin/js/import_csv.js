@@ -63,6 +63,48 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         }
         
+        // Кнопка продолжения прерванного импорта
+        if (e.target.classList.contains('btn-resume-import')) {
+            e.preventDefault();
+            
+            const fileId = e.target.getAttribute('data-id');
+            const button = e.target;
+            
+            if (confirm('Продолжить импорт с последней сохраненной пачки?')) {
+                button.disabled = true;
+                button.innerHTML = '⏳ Ставлю в очередь...';
+                button.style.background = '#999';
+                
+                fetch(`resume/${fileId}/`, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    }
+                })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        showMessage('success', data.message);
+                        setTimeout(() => {
+                            window.location.href = data.redirect_url;
+                        }, 1000);
+                    } else {
+                        showMessage('error', 'Ошибка: ' + data.message);
+                        button.disabled = false;
+                        button.innerHTML = '⏯ Продолжить';
+                        button.style.background = '#17a2b8';
+                    }
+                })
+                .catch(error => {
+                    console.error('Error:', error);
+                    showMessage('error', 'Произошла ошибка при продолжении импорта');
+                    button.disabled = false;
+                    button.innerHTML = '⏯ Продолжить';
+                    button.style.background = '#17a2b8';
+                });
+            }
+        }
+        
         // Кнопка отмены импорта
         if (e.target.classList.contains('btn-cancel-import')) {
             e.preventDefault();
@@ -140,6 +140,113 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Диагностические COUNT-запросы в CatalogView (логируются на уровне DEBUG).
+# Каждый такой подсчет - отдельный запрос к базе, поэтому по умолчанию выключено
+CATALOG_DEBUG_COUNTS = False
+
+# Время кэширования (сек) приблизительного количества товаров в keyset-режиме
+# каталога (параметр after=). 0 - не показывать общее количество
+CATALOG_APPROXIMATE_TOTAL_TTL = 600
+
+# Кэш результатов каталога (shop.catalog_cache): список id товаров и фасеты
+# по параметрам запроса, сбрасывается импортом и правками в админке.
+# Результаты хранятся в памяти процесса (locmem), а версия каталога - в
+# файловом кэше 'imports', общем для процессов сайта, воркера и команд,
+# поэтому сброс виден всем процессам сразу
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+    # Файловый кэш, общий для процессов сайта, воркера импорта и команд
+    # (версия каталога, кодировки файлов выгрузки)
+    'imports': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'imports',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+# Кэш определенных кодировок файлов выгрузки (shop.file_encoding)
+ENCODING_CACHE_ALIAS = 'imports'
+
+# Кэш результатов каталога и кэш его версии (общий для процессов)
+CATALOG_CACHE_ALIAS = 'catalog'
+CATALOG_VERSION_CACHE_ALIAS = 'imports'
+# Время жизни записи (сек), 0 - кэш выключен
+CATALOG_CACHE_TTL = 300
+# Для выборок больше этого размера кэшируются только количество и фасеты
+CATALOG_CACHE_MAX_IDS = 5000
+
+# Изображения товаров (section_id/tmp_id.jpg) и их манифест (shop.image_manifest).
+# Манифест строится командой build_image_manifest (--watch для слежения),
+# процессы сайта перечитывают его не чаще раза в указанный интервал (сек)
+IMAGES_ROOT = BASE_DIR / 'images'
+IMAGE_MANIFEST_PATH = BASE_DIR / 'images_manifest.json'
+IMAGE_MANIFEST_RELOAD_INTERVAL = 60
+
+# Фоновый воркер импорта (команда run_import_worker). Воркер раз в
+# IMPORT_WORKER_HEARTBEAT_INTERVAL сек отмечает, что жив; импорт без отметки
+# дольше IMPORT_WORKER_STALE_AFTER сек считается упавшим и возвращается в
+# очередь (продолжается с последней сохраненной строки), но не больше
+# IMPORT_WORKER_MAX_ATTEMPTS попыток
+IMPORT_WORKER_HEARTBEAT_INTERVAL = 10
+IMPORT_WORKER_STALE_AFTER = 120
+IMPORT_WORKER_MAX_ATTEMPTS = 3
+# Сколько секунд отмененный импорт может завершаться сам, прежде чем воркер его остановит
+IMPORT_WORKER_CANCEL_GRACE = 15
+
+# Канал прогресса импорта (shop.import_progress): команда пишет счетчики в
+# файл в IMPORT_PROGRESS_DIR раз в IMPORT_PROGRESS_WRITE_INTERVAL сек, в
+# ImportFile - раз в IMPORT_PROGRESS_FLUSH_INTERVAL сек; там же файл отмены
+IMPORT_PROGRESS_DIR = BASE_DIR / 'import_progress'
+IMPORT_PROGRESS_WRITE_INTERVAL = 1
+IMPORT_PROGRESS_FLUSH_INTERVAL = 5
+# Поток прогресса для админки (SSE): комментарий-heartbeat раз в
+# IMPORT_PROGRESS_STREAM_HEARTBEAT сек, через IMPORT_PROGRESS_STREAM_DURATION
+# сек поток закрывается и браузер переподключается
+IMPORT_PROGRESS_STREAM_HEARTBEAT = 15
+IMPORT_PROGRESS_STREAM_DURATION = 300
+
+# Длина ряда замеров по пачкам в ImportFile.batch_timings (shop.import_metrics);
+# при переполнении соседние замеры сливаются попарно
+IMPORT_TIMING_MAX_BATCHES = 1000
+
+# Прагмы каждого соединения SQLite (shop.db_tuning.configure_connection):
+# WAL - сайт читает, пока импорт пишет; busy_timeout (мс) - запись ждет
+# освобождения базы вместо ошибки "database is locked"
+SQLITE_CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+}
+
+# Прагмы на время импорта с --bulk-load. synchronous = OFF переживает падение
+# процесса, но не отключение питания - при риске такого используйте NORMAL
+IMPORT_SQLITE_PRAGMAS = {
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # 256 МБ
+    'temp_store': 'MEMORY',
+}
+
+# Индексы, которые --bulk-load снимает на время загрузки и строит в конце.
+# Индексы внешних ключей и фильтров каталога сюда не добавляйте - без них
+# сайт и сам импорт читают таблицу товаров полным проходом
+IMPORT_DEFERRED_INDEXES = (
+    'product_stock_created_idx',
+    'product_stock_price_idx',
+    'product_stock_name_idx',
+)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 